@@ -0,0 +1,298 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark_server import git_revision, summarize_latencies
+from db_manager import DatabaseManager, TASK_CACHE_SIZE
+
+OPERATIONS = [
+    'register_client',
+    'store_message',
+    'store_task',
+    'update_task_result',
+    'get_task',
+    'get_recent_messages',
+    'get_tasks_by_requester',
+    'get_tasks_by_worker'
+]
+
+REQUESTERS = 100  # Distinct requesters and workers in the synthetic data
+WORKERS = 50
+PREFILL_CHUNK = 50000
+
+
+def log(text):
+    """Progress goes to stderr so stdout stays machine-readable"""
+    print(text, file=sys.stderr, flush=True)
+
+
+def prefill(db_path, start, end, message_log=None):
+    """Grow the clients, messages and tasks tables from `start` to `end` rows each.
+
+    With a message_log the messages are appended to the log instead of the table.
+    """
+    conn = sqlite3.connect(db_path)
+    base_time = time.time() - end
+    for chunk_start in range(start, end, PREFILL_CHUNK):
+        chunk = range(chunk_start, min(chunk_start + PREFILL_CHUNK, end))
+        conn.executemany(
+            "INSERT INTO clients (name, client_type, last_seen, is_connected) VALUES (?, ?, ?, 0)",
+            ((f"Client-{i}", 'regular', base_time + i) for i in chunk)
+        )
+        messages = (
+            ('direct' if i % 4 == 0 else 'broadcast', f"Client-{i % 1000}",
+             f"Client-{(i + 1) % 1000}" if i % 4 == 0 else None,
+             f"synthetic message {i}", base_time + i)
+            for i in chunk
+        )
+        if message_log is not None:
+            message_log.append_many(messages)
+        else:
+            conn.executemany(
+                "INSERT INTO messages (message_type, sender, target, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                messages
+            )
+        conn.executemany(
+            """
+            INSERT INTO tasks
+            (task_id, task_type, worker, requester, parameters, status, submit_time, complete_time, result)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                (f"prefill-{i}", 'calculate', f"Worker-w{i % WORKERS}", f"TaskClient-r{i % REQUESTERS}",
+                 json.dumps({'operation': 'sum', 'numbers': [i, i + 1, i + 2]}), 'completed',
+                 base_time + i, base_time + i + 1, json.dumps({'task_id': f"prefill-{i}", 'result': 3 * i + 3}))
+                for i in chunk
+            )
+        )
+        conn.commit()
+    conn.close()
+
+
+class OperationRunner:
+    """Builds the arguments for each DatabaseManager call under test"""
+
+    def __init__(self, db, size):
+        self.db = db
+        self.size = size
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+    def warm_up(self):
+        """Read every task and task list the read operations pick from, so each run starts with a warm cache"""
+        db = self.db
+        for i in range(min(self.size, 1000)):
+            db.get_task(f"prefill-{self.size - 1 - i}")
+        for i in range(REQUESTERS):
+            db.get_tasks_by_requester(f"TaskClient-r{i}", limit=50)
+        for i in range(WORKERS):
+            db.get_tasks_by_worker(f"Worker-w{i}", limit=50)
+
+    def call(self, operation):
+        db = self.db
+        if operation == 'register_client':
+            # Half re-register an existing client, half add a new one
+            if random.random() < 0.5:
+                db.register_client(f"Client-{random.randrange(self.size)}", 'regular')
+            else:
+                db.register_client(f"BenchClient-{self.next_id()}-{random.random()}", 'regular')
+        elif operation == 'store_message':
+            db.store_message('broadcast', f"Client-{random.randrange(1000)}", "benchmark message")
+        elif operation == 'store_task':
+            db.store_task(f"bench-{self.next_id()}-{random.random()}", 'calculate',
+                          f"Worker-w{random.randrange(WORKERS)}", f"TaskClient-r{random.randrange(REQUESTERS)}",
+                          {'operation': 'sum', 'numbers': [1, 2, 3]})
+        elif operation == 'update_task_result':
+            task_id = f"prefill-{random.randrange(self.size)}"
+            db.update_task_result(task_id, {'task_id': task_id, 'result': 6})
+        elif operation == 'get_task':
+            # Status polling looks at the recent tasks
+            db.get_task(f"prefill-{self.size - 1 - random.randrange(min(self.size, 1000))}")
+        elif operation == 'get_recent_messages':
+            target = f"Client-{random.randrange(1000)}" if random.random() < 0.5 else None
+            db.get_recent_messages(limit=50, target=target)
+        elif operation == 'get_tasks_by_requester':
+            db.get_tasks_by_requester(f"TaskClient-r{random.randrange(REQUESTERS)}", limit=50)
+        elif operation == 'get_tasks_by_worker':
+            db.get_tasks_by_worker(f"Worker-w{random.randrange(WORKERS)}", limit=50)
+        else:
+            raise ValueError(f"Unknown operation: {operation}")
+
+
+def measure(runner, operation, threads, max_ops, max_seconds):
+    """Run one operation from several threads; returns throughput and latency summary"""
+    latencies = []
+    lock = threading.Lock()
+    remaining = [max_ops]
+    deadline = time.perf_counter() + max_seconds
+
+    def work():
+        local = []
+        while time.perf_counter() < deadline:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            start = time.perf_counter()
+            runner.call(operation)
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'ops': len(latencies),
+        'seconds': elapsed,
+        'ops_per_sec': len(latencies) / elapsed if elapsed > 0 else 0,
+        'latency_ms': summarize_latencies(latencies)
+    }
+
+
+def run_benchmark(config):
+    """Run the suite and return the machine-readable result document"""
+    results = []
+    with tempfile.TemporaryDirectory(prefix='ds-dbbench-', dir=config['tmpdir']) as tmpdir:
+        # Each message store gets its own database so the runs do not share data
+        for message_store in config['message_stores']:
+            db_path = os.path.join(tmpdir, f"bench-{message_store}.db")
+            db = DatabaseManager(db_path, task_cache_size=config['task_cache_size'], message_store=message_store,
+                                 message_log_fsync=config['log_fsync'])
+            if message_store == 'log' and not config['log_fsync']:
+                log("Note: the log does not fsync, while SQLite syncs every commit; "
+                    "use --log-fsync for a like-for-like store_message comparison")
+            current_size = 0
+
+            for size in sorted(config['sizes']):
+                log(f"Prefilling {message_store} store to {size} rows per table...")
+                prefill(db_path, current_size, size, db.message_log)
+                current_size = size
+                if db.task_cache is not None:
+                    # prefill wrote behind the manager's back; cached lists would miss the new rows
+                    db.task_cache.clear()
+                runner = OperationRunner(db, size)
+                # Untimed, so the first thread count does not pay for the cold cache alone
+                runner.warm_up()
+
+                for threads in config['threads']:
+                    for operation in config['operations']:
+                        result = measure(runner, operation, threads, config['ops'], config['max_seconds'])
+                        result.update({'message_store': message_store, 'size': size, 'threads': threads,
+                                       'operation': operation})
+                        results.append(result)
+                        log(f"  {message_store:<6} size={size:<9} threads={threads:<3} {operation:<24} "
+                            f"{result['ops_per_sec']:10.1f} ops/s  p99={result['latency_ms']['p99'] or 0:.3f} ms")
+
+            if db.message_log is not None:
+                db.message_log.close()
+
+    return {
+        'benchmark': 'database',
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform()
+        },
+        'config': config,
+        'results': results
+    }
+
+
+def compare_results(baseline, current):
+    """Print the relative throughput change for every (store, size, threads, operation)"""
+    def key(result):
+        # Results from before the message store option were all SQLite
+        return (result.get('message_store', 'sqlite'), result['size'], result['threads'], result['operation'])
+
+    print(f"Baseline {baseline['meta'].get('revision')} -> current {current['meta'].get('revision')}")
+    base = {key(r): r for r in baseline['results']}
+    for result in current['results']:
+        old = base.get(key(result))
+        if not old or not old['ops_per_sec']:
+            continue
+        change = (result['ops_per_sec'] - old['ops_per_sec']) / old['ops_per_sec'] * 100
+        print(f"  {key(result)[0]:<6} size={result['size']:<9} threads={result['threads']:<3} {result['operation']:<24} "
+              f"{old['ops_per_sec']:10.1f} -> {result['ops_per_sec']:10.1f} ops/s ({change:+.1f}%)")
+
+
+def parse_int_list(text):
+    return [int(float(value)) for value in text.split(',') if value.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DatabaseManager micro-benchmark")
+    parser.add_argument('--sizes', default='10000,100000',
+                        help="Comma-separated table sizes, e.g. 10000,100000,1000000,10000000")
+    parser.add_argument('--threads', default='1,4', help="Comma-separated thread counts")
+    parser.add_argument('--operations', default=','.join(OPERATIONS),
+                        help="Comma-separated subset of: " + ', '.join(OPERATIONS))
+    parser.add_argument('--ops', type=int, default=2000, help="Maximum calls per measurement")
+    parser.add_argument('--max-seconds', type=float, default=5, help="Time cap per measurement")
+    parser.add_argument('--task-cache-size', type=int, default=TASK_CACHE_SIZE,
+                        help="Task records cached by DatabaseManager (0 measures the uncached path)")
+    parser.add_argument('--message-stores', default='sqlite',
+                        help="Comma-separated message stores to compare: sqlite, log")
+    parser.add_argument('--log-fsync', action='store_true',
+                        help="fsync the message log after every append, matching SQLite's durability")
+    parser.add_argument('--tmpdir', help="Directory for the temporary databases")
+    parser.add_argument('--output', help="Write the JSON result to this file instead of stdout")
+    parser.add_argument('--baseline', help="Compare against a previous JSON result")
+    args = parser.parse_args()
+
+    operations = [op.strip() for op in args.operations.split(',') if op.strip()]
+    unknown = [op for op in operations if op not in OPERATIONS]
+    if unknown:
+        parser.error(f"Unknown operations: {', '.join(unknown)}")
+
+    message_stores = [store.strip() for store in args.message_stores.split(',') if store.strip()]
+    unknown = [store for store in message_stores if store not in ('sqlite', 'log')]
+    if unknown:
+        parser.error(f"Unknown message stores: {', '.join(unknown)}")
+
+    config = {
+        'sizes': parse_int_list(args.sizes),
+        'threads': parse_int_list(args.threads),
+        'operations': operations,
+        'ops': args.ops,
+        'max_seconds': args.max_seconds,
+        'task_cache_size': args.task_cache_size,
+        'message_stores': message_stores,
+        'log_fsync': args.log_fsync,
+        'tmpdir': args.tmpdir
+    }
+    result = run_benchmark(config)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        log(f"Results written to {args.output}")
+    else:
+        print(json.dumps(result, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_results(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,577 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from client import DistributedClient
+from task_client import DistributedTaskClient
+from task_worker import DistributedTaskWorker
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def percentile(sorted_values, p):
+    """Return the p-th percentile (0-100) of an already sorted list"""
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * (p / 100.0)
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def summarize_latencies(samples):
+    """Summarize latency samples (in seconds) as milliseconds"""
+    values = sorted(samples)
+    if not values:
+        return {'count': 0, 'mean': None, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) * 1000,
+        'p50': percentile(values, 50) * 1000,
+        'p95': percentile(values, 95) * 1000,
+        'p99': percentile(values, 99) * 1000,
+        'max': values[-1] * 1000
+    }
+
+
+def git_revision():
+    """Return the current git commit hash, if available"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def process_usage(pid=None):
+    """Return CPU seconds and resident memory for a process (default: this one)"""
+    if psutil is not None:
+        proc = psutil.Process(pid)
+        cpu = proc.cpu_times()
+        return {'cpu_seconds': cpu.user + cpu.system, 'rss_bytes': proc.memory_info().rss}
+
+    proc_dir = f"/proc/{pid or 'self'}"
+    if os.path.exists(proc_dir):
+        with open(f"{proc_dir}/stat") as f:
+            # Skip past the command name, which may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / ticks
+
+        rss_bytes = None
+        with open(f"{proc_dir}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss_bytes = int(line.split()[1]) * 1024
+                    break
+        return {'cpu_seconds': cpu_seconds, 'rss_bytes': rss_bytes}
+
+    if pid is None and resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # ru_maxrss is the peak, reported in KiB on Linux and bytes on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return {'cpu_seconds': usage.ru_utime + usage.ru_stime, 'rss_bytes': usage.ru_maxrss * scale}
+
+    return {'cpu_seconds': None, 'rss_bytes': None}
+
+
+def child_pids(pid):
+    """Direct and indirect child processes of a process (Linux /proc)"""
+    children = []
+    task_dir = f"/proc/{pid}/task"
+    if not os.path.isdir(task_dir):
+        return children
+    for tid in os.listdir(task_dir):
+        try:
+            with open(f"{task_dir}/{tid}/children") as f:
+                for child in f.read().split():
+                    children.append(int(child))
+                    children.extend(child_pids(int(child)))
+        except OSError:
+            pass
+    return children
+
+
+def process_tree_usage(pid):
+    """CPU seconds and resident memory summed over a process and its children"""
+    if psutil is not None:
+        pids = [pid] + [child.pid for child in psutil.Process(pid).children(recursive=True)]
+    else:
+        pids = [pid] + child_pids(pid)
+
+    total = {'cpu_seconds': 0.0, 'rss_bytes': 0}
+    for member in pids:
+        try:
+            usage = process_usage(member)
+        except (OSError, IndexError):
+            continue  # The process exited meanwhile
+        if usage['cpu_seconds'] is None:
+            return usage
+        total['cpu_seconds'] += usage['cpu_seconds']
+        total['rss_bytes'] += usage['rss_bytes'] or 0
+    return total
+
+
+def find_free_port(host):
+    """Ask the OS for a free TCP port"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(host, port, timeout=10):
+    """Wait until a server accepts connections on the given port"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def wait_until(condition, timeout=10, interval=0.05):
+    """Poll a condition until it becomes true or the timeout expires"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return False
+
+
+class Recorder:
+    """Thread-safe collection of benchmark counters and latency samples"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {'broadcast': 0, 'direct': 0, 'task': 0}
+        self.delivered = {'broadcast': 0, 'direct': 0, 'task': 0}
+        self.latencies = {'broadcast': [], 'direct': [], 'task': []}
+        self.recording = False
+        self.sending = False
+
+    def record_sent(self, kind):
+        with self.lock:
+            if self.recording and self.sending:
+                self.sent[kind] += 1
+
+    def record_delivery(self, kind, latency=None):
+        with self.lock:
+            if self.recording:
+                self.delivered[kind] += 1
+                if latency is not None:
+                    self.latencies[kind].append(latency)
+
+
+class BenchClient(DistributedClient):
+    """Communication client that timestamps its messages and records deliveries"""
+
+    def __init__(self, name, host, port, recorder):
+        super().__init__(name, host, port)
+        self.recorder = recorder
+
+    def send_bench_message(self, kind, target=None):
+        message = {
+            'type': kind,
+            'message': f"bench {kind} from {self.name}",
+            'bench_sent_at': time.perf_counter()
+        }
+        if target:
+            message['target'] = target
+        if self.send_message(message):
+            self.recorder.record_sent(kind)
+
+    def process_message(self, message):
+        sent_at = message.get('bench_sent_at')
+        if sent_at is not None:
+            latency = time.perf_counter() - sent_at
+            message_type = message.get('type')
+            if message_type == 'broadcast':
+                # Every chat client sees every broadcast; only the sender's echo is sampled
+                self.recorder.record_delivery(
+                    'broadcast', latency if message.get('sender') == self.name else None
+                )
+            elif message_type == 'direct':
+                self.recorder.record_delivery('direct', latency)
+            return
+
+        super().process_message(message)
+
+
+class BenchTaskClient(DistributedTaskClient):
+    """Task client that records the round-trip time of each task"""
+
+    def __init__(self, name, host, port, recorder):
+        super().__init__(name, host, port)
+        self.recorder = recorder
+        self.completed = threading.Condition()
+
+    def process_message(self, message):
+        task_result = message.get('task_result')
+        if task_result and task_result.get('task_id') in self.tasks_pending:
+            task_info = self.tasks_pending[task_result['task_id']]
+            self.recorder.record_delivery('task', time.time() - task_info['submit_time'])
+
+        super().process_message(message)
+
+        if task_result:
+            with self.completed:
+                self.completed.notify_all()
+
+
+class BenchWorker(DistributedTaskWorker):
+    """Worker that skips the simulated processing delay"""
+
+    def __init__(self, name, host, port):
+        super().__init__(name, host, port)
+        self.processing_delay = (0, 0)
+
+
+class ServerHandle:
+    """A benchmark target server running in-process or as a subprocess"""
+
+    def __init__(self, mode, host, port, processes=1):
+        self.mode = mode
+        self.host = host
+        self.port = port
+        self.processes = processes
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='ds-bench-')
+        self.db_path = os.path.join(self.tmpdir.name, 'bench.db')
+        self.process = None
+        self.server = None
+
+    def start(self):
+        if self.mode == 'subprocess':
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+            self.process = subprocess.Popen(
+                [sys.executable, script, '--host', self.host, '--port', str(self.port), '--db', self.db_path,
+                 '--processes', str(self.processes)],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+        else:
+            from server import DistributedServer
+            self.server = DistributedServer(self.host, self.port, self.db_path)
+            threading.Thread(target=self.server.start, daemon=True).start()
+
+        if not wait_for_port(self.host, self.port):
+            self.stop()
+            raise RuntimeError(f"Server did not start on {self.host}:{self.port}")
+
+    def usage(self):
+        if self.process is not None:
+            return process_tree_usage(self.process.pid)
+        return process_usage()
+
+    def stop(self):
+        if self.process is not None:
+            # SIGINT lets a multi-process server stop its children
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.server is not None:
+            # Let the handler threads finish their database work before removing it
+            wait_until(lambda: not self.server.clients, timeout=5)
+            self.server.stop()
+            time.sleep(0.1)
+        self.tmpdir.cleanup()
+
+
+def parse_mix(mix_text):
+    """Parse a mix like 'broadcast=0.5,direct=0.4,task=0.1' into normalized weights"""
+    weights = {'broadcast': 0.0, 'direct': 0.0, 'task': 0.0}
+    for part in mix_text.split(','):
+        if not part.strip():
+            continue
+        kind, _, value = part.partition('=')
+        kind = kind.strip()
+        if kind not in weights:
+            raise ValueError(f"Unknown message kind in mix: {kind}")
+        weights[kind] = float(value)
+
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError("Mix weights must add up to a positive value")
+    return {kind: weight / total for kind, weight in weights.items()}
+
+
+def pace(next_send, interval):
+    """Sleep until the next scheduled send time; returns the following one"""
+    if interval <= 0:
+        return next_send
+    delay = next_send - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+    return next_send + interval
+
+
+def run_message_sender(client, peers, weights, rate, stop_event):
+    """Send broadcast and direct messages from one client until stopped"""
+    message_weight = weights['broadcast'] + weights['direct']
+    if message_weight <= 0:
+        return
+    broadcast_share = weights['broadcast'] / message_weight
+    interval = 1.0 / rate if rate > 0 else 0
+    next_send = time.perf_counter()
+
+    while not stop_event.is_set() and client.connected:
+        next_send = pace(next_send, interval)
+        if random.random() < broadcast_share or not peers:
+            client.send_bench_message('broadcast')
+        else:
+            client.send_bench_message('direct', random.choice(peers))
+
+
+def run_task_submitter(task_client, workers, rate, stop_event, task_timeout):
+    """Submit tasks to a dedicated set of workers, one outstanding task per worker"""
+    interval = 1.0 / rate if rate > 0 else 0
+    next_send = time.perf_counter()
+    outstanding = {}  # worker -> (task_id, submit_time)
+
+    while not stop_event.is_set() and task_client.connected:
+        now = time.time()
+        for worker in workers:
+            task_id, submitted = outstanding.get(worker, (None, 0))
+            if task_id and task_id in task_client.tasks_pending and now - submitted < task_timeout:
+                continue
+
+            if task_id and task_id in task_client.tasks_pending:
+                # Give up on a lost task so the worker can be used again
+                task_client.tasks_pending.pop(task_id, None)
+
+            next_send = pace(next_send, interval)
+            if stop_event.is_set():
+                return
+            numbers = [random.randint(1, 100) for _ in range(10)]
+            new_task_id = task_client.submit_task(worker, 'calculate', {'operation': 'sum', 'numbers': numbers})
+            if new_task_id:
+                task_client.recorder.record_sent('task')
+                outstanding[worker] = (new_task_id, time.time())
+
+        with task_client.completed:
+            task_client.completed.wait(timeout=0.05)
+
+
+def run_benchmark(config):
+    """Run one benchmark and return the machine-readable result document"""
+    weights = parse_mix(config['mix'])
+    host = config['host']
+    port = config['port'] or find_free_port(host)
+    recorder = Recorder()
+    server = ServerHandle(config['server_mode'], host, port, config['server_processes'])
+    clients, task_clients, workers = [], [], []
+    stop_event = threading.Event()
+    log = sys.stdout if config['verbose'] else open(os.devnull, 'w')
+
+    # Client (and in-process server) chatter would corrupt JSON written to stdout
+    with contextlib.redirect_stdout(log):
+        server.start()
+        try:
+            for i in range(config['workers']):
+                worker = BenchWorker(f"bench{i}", host, port)
+                if worker.connect():
+                    workers.append(worker)
+            for i in range(config['clients']):
+                client = BenchClient(f"BenchClient-{i}", host, port, recorder)
+                if client.connect():
+                    clients.append(client)
+            for i in range(config['task_clients']):
+                task_client = BenchTaskClient(f"bench{i}", host, port, recorder)
+                if task_client.connect():
+                    task_clients.append(task_client)
+
+            worker_names = [f"Worker-{w.name}" for w in workers]
+            for task_client in task_clients:
+                task_client.request_client_list()
+                wait_until(lambda: all(w in task_client.client_list for w in worker_names))
+
+            # Split the workers between task clients so no worker gets two tasks at once
+            assignments = {tc: worker_names[i::len(task_clients)] for i, tc in enumerate(task_clients)}
+
+            threads = []
+            client_names = [c.name for c in clients]
+            message_rate = config['rate'] * (weights['broadcast'] + weights['direct'])
+            for client in clients:
+                peers = [name for name in client_names if name != client.name]
+                per_client_rate = message_rate / len(clients) if config['rate'] > 0 else 0
+                threads.append(threading.Thread(
+                    target=run_message_sender,
+                    args=(client, peers, weights, per_client_rate, stop_event),
+                    daemon=True
+                ))
+            if weights['task'] > 0:
+                task_rate = config['rate'] * weights['task']
+                for task_client, assigned in assignments.items():
+                    if not assigned:
+                        continue
+                    per_client_rate = task_rate / len(task_clients) if config['rate'] > 0 else 0
+                    threads.append(threading.Thread(
+                        target=run_task_submitter,
+                        args=(task_client, assigned, per_client_rate, stop_event, config['task_timeout']),
+                        daemon=True
+                    ))
+
+            usage_before = server.usage()
+            recorder.recording = recorder.sending = True
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+
+            time.sleep(config['duration'])
+            recorder.sending = False
+            stop_event.set()
+            elapsed = time.perf_counter() - started
+            for thread in threads:
+                thread.join(timeout=5)
+
+            # Let in-flight messages arrive before counting
+            time.sleep(config['drain'])
+            recorder.recording = False
+            usage_after = server.usage()
+        finally:
+            stop_event.set()
+            for participant in clients + task_clients + workers:
+                participant.disconnect()
+            # Give receive threads a moment to report the closed sockets
+            time.sleep(0.2)
+            server.stop()
+
+    if not config['verbose']:
+        log.close()
+
+    results = {}
+    for kind in ('broadcast', 'direct', 'task'):
+        sent = recorder.sent[kind]
+        # Broadcasts reach the subscribers of the default channel, i.e. the chat clients
+        expected = sent * len(clients) if kind == 'broadcast' else sent
+        results[kind] = {
+            'sent': sent,
+            'delivered': recorder.delivered[kind],
+            'expected_deliveries': expected,
+            'throughput': sent / elapsed if elapsed > 0 else 0,
+            'delivery_throughput': recorder.delivered[kind] / elapsed if elapsed > 0 else 0,
+            'latency_ms': summarize_latencies(recorder.latencies[kind])
+        }
+
+    cpu_seconds = None
+    if usage_before['cpu_seconds'] is not None and usage_after['cpu_seconds'] is not None:
+        cpu_seconds = usage_after['cpu_seconds'] - usage_before['cpu_seconds']
+    results['server'] = {
+        'scope': 'server processes' if config['server_mode'] == 'subprocess' else 'benchmark process',
+        'cpu_seconds': cpu_seconds,
+        'cpu_percent': cpu_seconds / elapsed * 100 if cpu_seconds is not None and elapsed > 0 else None,
+        'rss_bytes': usage_after['rss_bytes']
+    }
+
+    return {
+        'benchmark': 'server_load',
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'elapsed_seconds': elapsed,
+            'connected': {'clients': len(clients), 'task_clients': len(task_clients), 'workers': len(workers)}
+        },
+        'config': config,
+        'results': results
+    }
+
+
+def compare_results(baseline, current):
+    """Print the relative change of the headline numbers between two runs"""
+    print(f"Baseline {baseline['meta'].get('revision')} -> current {current['meta'].get('revision')}")
+    for kind in ('broadcast', 'direct', 'task'):
+        base = baseline['results'].get(kind, {})
+        cur = current['results'].get(kind, {})
+        for label, old, new in (
+            ('throughput', base.get('throughput'), cur.get('throughput')),
+            ('p50 ms', (base.get('latency_ms') or {}).get('p50'), (cur.get('latency_ms') or {}).get('p50')),
+            ('p99 ms', (base.get('latency_ms') or {}).get('p99'), (cur.get('latency_ms') or {}).get('p99'))
+        ):
+            if not old or new is None:
+                continue
+            print(f"  {kind:<9} {label:<10} {old:12.2f} -> {new:12.2f} ({(new - old) / old * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-generation benchmark for the messaging server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=0, help="Server port (default: a free port)")
+    parser.add_argument('--server-mode', choices=['subprocess', 'inprocess'], default='subprocess')
+    parser.add_argument('--server-processes', type=int, default=1,
+                        help="Run the subprocess server with this many processes")
+    parser.add_argument('--clients', type=int, default=10, help="Communication clients")
+    parser.add_argument('--task-clients', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--mix', default='broadcast=0.5,direct=0.4,task=0.1',
+                        help="Relative weights of broadcast, direct and task traffic")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Target operations per second across all senders (0 = unthrottled)")
+    parser.add_argument('--duration', type=float, default=10, help="Measurement window in seconds")
+    parser.add_argument('--drain', type=float, default=2, help="Seconds to wait for in-flight messages")
+    parser.add_argument('--task-timeout', type=float, default=10, help="Seconds before a task counts as lost")
+    parser.add_argument('--output', help="Write the JSON result to this file instead of stdout")
+    parser.add_argument('--baseline', help="Compare against a previous JSON result")
+    parser.add_argument('--verbose', action='store_true', help="Keep client output instead of discarding it")
+    args = parser.parse_args()
+    if args.server_processes > 1 and args.server_mode != 'subprocess':
+        parser.error("--server-processes requires --server-mode subprocess")
+
+    config = {
+        'host': args.host,
+        'port': args.port,
+        'server_mode': args.server_mode,
+        'server_processes': args.server_processes,
+        'clients': args.clients,
+        'task_clients': args.task_clients,
+        'workers': args.workers,
+        'mix': args.mix,
+        'rate': args.rate,
+        'duration': args.duration,
+        'drain': args.drain,
+        'task_timeout': args.task_timeout,
+        'verbose': args.verbose
+    }
+    result = run_benchmark(config)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
+    else:
+        print(json.dumps(result, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_results(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
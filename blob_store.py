@@ -0,0 +1,102 @@
+import hashlib
+import json
+import sqlite3
+
+BLOB_THRESHOLD = 64 * 1024  # Serialized payloads at least this large are stored out of line
+REF_PREFIX = '@blob:'  # Never the start of valid JSON, so a reference can't be mistaken for a payload
+
+
+class BlobRef:
+    """Reference to a task payload held in the blobs table.
+
+    Nothing is read until view() or load() is called, so tasks can be listed
+    without pulling their large parameters or results into memory.
+    """
+
+    def __init__(self, db_path, digest):
+        self.db_path = db_path
+        self.digest = digest
+
+    def view(self):
+        """The serialized JSON as a read-only memoryview over the bytes SQLite returned"""
+        return memoryview(read_blob(self.db_path, self.digest))
+
+    def load(self):
+        """The payload decoded from JSON"""
+        return json.loads(read_blob(self.db_path, self.digest))
+
+    def __eq__(self, other):
+        return isinstance(other, BlobRef) and other.digest == self.digest
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __repr__(self):
+        return f"BlobRef({self.digest[:12]})"
+
+
+def store_payload(cursor, payload_json, threshold=BLOB_THRESHOLD):
+    """Value to put in a tasks column for a serialized payload.
+
+    Small payloads are returned unchanged; large ones are written to the blobs
+    table under their SHA-256 (once, however many tasks share them) and
+    replaced by a reference.
+    """
+    if payload_json is None or threshold is None or len(payload_json) < threshold:
+        return payload_json
+    data = payload_json.encode('utf-8')
+    if len(data) < threshold:
+        return payload_json
+    digest = hashlib.sha256(data).hexdigest()
+    cursor.execute("INSERT OR IGNORE INTO blobs (hash, size, data) VALUES (?, ?, ?)", (digest, len(data), data))
+    return REF_PREFIX + digest
+
+
+def decode_payload(db_path, value):
+    """Decode a tasks column: JSON text, or a BlobRef if it holds a reference"""
+    if not value:
+        return value
+    if value.startswith(REF_PREFIX):
+        return BlobRef(db_path, value[len(REF_PREFIX):])
+    return json.loads(value)
+
+
+def read_blob(db_path, digest):
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute("SELECT data FROM blobs WHERE hash = ?", (digest,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        raise KeyError(f"Missing blob {digest}")
+    return row[0]
+
+
+def inline_sql(column):
+    """SQL expression giving a tasks column with any blob reference replaced by its JSON text"""
+    return (f"CASE WHEN {column} GLOB '{REF_PREFIX}*' "
+            f"THEN (SELECT CAST(data AS TEXT) FROM blobs WHERE hash = substr({column}, {len(REF_PREFIX) + 1})) "
+            f"ELSE {column} END")
+
+
+def delete_unused_blobs(conn):
+    """Delete the blobs no task or workflow refers to and commit; returns how many were removed.
+
+    Blobs become unused when a payload is replaced (a new result, an import
+    with on_conflict='replace') or its row was never stored (an ignored
+    import row).
+    """
+    cursor = conn.execute(
+        """
+        DELETE FROM blobs WHERE hash NOT IN (
+            SELECT substr(parameters, ?) FROM tasks WHERE parameters GLOB ?
+            UNION ALL
+            SELECT substr(result, ?) FROM tasks WHERE result GLOB ?
+            UNION ALL
+            SELECT substr(result, ?) FROM workflows WHERE result GLOB ?
+        )
+        """,
+        (len(REF_PREFIX) + 1, REF_PREFIX + '*') * 3
+    )
+    conn.commit()
+    return cursor.rowcount
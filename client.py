@@ -3,15 +3,22 @@ import threading
 import json
 import time
 import sys
+import random
 
 class DistributedClient:
-    def __init__(self, name, host='localhost', port=5000):
+    def __init__(self, name, host='localhost', port=5000, history=0):
         self.name = name
         self.host = host
         self.port = port
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connected = False
         self.client_list = []
+        self.history = history  # Messages per channel to replay when connecting
+        self.presence_epoch = None  # Server presence epoch and version of client_list
+        self.presence_version = None
+        self.presence_resync = False
+        self.last_search = None  # (query, cursor of its next page) of the latest search
+        self.rejection = None  # The last 'rejected' frame from the server
         
     def connect(self):
         """Connect to the server"""
@@ -21,10 +28,13 @@ class DistributedClient:
             print(f"Connected to server at {self.host}:{self.port}")
             
             # Register with the server
-            self.send_message({
+            register = {
                 'type': 'register',
                 'name': self.name
-            })
+            }
+            if self.history:
+                register['history'] = self.history
+            self.send_message(register)
             
             # Start a thread to receive messages
             receive_thread = threading.Thread(target=self.receive_messages)
@@ -36,10 +46,37 @@ class DistributedClient:
             print(f"Error connecting to server: {e}")
             return False
     
+    def connect_with_backoff(self, attempts=5, settle=0.3):
+        """Connect, backing off and retrying while the server turns us away"""
+        for attempt in range(attempts):
+            self.rejection = None
+            if self.connect():
+                # A full server rejects at once, a used-up quota right after registering
+                settle_until = time.time() + settle
+                while self.connected and self.rejection is None and time.time() < settle_until:
+                    time.sleep(0.05)
+                if self.connected and self.rejection is None:
+                    return True
+            if attempt + 1 == attempts:
+                break
+            # Exponential backoff from the server's hint, with jitter so rejected clients spread out
+            retry_after = (self.rejection or {}).get('retry_after', 1.0)
+            delay = retry_after * 2 ** attempt * random.uniform(0.5, 1.5)
+            print(f"Retrying in {delay:.1f}s...")
+            time.sleep(delay)
+            self.client_socket.close()
+            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        return False
+    
     def disconnect(self):
         """Disconnect from the server"""
         if self.connected:
             self.connected = False
+            try:
+                # Wake up the receive thread, which holds a file object on the socket
+                self.client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.client_socket.close()
             print("Disconnected from server")
     
@@ -50,7 +87,7 @@ class DistributedClient:
             return False
         
         try:
-            message_json = json.dumps(message)
+            message_json = json.dumps(message) + '\n'
             self.client_socket.sendall(message_json.encode('utf-8'))
             return True
         except Exception as e:
@@ -65,6 +102,28 @@ class DistributedClient:
             'message': message_text
         })
     
+    def subscribe(self, channel):
+        """Start receiving the messages published on a channel"""
+        return self.send_message({
+            'type': 'subscribe',
+            'channel': channel
+        })
+    
+    def unsubscribe(self, channel):
+        """Stop receiving the messages published on a channel"""
+        return self.send_message({
+            'type': 'unsubscribe',
+            'channel': channel
+        })
+    
+    def publish(self, channel, message_text):
+        """Publish a message to the subscribers of a channel"""
+        return self.send_message({
+            'type': 'publish',
+            'channel': channel,
+            'message': message_text
+        })
+    
     def send_direct_message(self, target, message_text):
         """Send a direct message to a specific client"""
         if target not in self.client_list:
@@ -83,11 +142,86 @@ class DistributedClient:
             'type': 'status'
         })
     
+    def request_presence_changes(self):
+        """Ask for the presence changes since the version of our client list"""
+        self.presence_resync = True
+        return self.send_message({
+            'type': 'presence_sync',
+            'epoch': self.presence_epoch,
+            'since': self.presence_version
+        })
+    
+    def apply_presence_delta(self, message):
+        """Apply a presence delta to client_list; returns True if the list changed"""
+        if self.presence_version is None or message.get('epoch') != self.presence_epoch:
+            # No snapshot yet, or the server restarted
+            if not self.presence_resync:
+                self.request_presence_changes()
+            return False
+        
+        if message.get('version', 0) <= self.presence_version:
+            return False  # Already applied
+        
+        if message.get('since') != self.presence_version:
+            # A delta went missing; catch up from the server's log
+            if not self.presence_resync:
+                self.request_presence_changes()
+            return False
+        
+        removed = set(message.get('removed', []))
+        client_list = [name for name in self.client_list if name not in removed]
+        known = set(client_list)
+        client_list += [name for name in message.get('added', []) if name not in known]
+        self.client_list = client_list
+        self.presence_version = message['version']
+        self.presence_resync = False
+        return True
+    
+    def request_history(self, channel=None, limit=50, before_id=None, direct=False):
+        """Request a page of older messages for a channel, or for our own inbox with direct=True"""
+        message = {
+            'type': 'history',
+            'limit': limit
+        }
+        if direct:
+            message['direct'] = True
+        elif channel:
+            message['channel'] = channel
+        if before_id is not None:
+            message['before_id'] = before_id
+        return self.send_message(message)
+    
+    def search_messages(self, query, sender=None, target=None, since=None, until=None, cursor=None, limit=20):
+        """Search the message history; hits arrive best first in a search_result.
+        
+        Pass the next_cursor of a result back as cursor for the following page.
+        """
+        message = {
+            'type': 'search',
+            'query': query,
+            'limit': limit
+        }
+        for key, value in (('sender', sender), ('target', target), ('since', since), ('until', until),
+                           ('cursor', cursor)):
+            if value is not None:
+                message[key] = value
+        return self.send_message(message)
+    
+    def request_profile(self, action, token):
+        """Ask the server to start or stop its profiler (requires the admin token)"""
+        return self.send_message({
+            'type': 'profile',
+            'action': action,
+            'token': token
+        })
+    
     def receive_messages(self):
         """Receive and process messages from the server"""
+        # Messages are newline-delimited JSON documents
+        reader = self.client_socket.makefile('r', encoding='utf-8')
         while self.connected:
             try:
-                data = self.client_socket.recv(1024).decode('utf-8')
+                data = reader.readline()
                 if not data:
                     print("Connection to server lost")
                     self.connected = False
@@ -112,6 +246,14 @@ class DistributedClient:
             msg_text = message.get('message', '')
             print(f"[Broadcast] {sender}: {msg_text}")
         
+        elif message_type == 'publish':
+            sender = message.get('sender', 'Unknown')
+            msg_text = message.get('message', '')
+            print(f"[#{message.get('channel')}] {sender}: {msg_text}")
+        
+        elif message_type == 'subscriptions':
+            print(f"Subscribed channels: {', '.join(message.get('channels', [])) or '(none)'}")
+        
         elif message_type == 'direct':
             sender = message.get('sender', 'Unknown')
             msg_text = message.get('message', '')
@@ -121,22 +263,69 @@ class DistributedClient:
             msg_text = message.get('message', '')
             print(f"[System] {msg_text}")
         
+        elif message_type == 'rejected':
+            # Sent instead of accepting the session; connect_with_backoff retries later
+            self.rejection = message
+            print(f"Server rejected the connection ({message.get('reason')}), retry after {message.get('retry_after')}s")
+            self.connected = False
+        
         elif message_type == 'client_list':
             self.client_list = message.get('clients', [])
+            self.presence_epoch = message.get('epoch')
+            self.presence_version = message.get('version')
+            self.presence_resync = False
             print("Connected clients:")
             for client in self.client_list:
                 print(f"- {client}")
+        
+        elif message_type == 'presence_delta':
+            self.apply_presence_delta(message)
+        
+        elif message_type == 'history':
+            label = 'direct messages' if message.get('direct') else f"#{message.get('channel')}"
+            print(f"History of {label}:")
+            for entry in message.get('messages', []):
+                timestamp = time.strftime('%H:%M:%S', time.localtime(entry.get('timestamp') or 0))
+                print(f"  {timestamp} {entry.get('sender')}: {entry.get('message')}")
+            if message.get('next_before_id'):
+                print(f"  (older messages: before id {message['next_before_id']})")
+        
+        elif message_type == 'search_result':
+            if message.get('error'):
+                print(f"Search failed: {message['error']}")
+                return
+            hits = message.get('hits', [])
+            print(f"{len(hits)} results for '{message.get('query')}' ({message.get('took', 0) * 1000:.1f} ms):")
+            for hit in hits:
+                timestamp = time.strftime('%Y-%m-%d %H:%M', time.localtime(hit.get('timestamp') or 0))
+                print(f"  {timestamp} {hit.get('sender')}: {hit.get('snippet') or hit.get('content')}")
+            self.last_search = (message.get('query'), message.get('next_cursor'))
+            if message.get('next_cursor'):
+                print("  (more results: /search)")
+        
+        elif message_type == 'profile':
+            status = message.get('status')
+            if message.get('path'):
+                print(f"[Profiler] {status}: {message['path']}")
+            else:
+                print(f"[Profiler] {status}")
     
     def run_interactive(self):
         """Run an interactive client session"""
-        if not self.connect():
+        if not self.connect_with_backoff():
             return
         
         print("\nCommands:")
         print("  /list - Show connected clients")
         print("  /msg <client> <message> - Send a direct message to a client")
+        print("  /join <channel> - Subscribe to a channel")
+        print("  /leave <channel> - Unsubscribe from a channel")
+        print("  /pub <channel> <message> - Publish a message to a channel")
+        print("  /history [channel] - Show recent messages of a channel ('direct' for your inbox)")
+        print("  /search <words> - Search the message history (/search alone shows more results)")
+        print("  /profile <start|stop> <token> - Control the server profiler (admin)")
         print("  /quit - Disconnect and exit")
-        print("  Any other text will be broadcast to all clients\n")
+        print("  Any other text will be broadcast to the 'general' channel\n")
         
         try:
             while self.connected:
@@ -157,6 +346,43 @@ class DistributedClient:
                     else:
                         print("Usage: /msg <client> <message>")
                 
+                elif user_input.lower().startswith('/join '):
+                    self.subscribe(user_input[6:].strip())
+                
+                elif user_input.lower().startswith('/leave '):
+                    self.unsubscribe(user_input[7:].strip())
+                
+                elif user_input.lower().startswith('/pub '):
+                    parts = user_input[5:].strip().split(' ', 1)
+                    if len(parts) == 2:
+                        channel, message = parts
+                        self.publish(channel, message)
+                    else:
+                        print("Usage: /pub <channel> <message>")
+                
+                elif user_input.lower() == '/history' or user_input.lower().startswith('/history '):
+                    channel = user_input[9:].strip()
+                    if channel == 'direct':
+                        self.request_history(direct=True)
+                    else:
+                        self.request_history(channel or None)
+                
+                elif user_input.lower() == '/search' or user_input.lower().startswith('/search '):
+                    query = user_input[8:].strip()
+                    if query:
+                        self.search_messages(query)
+                    elif self.last_search and self.last_search[1]:
+                        self.search_messages(self.last_search[0], cursor=self.last_search[1])
+                    else:
+                        print("Usage: /search <words>")
+                
+                elif user_input.lower().startswith('/profile '):
+                    parts = user_input[9:].strip().split(' ', 1)
+                    if len(parts) == 2 and parts[0] in ('start', 'stop'):
+                        self.request_profile(parts[0], parts[1])
+                    else:
+                        print("Usage: /profile <start|stop> <token>")
+                
                 elif user_input:
                     # Broadcast the message
                     self.broadcast_message(user_input)
@@ -0,0 +1,292 @@
+import argparse
+import csv
+import gzip
+import itertools
+import json
+import sqlite3
+import sys
+import time
+
+from blob_store import BLOB_THRESHOLD, delete_unused_blobs, inline_sql, store_payload
+from message_log import MessageLog
+
+TABLES = ('tasks', 'messages')
+BATCH_SIZE = 10000  # Rows per fetchmany() on export and per executemany() transaction on import
+MESSAGE_LOG_COLUMNS = ['id', 'message_type', 'sender', 'target', 'content', 'timestamp']
+PAYLOAD_COLUMNS = ('parameters', 'result')  # Task columns that may hold a blob reference
+
+
+def table_columns(conn, table):
+    """Column names of a table and a {column: (declared type, nullable)} map"""
+    if table not in TABLES:
+        raise ValueError(f"Unknown table: {table}")
+    info = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    columns = [row[1] for row in info]
+    details = {row[1]: (row[2].upper(), not row[3] and not row[5]) for row in info}
+    return columns, details
+
+
+def read_table(db_path, table, batch_size=BATCH_SIZE, message_log_dir=None):
+    """Return (columns, rows) where rows lazily yields one tuple per row in id order.
+
+    Rows are fetched batch_size at a time, so memory stays flat however big
+    the table is. Task payloads kept in the blobs table are written inline,
+    so an export does not depend on the database it came from. Messages are
+    read from the segmented log instead when message_log_dir is given.
+    """
+    if table == 'messages' and message_log_dir:
+        message_log = MessageLog(message_log_dir)
+
+        def log_rows():
+            try:
+                for message in message_log.iter_messages():
+                    yield tuple(message[key] for key in ('id', 'type', 'sender', 'target', 'content', 'timestamp'))
+            finally:
+                message_log.close()
+
+        return list(MESSAGE_LOG_COLUMNS), log_rows()
+
+    conn = sqlite3.connect(db_path)
+    columns, _ = table_columns(conn, table)
+
+    def rows():
+        try:
+            selected = [inline_sql(column) if column in PAYLOAD_COLUMNS else column for column in columns]
+            cursor = conn.execute(f"SELECT {', '.join(selected)} FROM {table} ORDER BY id")
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield from batch
+        finally:
+            conn.close()
+
+    return columns, rows()
+
+
+def write_jsonl(columns, rows, out):
+    """Write one JSON object per line; JSON-valued columns are kept as their stored text"""
+    count = 0
+    for row in rows:
+        out.write(json.dumps(dict(zip(columns, row))) + '\n')
+        count += 1
+    return count
+
+
+def write_csv(columns, rows, out):
+    """Write a header line and one CSV record per row; NULL becomes an empty field"""
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    count = 0
+    for batch in iter_batches(rows, BATCH_SIZE):
+        writer.writerows(batch)
+        count += len(batch)
+    return count
+
+
+def read_jsonl(source):
+    """Return (columns, rows) for a JSON-lines file; columns come from the first object"""
+    lines = (line for line in source if line.strip())
+    first = next(lines, None)
+    if first is None:
+        return [], iter(())
+    first = json.loads(first)
+    columns = list(first)
+
+    def rows():
+        yield tuple(first.get(column) for column in columns)
+        for line in lines:
+            record = json.loads(line)
+            yield tuple(record.get(column) for column in columns)
+
+    return columns, rows()
+
+
+def read_csv(source):
+    """Return (columns, rows) for a CSV file with a header line"""
+    reader = csv.reader(source)
+    columns = next(reader, [])
+    return columns, (tuple(row) for row in reader)
+
+
+def iter_batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def text_converter(declared_type, nullable):
+    """Turn a CSV field back into the value that was exported.
+
+    Numbers are parsed here rather than by SQLite, whose text-to-REAL
+    conversion can be off in the last digit.
+    """
+    parse = {'INTEGER': int, 'REAL': float}.get(declared_type)
+
+    def convert(value):
+        if value == '':
+            return None if nullable else value
+        return parse(value) if parse else value
+
+    return convert
+
+
+def load_rows(db_path, table, columns, rows, batch_size=BATCH_SIZE, keep_ids=False, on_conflict='ignore',
+              from_text=False, message_log_dir=None, blob_threshold=BLOB_THRESHOLD):
+    """Insert rows in batches, one transaction per batch; returns the number of rows read.
+
+    Without keep_ids the stored ids are dropped and new ones assigned, so an
+    export can be loaded into a database that already has data. on_conflict
+    ('ignore', 'replace' or 'abort') decides what happens to rows that clash
+    with a unique key such as tasks.task_id. from_text marks rows read from
+    CSV, whose fields are all strings: numbers are parsed and empty fields
+    become NULL again in the columns that allow it. Task payloads of at
+    least blob_threshold bytes go to the blobs table, as with store_task.
+
+    Run it with the server stopped: the server's task cache and message log
+    do not see rows written by another process, and would serve stale tasks.
+    """
+    if table == 'messages' and message_log_dir:
+        return _load_message_log(message_log_dir, columns, rows, batch_size, from_text)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        table_cols, details = table_columns(conn, table)
+        unknown = [column for column in columns if column not in table_cols]
+        if unknown:
+            raise ValueError(f"Columns not in {table}: {', '.join(unknown)}")
+
+        positions = [i for i, column in enumerate(columns) if keep_ids or column != 'id']
+        insert_columns = [columns[i] for i in positions]
+        converters = [text_converter(*details[column]) for column in insert_columns] if from_text else None
+        verb = {'ignore': 'INSERT OR IGNORE', 'replace': 'INSERT OR REPLACE', 'abort': 'INSERT'}[on_conflict]
+        sql = (f"{verb} INTO {table} ({', '.join(insert_columns)}) "
+               f"VALUES ({', '.join('?' for _ in insert_columns)})")
+
+        if converters:
+            prepared = ([convert(row[i]) for convert, i in zip(converters, positions)] for row in rows)
+        else:
+            prepared = ([row[i] for i in positions] for row in rows)
+
+        payload_positions = [j for j, column in enumerate(insert_columns) if column in PAYLOAD_COLUMNS]
+
+        count = 0
+        for batch in iter_batches(prepared, batch_size):
+            with conn:
+                for values in batch:
+                    for j in payload_positions:
+                        values[j] = store_payload(conn, values[j], blob_threshold)
+                conn.executemany(sql, batch)
+            count += len(batch)
+        if payload_positions:
+            # Replaced rows leave their old payloads behind, and ignored rows never used theirs
+            delete_unused_blobs(conn)
+        return count
+    finally:
+        conn.close()
+
+
+def _load_message_log(message_log_dir, columns, rows, batch_size, from_text):
+    """Append messages to the segmented log; the log assigns new ids"""
+    type_at, sender_at, target_at, content_at, timestamp_at = [
+        columns.index(column) for column in ('message_type', 'sender', 'target', 'content', 'timestamp')
+    ]
+    message_log = MessageLog(message_log_dir)
+    count = 0
+    try:
+        for batch in iter_batches(rows, batch_size):
+            message_log.append_many([
+                (row[type_at], row[sender_at], None if from_text and row[target_at] == '' else row[target_at],
+                 row[content_at], float(row[timestamp_at]))
+                for row in batch
+            ])
+            count += len(batch)
+    finally:
+        message_log.close()
+    return count
+
+
+def open_file(path, mode):
+    """Open a text file, '-' for stdin/stdout, gzip-compressed if the name ends in .gz"""
+    if path == '-':
+        return sys.stdout if 'w' in mode else sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def detect_format(path, fmt):
+    if fmt:
+        return fmt
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'csv' if name.endswith('.csv') else 'jsonl'
+
+
+def export_table(db_path, table, path, fmt=None, batch_size=BATCH_SIZE, message_log_dir=None):
+    """Stream a table to a JSONL or CSV file; returns the number of rows written"""
+    fmt = detect_format(path, fmt)
+    columns, rows = read_table(db_path, table, batch_size, message_log_dir)
+    out = open_file(path, 'w')
+    try:
+        if fmt == 'csv':
+            return write_csv(columns, rows, out)
+        return write_jsonl(columns, rows, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def import_table(db_path, table, path, fmt=None, batch_size=BATCH_SIZE, keep_ids=False, on_conflict='ignore',
+                 message_log_dir=None):
+    """Bulk-load a JSONL or CSV file into a table; returns the number of rows read"""
+    fmt = detect_format(path, fmt)
+    source = open_file(path, 'r')
+    try:
+        columns, rows = read_csv(source) if fmt == 'csv' else read_jsonl(source)
+        return load_rows(db_path, table, columns, rows, batch_size, keep_ids, on_conflict,
+                         from_text=(fmt == 'csv'), message_log_dir=message_log_dir)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream tasks and messages to and from JSONL or CSV")
+    parser.add_argument('--db', default='distributed_system.db', help="SQLite database path")
+    parser.add_argument('--message-log-dir', help="Read/write messages in this segmented log instead of the table")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export = subparsers.add_parser('export', help="Write a table to a file")
+    export.add_argument('table', choices=TABLES)
+    export.add_argument('output', help="Output file (.jsonl, .csv, optionally .gz; '-' for stdout)")
+    export.add_argument('--format', choices=['jsonl', 'csv'], help="Default: from the file name")
+
+    load = subparsers.add_parser('import', help="Load a file into a table (stop the server first)")
+    load.add_argument('table', choices=TABLES)
+    load.add_argument('input', help="Input file (.jsonl, .csv, optionally .gz; '-' for stdin)")
+    load.add_argument('--format', choices=['jsonl', 'csv'], help="Default: from the file name")
+    load.add_argument('--keep-ids', action='store_true', help="Keep the exported ids instead of assigning new ones")
+    load.add_argument('--on-conflict', choices=['ignore', 'replace', 'abort'], default='ignore',
+                      help="What to do with rows that clash with a unique key")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.command == 'export':
+        count = export_table(args.db, args.table, args.output, args.format, args.batch_size, args.message_log_dir)
+        action = "Exported"
+    else:
+        count = import_table(args.db, args.table, args.input, args.format, args.batch_size,
+                             args.keep_ids, args.on_conflict, args.message_log_dir)
+        action = "Imported"
+    elapsed = time.perf_counter() - started
+    # Progress goes to stderr so an export to stdout stays clean
+    print(f"{action} {count} {args.table} rows in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f} rows/s)",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
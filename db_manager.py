@@ -3,12 +3,50 @@ import json
 import time
 import os
 import threading
+from task_cache import TaskCache
+from message_log import MessageLog
+from blob_store import BlobRef, BLOB_THRESHOLD, store_payload, decode_payload, delete_unused_blobs
+
+TASK_CACHE_SIZE = 10000  # Task records kept in memory by default
+# Columns added to tasks after its first release, with their definitions
+TASK_COLUMNS_ADDED = [
+    ('priority', "TEXT NOT NULL DEFAULT 'normal'"),
+    ('deadline', "REAL"),
+    ('deadline_missed', "INTEGER")
+]
+SEARCH_SNIPPET_TOKENS = 12  # Words around the matches in a search hit's snippet
+
+def search_words(query):
+    """Words of a search query; a trailing * asks for a prefix match"""
+    return [word for word in (part.strip('"') for part in query.split()) if word.strip('*')]
 
 class DatabaseManager:
-    def __init__(self, db_path='distributed_system.db'):
-        """Initialize the database manager with the specified database path"""
+    def __init__(self, db_path='distributed_system.db', task_cache_size=TASK_CACHE_SIZE,
+                 message_store='sqlite', message_log_dir=None, blob_threshold=BLOB_THRESHOLD,
+                 message_log_fsync=False):
+        """Initialize the database manager with the specified database path.
+        
+        task_cache_size bounds the write-through task cache; use 0 when other
+        processes write to the same database, since the cache would not see
+        their changes. message_store='log' keeps messages in an append-only
+        segmented log (message_log_dir, next to the database by default)
+        instead of the messages table; clients and tasks stay in SQLite.
+        The log only survives power loss with message_log_fsync, which
+        syncs every append the way SQLite syncs every commit.
+        Task parameters and results whose JSON is at least blob_threshold
+        bytes are kept in the blobs table, with a reference in the task row.
+        """
         self.db_path = db_path
         self.lock = threading.Lock()
+        self.task_cache = TaskCache(task_cache_size) if task_cache_size > 0 else None
+        self.blob_threshold = blob_threshold
+        self.full_text = False  # Whether messages_fts exists; searches fall back to LIKE otherwise
+        self.message_log = None
+        if message_store == 'log':
+            self.message_log = MessageLog(message_log_dir or os.path.splitext(db_path)[0] + '-messages',
+                                          fsync=message_log_fsync)
+        elif message_store != 'sqlite':
+            raise ValueError(f"Unknown message store: {message_store}")
         self._create_tables()
     
     def _create_tables(self):
@@ -17,6 +55,10 @@ class DatabaseManager:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
             
+            # Lets the archiver hand pages of deleted messages back in small steps.
+            # Only takes effect when the database file is new
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            
             # Create clients table
             cursor.execute('''
             CREATE TABLE IF NOT EXISTS clients (
@@ -52,9 +94,116 @@ class DatabaseManager:
                 status TEXT NOT NULL,
                 submit_time REAL NOT NULL,
                 complete_time REAL,
+                result TEXT,
+                priority TEXT NOT NULL DEFAULT 'normal',
+                deadline REAL,
+                deadline_missed INTEGER
+            )
+            ''')
+            
+            # Databases created by older versions lack the newer columns
+            cursor.execute("PRAGMA table_info(tasks)")
+            existing = [row[1] for row in cursor.fetchall()]
+            for column, definition in TASK_COLUMNS_ADDED:
+                if column not in existing:
+                    cursor.execute(f"ALTER TABLE tasks ADD COLUMN {column} {definition}")
+            
+            # Large task payloads, stored once per distinct content (SHA-256 of the JSON)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                data BLOB NOT NULL
+            )
+            ''')
+            
+            # Workflows (DAGs of tasks run by the server) and the state of each of their nodes
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS workflows (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                workflow_id TEXT UNIQUE NOT NULL,
+                requester TEXT NOT NULL,
+                definition TEXT NOT NULL,
+                output_node TEXT NOT NULL,
+                status TEXT NOT NULL,
+                submit_time REAL NOT NULL,
+                complete_time REAL,
                 result TEXT
             )
             ''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS workflow_nodes (
+                workflow_id TEXT NOT NULL,
+                node_id TEXT NOT NULL,
+                task_type TEXT NOT NULL,
+                status TEXT NOT NULL,
+                task_id TEXT,
+                worker TEXT,
+                start_time REAL,
+                complete_time REAL,
+                PRIMARY KEY (workflow_id, node_id)
+            )
+            ''')
+            
+            # Direct messages and task results for clients that were offline, as JSON frames
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                recipient TEXT NOT NULL,
+                frame TEXT NOT NULL,
+                created REAL NOT NULL,
+                expires REAL NOT NULL,
+                delivered REAL
+            )
+            ''')
+            # Only the undelivered frames of a recipient are ever looked up
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_outbox_recipient_id ON outbox (recipient, id) WHERE delivered IS NULL"
+            )
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_expires ON outbox (expires)")
+            
+            # Full-text index of message contents. Triggers keep it in step with every insert and
+            # delete, including those of the archiver and of bulk imports
+            try:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")
+                fts_exists = cursor.fetchone() is not None
+                cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    content, content='messages', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+                ''')
+                cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+                END
+                ''')
+                cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                END
+                ''')
+                cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+                END
+                ''')
+                if not fts_exists:
+                    # Index the messages a database from an older version already holds
+                    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+                self.full_text = True
+            except sqlite3.OperationalError:
+                # SQLite built without FTS5
+                self.full_text = False
+            
+            # History pages are read per target, newest id first
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_target_id ON messages (target, id)")
+            
+            # Task queries filter by requester, worker or status and page by id
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_requester_id ON tasks (requester, id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_worker_id ON tasks (worker, id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_id ON tasks (status, id)")
             
             conn.commit()
             conn.close()
@@ -101,6 +250,42 @@ class DatabaseManager:
             conn.commit()
             conn.close()
     
+    def record_presence_events(self, events):
+        """Apply a batch of (event, name, client_type, timestamp) joins/leaves in one transaction"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            for event, name, client_type, timestamp in events:
+                if event == 'joined':
+                    cursor.execute(
+                        """
+                        INSERT INTO clients (name, client_type, last_seen, is_connected) VALUES (?, ?, ?, 1)
+                        ON CONFLICT(name) DO UPDATE SET last_seen = excluded.last_seen, is_connected = 1,
+                        client_type = excluded.client_type
+                        """,
+                        (name, client_type, timestamp)
+                    )
+                else:
+                    cursor.execute(
+                        "UPDATE clients SET is_connected = 0 WHERE name = ?",
+                        (name,)
+                    )
+            
+            # One system message per event, as when they were stored one at a time
+            rows = [("system", "Server", None, f"{name} {event} the system", timestamp)
+                    for event, name, _, timestamp in events]
+            if self.message_log is not None:
+                self.message_log.append_many(rows)
+            else:
+                cursor.executemany(
+                    "INSERT INTO messages (message_type, sender, target, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+            
+            conn.commit()
+            conn.close()
+    
     def get_connected_clients(self):
         """Get a list of all connected clients"""
         with self.lock:
@@ -115,7 +300,10 @@ class DatabaseManager:
             return [{"name": name, "type": client_type} for name, client_type in clients]
     
     def store_message(self, message_type, sender, content, target=None):
-        """Store a message in the database"""
+        """Store a message in the database and return its id"""
+        if self.message_log is not None:
+            return self.message_log.store_message(message_type, sender, content, target)
+        
         with self.lock:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
@@ -126,12 +314,232 @@ class DatabaseManager:
                 "INSERT INTO messages (message_type, sender, target, content, timestamp) VALUES (?, ?, ?, ?, ?)",
                 (message_type, sender, target, content, current_time)
             )
+            message_id = cursor.lastrowid
             
             conn.commit()
             conn.close()
+            
+            return message_id
+    
+    def get_last_message_id(self):
+        """Get the id of the newest stored message (0 if there are none)"""
+        if self.message_log is not None:
+            return self.message_log.get_last_message_id()
+        
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute("SELECT MAX(id) FROM messages")
+            last_id = cursor.fetchone()[0]
+            
+            conn.close()
+            
+            return last_id or 0
+    
+    def get_messages_before(self, message_type, target, before_id=None, limit=50, include_broadcasts=False):
+        """Get one page of a target's messages with id below before_id, newest first.
+        
+        Keyset pagination: pass the smallest id of a page as before_id to get
+        the next (older) one. include_broadcasts adds the untargeted broadcast
+        messages, which belong to the default channel.
+        """
+        if self.message_log is not None:
+            return self.message_log.get_messages_before(message_type, target, before_id, limit, include_broadcasts)
+        
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            # One index range scan per kind of row; an OR here would sort every match
+            queries = [("message_type = ? AND target = ?", [message_type, target])]
+            if include_broadcasts:
+                queries.append(("message_type = 'broadcast' AND target IS NULL", []))
+            
+            messages = []
+            for condition, params in queries:
+                if before_id is not None:
+                    condition += " AND id < ?"
+                    params = params + [before_id]
+                cursor.execute(
+                    f"SELECT id, message_type, sender, target, content, timestamp FROM messages WHERE {condition} ORDER BY id DESC LIMIT ?",
+                    params + [limit]
+                )
+                messages.extend(cursor.fetchall())
+            messages.sort(reverse=True)
+            del messages[limit:]
+            
+            conn.close()
+            
+            return [
+                {
+                    "id": message_id,
+                    "type": msg_type,
+                    "sender": sender,
+                    "target": target,
+                    "content": content,
+                    "timestamp": timestamp
+                }
+                for message_id, msg_type, sender, target, content, timestamp in messages
+            ]
+    
+    def query_messages(self, message_type=None, sender=None, target=None, since=None, until=None,
+                       before_id=None, limit=100, participant=None):
+        """Get one page of messages matching the given filters, newest first.
+        
+        Pages are keyed on id like get_messages_before. participant, if set,
+        hides direct messages that the named client neither sent nor received.
+        """
+        if self.message_log is not None:
+            return self.message_log.query_messages(message_type, sender, target, since, until,
+                                                   before_id, limit, participant)
+        
+        conditions = []
+        params = []
+        for column, value in (('message_type', message_type), ('sender', sender), ('target', target)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("timestamp <= ?")
+            params.append(until)
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        if participant is not None:
+            conditions.append("(message_type != 'direct' OR sender = ? OR target = ?)")
+            params += [participant, participant]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                f"SELECT id, message_type, sender, target, content, timestamp FROM messages {where} ORDER BY id DESC LIMIT ?",
+                params + [limit]
+            )
+            messages = cursor.fetchall()
+            
+            conn.close()
+            
+            return [
+                {
+                    "id": message_id,
+                    "type": msg_type,
+                    "sender": sender,
+                    "target": target,
+                    "content": content,
+                    "timestamp": timestamp
+                }
+                for message_id, msg_type, sender, target, content, timestamp in messages
+            ]
+    
+    def search_messages(self, query, sender=None, target=None, since=None, until=None, cursor=None,
+                        limit=50, participant=None):
+        """Search message contents; returns (hits, next_cursor).
+        
+        Every word of the query must occur in a hit; a trailing * matches
+        words starting with the rest. Hits come best first by bm25 rank
+        (lower is better) with a snippet marking the matches in [brackets].
+        Pass next_cursor back as cursor for the next page; it is None on the
+        last one. bm25 scores depend on the whole index, so messages stored
+        between two pages shift every rank and a hit near the page boundary
+        may be repeated or skipped. Without FTS5, or with the log message store, words are
+        matched as substrings and hits come newest first, without rank.
+        participant hides direct messages the named client is not part of.
+        """
+        words = search_words(query or '')
+        if not words:
+            return [], None
+        
+        if self.message_log is not None:
+            before_id = cursor[-1] if cursor else None
+            hits = self.message_log.search_messages([word.strip('*') for word in words], sender, target, since,
+                                                    until, before_id, limit + 1, participant)
+            for hit in hits:
+                hit.update(rank=None, snippet=None)
+            return hits[:limit], ([hits[limit - 1]['id']] if len(hits) > limit else None)
+        
+        conditions = []
+        params = []
+        for column, value in (('m.sender', sender), ('m.target', target)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("m.timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("m.timestamp <= ?")
+            params.append(until)
+        if participant is not None:
+            conditions.append("(m.message_type != 'direct' OR m.sender = ? OR m.target = ?)")
+            params += [participant, participant]
+        
+        if self.full_text:
+            # Each word quoted, so nothing in the query is taken as FTS5 syntax
+            match = ' '.join('"' + word.rstrip('*').replace('"', '""') + '"' + ('*' if word.endswith('*') else '')
+                             for word in words)
+            conditions.insert(0, "messages_fts MATCH ?")
+            params.insert(0, match)
+            if cursor:
+                # Keyset on (rank, id); ranks move when the index changes between pages
+                conditions.append("(messages_fts.rank > ? OR (messages_fts.rank = ? AND m.id > ?))")
+                params += [cursor[0], cursor[0], cursor[-1]]
+            sql = f"""
+                SELECT m.id, m.message_type, m.sender, m.target, m.content, m.timestamp, messages_fts.rank,
+                       snippet(messages_fts, 0, '[', ']', '...', {SEARCH_SNIPPET_TOKENS})
+                FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                WHERE {' AND '.join(conditions)}
+                ORDER BY messages_fts.rank, m.id LIMIT ?
+            """
+        else:
+            for word in words:
+                # LIKE is case-insensitive for ASCII only; a full scan, newest first
+                escaped = word.rstrip('*').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                conditions.append("m.content LIKE ? ESCAPE '\\'")
+                params.append(f"%{escaped}%")
+            if cursor:
+                conditions.append("m.id < ?")
+                params.append(cursor[-1])
+            sql = f"""
+                SELECT m.id, m.message_type, m.sender, m.target, m.content, m.timestamp, NULL, NULL
+                FROM messages m WHERE {' AND '.join(conditions)}
+                ORDER BY m.id DESC LIMIT ?
+            """
+        
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(sql, params + [limit + 1]).fetchall()
+        conn.close()
+        
+        hits = [
+            {
+                "id": message_id,
+                "type": msg_type,
+                "sender": sender,
+                "target": target,
+                "content": content,
+                "timestamp": timestamp,
+                "rank": rank,
+                "snippet": snippet
+            }
+            for message_id, msg_type, sender, target, content, timestamp, rank, snippet in rows[:limit]
+        ]
+        next_cursor = None
+        if len(rows) > limit:
+            last = hits[-1]
+            next_cursor = [last['rank'], last['id']] if self.full_text else [last['id']]
+        return hits, next_cursor
     
     def get_recent_messages(self, limit=50, target=None):
         """Get recent messages, optionally filtered by target"""
+        if self.message_log is not None:
+            return self.message_log.get_recent_messages(limit, target)
+        
         with self.lock:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
@@ -161,51 +569,100 @@ class DatabaseManager:
                 for msg_type, sender, target, content, timestamp in messages
             ]
     
-    def store_task(self, task_id, task_type, worker, requester, parameters):
-        """Store a new task in the database"""
+    def store_task(self, task_id, task_type, worker, requester, parameters, priority='normal', deadline=None):
+        """Store a new task in the database; deadline is an absolute time, if any"""
         with self.lock:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
             
             current_time = time.time()
             parameters_json = json.dumps(parameters)
+            parameters_value = store_payload(cursor, parameters_json, self.blob_threshold)
             
             cursor.execute(
                 """
                 INSERT INTO tasks 
-                (task_id, task_type, worker, requester, parameters, status, submit_time) 
-                VALUES (?, ?, ?, ?, ?, ?, ?)
+                (task_id, task_type, worker, requester, parameters, status, submit_time, priority, deadline) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """,
-                (task_id, task_type, worker, requester, parameters_json, "pending", current_time)
+                (task_id, task_type, worker, requester, parameters_value, "pending", current_time, priority,
+                 deadline)
             )
             
             conn.commit()
+            
+            if self.task_cache is not None:
+                # Same shape as a row read back by get_task
+                self.task_cache.add({
+                    'id': cursor.lastrowid,
+                    'task_id': task_id,
+                    'task_type': task_type,
+                    'worker': worker,
+                    'requester': requester,
+                    'parameters': decode_payload(self.db_path, parameters_value),
+                    'status': "pending",
+                    'submit_time': current_time,
+                    'complete_time': None,
+                    'result': None,
+                    'priority': priority,
+                    'deadline': deadline,
+                    'deadline_missed': None
+                })
+            
             conn.close()
     
     def update_task_result(self, task_id, result, status="completed"):
-        """Update a task with its result"""
+        """Update a task with its result.
+        
+        For a task with a deadline, records whether it finished after it and
+        returns that (True or False); returns None for tasks without one.
+        """
         with self.lock:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
             
             current_time = time.time()
-            result_json = json.dumps(result)
+            result_value = store_payload(cursor, json.dumps(result), self.blob_threshold)
             
             cursor.execute(
                 """
                 UPDATE tasks 
-                SET status = ?, complete_time = ?, result = ? 
+                SET status = ?, complete_time = ?, result = ?,
+                    deadline_missed = CASE WHEN deadline IS NULL THEN NULL ELSE ? > deadline END
                 WHERE task_id = ?
                 """,
-                (status, current_time, result_json, task_id)
+                (status, current_time, result_value, current_time, task_id)
             )
+            cursor.execute("SELECT deadline_missed FROM tasks WHERE task_id = ?", (task_id,))
+            row = cursor.fetchone()
+            deadline_missed = row[0] if row else None
             
             conn.commit()
             conn.close()
+            
+            if self.task_cache is not None:
+                self.task_cache.update(task_id, {
+                    'status': status,
+                    'complete_time': current_time,
+                    'result': decode_payload(self.db_path, result_value),
+                    'deadline_missed': deadline_missed
+                })
+            
+            return None if deadline_missed is None else bool(deadline_missed)
     
-    def get_task(self, task_id):
-        """Get a specific task by its ID"""
+    def get_task(self, task_id, load_blobs=False):
+        """Get a specific task by its ID.
+        
+        Parameters or results stored out of line are returned as BlobRef
+        objects and only read when load() or view() is called; pass
+        load_blobs=True to get them decoded right away.
+        """
         with self.lock:
+            if self.task_cache is not None:
+                task_dict = self.task_cache.get(task_id)
+                if task_dict is not None:
+                    return self._load_blobs(task_dict) if load_blobs else task_dict
+            
             conn = sqlite3.connect(self.db_path)
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
@@ -216,16 +673,21 @@ class DatabaseManager:
             conn.close()
             
             if task:
-                task_dict = dict(task)
-                task_dict['parameters'] = json.loads(task_dict['parameters'])
-                if task_dict['result']:
-                    task_dict['result'] = json.loads(task_dict['result'])
-                return task_dict
+                task_dict = self._task_dict(task)
+                if self.task_cache is not None:
+                    self.task_cache.put(dict(task_dict))
+                    self.task_cache.evict()
+                return self._load_blobs(task_dict) if load_blobs else task_dict
             return None
     
-    def get_tasks_by_requester(self, requester, limit=50):
+    def get_tasks_by_requester(self, requester, limit=50, load_blobs=False):
         """Get tasks submitted by a specific requester"""
         with self.lock:
+            if self.task_cache is not None:
+                cached = self.task_cache.get_many('requester', requester, limit)
+                if cached is not None:
+                    return [self._load_blobs(task) for task in cached] if load_blobs else cached
+            
             conn = sqlite3.connect(self.db_path)
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
@@ -238,19 +700,63 @@ class DatabaseManager:
             
             conn.close()
             
-            result = []
-            for task in tasks:
-                task_dict = dict(task)
-                task_dict['parameters'] = json.loads(task_dict['parameters'])
-                if task_dict['result']:
-                    task_dict['result'] = json.loads(task_dict['result'])
-                result.append(task_dict)
+            result = [self._task_dict(task) for task in tasks]
             
-            return result
+            if self.task_cache is not None:
+                self.task_cache.fill('requester', requester, [dict(task) for task in result], limit)
+            
+            return [self._load_blobs(task) for task in result] if load_blobs else result
+    
+    def query_tasks(self, requester=None, worker=None, status=None, task_type=None, task_ids=None,
+                    since=None, until=None, before_id=None, limit=100, load_blobs=False):
+        """Get one page of tasks matching the given filters, newest (highest id) first.
+        
+        since and until bound the submit time. Pass the smallest id of a page
+        as before_id to get the next one. The cache is not consulted, since it
+        cannot tell whether it holds every match.
+        """
+        conditions = []
+        params = []
+        for column, value in (('requester', requester), ('worker', worker), ('status', status),
+                              ('task_type', task_type)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if task_ids is not None:
+            conditions.append(f"task_id IN ({', '.join('?' for _ in task_ids)})")
+            params += list(task_ids)
+        if since is not None:
+            conditions.append("submit_time >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("submit_time <= ?")
+            params.append(until)
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            
+            cursor.execute(f"SELECT * FROM tasks {where} ORDER BY id DESC LIMIT ?", params + [limit])
+            tasks = cursor.fetchall()
+            
+            conn.close()
+            
+            result = [self._task_dict(task) for task in tasks]
+            return [self._load_blobs(task) for task in result] if load_blobs else result
     
-    def get_tasks_by_worker(self, worker, limit=50):
+    def get_tasks_by_worker(self, worker, limit=50, load_blobs=False):
         """Get tasks assigned to a specific worker"""
         with self.lock:
+            if self.task_cache is not None:
+                cached = self.task_cache.get_many('worker', worker, limit)
+                if cached is not None:
+                    return [self._load_blobs(task) for task in cached] if load_blobs else cached
+            
             conn = sqlite3.connect(self.db_path)
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
@@ -263,12 +769,203 @@ class DatabaseManager:
             
             conn.close()
             
-            result = []
-            for task in tasks:
-                task_dict = dict(task)
-                task_dict['parameters'] = json.loads(task_dict['parameters'])
-                if task_dict['result']:
-                    task_dict['result'] = json.loads(task_dict['result'])
-                result.append(task_dict)
+            result = [self._task_dict(task) for task in tasks]
+            
+            if self.task_cache is not None:
+                self.task_cache.fill('worker', worker, [dict(task) for task in result], limit)
+            
+            return [self._load_blobs(task) for task in result] if load_blobs else result
+    
+    def store_outbox_frame(self, recipient, frame, ttl):
+        """Keep a JSON frame for an offline client for ttl seconds; False if no client of that name ever registered"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            current_time = time.time()
+            cursor.execute(
+                """
+                INSERT INTO outbox (recipient, frame, created, expires)
+                SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM clients WHERE name = ?)
+                """,
+                (recipient, frame, current_time, current_time + ttl, recipient)
+            )
+            stored = cursor.rowcount > 0
+            
+            conn.commit()
+            conn.close()
+            
+            return stored
+    
+    def get_outbox_frames(self, recipient):
+        """Undelivered, unexpired frames for a recipient as (id, JSON) pairs, oldest first"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            """
+            SELECT id, frame FROM outbox
+            WHERE recipient = ? AND delivered IS NULL AND expires > ?
+            ORDER BY id
+            """,
+            (recipient, time.time())
+        )
+        frames = cursor.fetchall()
+        
+        conn.close()
+        return frames
+    
+    def mark_outbox_delivered(self, frame_ids):
+        """Mark frames as delivered, all in one statement"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                "UPDATE outbox SET delivered = ? WHERE id IN (SELECT value FROM json_each(?))",
+                (time.time(), json.dumps(list(frame_ids)))
+            )
+            
+            conn.commit()
+            conn.close()
+    
+    def purge_outbox(self):
+        """Delete frames whose time to live is over, delivered or not; returns how many"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute("DELETE FROM outbox WHERE expires <= ?", (time.time(),))
+            removed = cursor.rowcount
+            
+            conn.commit()
+            conn.close()
+            
+            return removed
+    
+    def store_workflow(self, workflow_id, requester, nodes, output_node):
+        """Store a new workflow and its nodes, all pending; nodes are dicts with 'id' and 'task_type'"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                """
+                INSERT INTO workflows (workflow_id, requester, definition, output_node, status, submit_time)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (workflow_id, requester, json.dumps(nodes), output_node, "running", time.time())
+            )
+            cursor.executemany(
+                "INSERT INTO workflow_nodes (workflow_id, node_id, task_type, status) VALUES (?, ?, ?, ?)",
+                [(workflow_id, node['id'], node['task_type'], "pending") for node in nodes]
+            )
+            
+            conn.commit()
+            conn.close()
+    
+    def update_workflow_node(self, workflow_id, node_id, status, task_id=None, worker=None):
+        """Record a node's new status: 'running' with its task and worker, then 'completed' or 'failed'"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            current_time = time.time()
+            cursor.execute(
+                """
+                UPDATE workflow_nodes
+                SET status = ?, task_id = COALESCE(?, task_id), worker = COALESCE(?, worker),
+                    start_time = CASE WHEN ? = 'running' THEN ? ELSE start_time END,
+                    complete_time = CASE WHEN ? = 'running' THEN complete_time ELSE ? END
+                WHERE workflow_id = ? AND node_id = ?
+                """,
+                (status, task_id, worker, status, current_time, status, current_time, workflow_id, node_id)
+            )
+            
+            conn.commit()
+            conn.close()
+    
+    def finish_workflow(self, workflow_id, status, result):
+        """Store a workflow's outcome; nodes that never ran are marked cancelled"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            current_time = time.time()
+            result_value = store_payload(cursor, json.dumps(result), self.blob_threshold)
+            cursor.execute(
+                "UPDATE workflows SET status = ?, complete_time = ?, result = ? WHERE workflow_id = ?",
+                (status, current_time, result_value, workflow_id)
+            )
+            cursor.execute(
+                """
+                UPDATE workflow_nodes SET status = 'cancelled', complete_time = ?
+                WHERE workflow_id = ? AND status = 'pending'
+                """,
+                (current_time, workflow_id)
+            )
             
-            return result
\ No newline at end of file
+            conn.commit()
+            conn.close()
+    
+    def get_workflow(self, workflow_id):
+        """A workflow with the state, task and result of each node, or None"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT * FROM workflows WHERE workflow_id = ?", (workflow_id,))
+        row = cursor.fetchone()
+        if row is None:
+            conn.close()
+            return None
+        workflow = dict(row)
+        workflow['definition'] = json.loads(workflow['definition'])
+        workflow['result'] = decode_payload(self.db_path, workflow['result'])
+        if isinstance(workflow['result'], BlobRef):
+            workflow['result'] = workflow['result'].load()
+        
+        # Node results are the results of their tasks
+        cursor.execute(
+            """
+            SELECT n.node_id, n.task_type, n.status, n.task_id, n.worker, n.start_time, n.complete_time,
+                   t.result
+            FROM workflow_nodes n LEFT JOIN tasks t ON t.task_id = n.task_id
+            WHERE n.workflow_id = ?
+            ORDER BY n.rowid
+            """,
+            (workflow_id,)
+        )
+        workflow['nodes'] = []
+        for row in cursor.fetchall():
+            node = dict(row)
+            node['result'] = decode_payload(self.db_path, node['result'])
+            if isinstance(node['result'], BlobRef):
+                node['result'] = node['result'].load()
+            workflow['nodes'].append(node)
+        
+        conn.close()
+        return workflow
+    
+    def _task_dict(self, row):
+        """Task row as a dict with its JSON columns decoded; blob references become BlobRefs"""
+        task_dict = dict(row)
+        task_dict['parameters'] = decode_payload(self.db_path, task_dict['parameters'])
+        task_dict['result'] = decode_payload(self.db_path, task_dict['result'])
+        return task_dict
+    
+    def _load_blobs(self, task_dict):
+        """Replace BlobRefs in a task dict by the payloads they point to"""
+        for field in ('parameters', 'result'):
+            if isinstance(task_dict[field], BlobRef):
+                task_dict[field] = task_dict[field].load()
+        return task_dict
+    
+    def delete_unused_blobs(self):
+        """Delete blobs no task or workflow refers to any more; returns how many were removed"""
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            try:
+                return delete_unused_blobs(conn)
+            finally:
+                conn.close()
\ No newline at end of file
@@ -0,0 +1,343 @@
+import hmac
+import json
+import socket
+import threading
+import time
+
+
+def parse_address(text, default_host='localhost'):
+    """Parse "host:port", "port" or "unix:/path" into an address tuple"""
+    if isinstance(text, (tuple, list)):
+        if text[0] == 'unix':
+            return ('unix', text[1])
+        return (text[0], int(text[1]))
+    if text.startswith('unix:'):
+        return ('unix', text[5:])
+    host, _, port = text.rpartition(':')
+    return (host or default_host, int(port))
+
+
+class PeerLink:
+    """Outbound connection used to send frames to one peer server.
+
+    Links are one-way: a node only writes to its outbound links and only
+    reads peer frames from inbound connections, so each pair of nodes is
+    joined by two links. The link reconnects with backoff until closed.
+    """
+
+    def __init__(self, federation, address):
+        self.federation = federation
+        self.address = address
+        self.node_id = None
+        self.sock = None
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name=f"peer-link {self.address[0]}:{self.address[1]}")
+        thread.daemon = True
+        thread.start()
+
+    def connect(self):
+        if self.address[0] == 'unix':
+            # Sibling process on the same host (multi-process mode)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(5)
+            try:
+                sock.connect(self.address[1])
+            except OSError:
+                sock.close()
+                raise
+            return sock
+        return socket.create_connection(self.address, timeout=5)
+
+    def run(self):
+        backoff = 0.5
+        while not self.closed:
+            sock = None
+            try:
+                sock = self.connect()
+                sock.settimeout(None)
+                reader = sock.makefile('r', encoding='utf-8')
+
+                sock.sendall((json.dumps(self.federation.hello_message()) + '\n').encode('utf-8'))
+                welcome = json.loads(reader.readline() or 'null')
+                if not isinstance(welcome, dict) or welcome.get('type') != 'peer_welcome':
+                    raise ConnectionError("peer did not answer the handshake")
+
+                self.node_id = welcome.get('node')
+                if not self.federation.attach_link(self):
+                    # This address is ourselves, or another link already reaches that node
+                    self.closed = True
+                    break
+
+                with self.lock:
+                    self.sock = sock
+                self.send(self.federation.snapshot_message())
+                print(f"Peer link to {self.node_id} at {self.address[0]}:{self.address[1]} established")
+                backoff = 0.5
+
+                # The peer never writes after the welcome; reading only detects a closed link
+                while reader.readline():
+                    pass
+            except (OSError, ValueError) as e:
+                if not self.closed:
+                    print(f"Peer link to {self.address[0]}:{self.address[1]} unavailable: {e}")
+            finally:
+                with self.lock:
+                    self.sock = None
+                if sock is not None:
+                    sock.close()
+                self.federation.detach_link(self)
+
+            if not self.closed:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 10)
+
+    def send(self, frame):
+        """Send one frame to the peer; returns False if the link is down"""
+        data = (json.dumps(frame) + '\n').encode('utf-8')
+        with self.lock:
+            if self.sock is None:
+                return False
+            try:
+                self.sock.sendall(data)
+                return True
+            except OSError:
+                # Wake up the reader in run(), which reconnects
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return False
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            if self.sock is not None:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class Federation:
+    """Peers a DistributedServer with other server nodes.
+
+    Nodes share presence (which client names are connected to which node),
+    forward direct messages and task traffic to the node that owns the
+    target, and relay each broadcast once per peer. Every node must peer with
+    every other node; an inbound peer is linked back automatically, so it is
+    enough to list each pair on one side.
+
+    Peers connect on the client port, so a peer_hello must carry the shared
+    peer token; without a token configured only trusted connections (the
+    sibling processes' Unix sockets) are accepted as peers.
+    """
+
+    def __init__(self, server, node_id, advertise_address, peers=(), persist_remote=True, peer_token=None):
+        self.server = server
+        self.node_id = node_id
+        self.advertise_address = advertise_address
+        self.peer_token = peer_token  # Shared secret every node sends in its peer_hello
+        self.initial_peers = [parse_address(peer) for peer in peers]
+        # Each node has its own database unless they share one (see multi-process mode)
+        self.persist_remote = persist_remote
+        self.lock = threading.Lock()
+        self.links_by_address = {}  # (host, port) or ('unix', path) -> PeerLink
+        self.links_by_node = {}  # node id -> attached PeerLink
+        self.node_clients = {}  # node id -> set of client names on that node
+        self.remote_clients = {}  # client name -> node id
+        self.inbound_counts = {}  # node id -> number of open inbound connections
+
+    def start(self):
+        for address in self.initial_peers:
+            self.add_peer(address)
+
+    def add_peer(self, address):
+        """Open an outbound link to a peer unless one already exists"""
+        address = parse_address(address)
+        with self.lock:
+            if address in self.links_by_address:
+                return
+            link = PeerLink(self, address)
+            self.links_by_address[address] = link
+        link.start()
+
+    def hello_message(self):
+        return {
+            'type': 'peer_hello',
+            'node': self.node_id,
+            'address': list(self.advertise_address),
+            'token': self.peer_token
+        }
+
+    def authenticate(self, hello, trusted=False):
+        """Whether a peer_hello comes from a node that knows the peer token"""
+        if trusted:
+            return True
+        token = hello.get('token')
+        if not self.peer_token or not isinstance(token, str):
+            return False
+        return hmac.compare_digest(token.encode('utf-8'), self.peer_token.encode('utf-8'))
+
+    def snapshot_message(self):
+        return {
+            'type': 'peer_presence',
+            'node': self.node_id,
+            'snapshot': True,
+            'clients': self.server.local_client_names()
+        }
+
+    def attach_link(self, link):
+        """Make a connected link the route to its node; False if it should be dropped.
+
+        Rejected links stay in links_by_address so the same address is not retried.
+        """
+        with self.lock:
+            if link.node_id == self.node_id:
+                return False
+            current = self.links_by_node.get(link.node_id)
+            if current is not None and current is not link:
+                return False
+            self.links_by_node[link.node_id] = link
+            return True
+
+    def detach_link(self, link):
+        with self.lock:
+            if self.links_by_node.get(link.node_id) is link:
+                del self.links_by_node[link.node_id]
+
+    def send_to_all(self, frame):
+        with self.lock:
+            links = list(self.links_by_node.values())
+        for link in links:
+            link.send(frame)
+
+    def announce_presence(self, added=(), removed=()):
+        """Tell every peer about clients that joined or left this node"""
+        self.send_to_all({
+            'type': 'peer_presence',
+            'node': self.node_id,
+            'added': list(added),
+            'removed': list(removed)
+        })
+
+    def relay_broadcast(self, message):
+        """Relay a broadcast once to each peer, which fans it out locally"""
+        self.send_to_all({'type': 'peer_broadcast', 'node': self.node_id, 'message': message})
+
+    def owner_of(self, name):
+        with self.lock:
+            return self.remote_clients.get(name)
+
+    def remote_client_names(self):
+        with self.lock:
+            return list(self.remote_clients)
+
+    def forward_direct(self, message, target):
+        """Forward a direct message to the node that owns the target"""
+        with self.lock:
+            link = self.links_by_node.get(self.remote_clients.get(target))
+        if link is None:
+            return False
+        return link.send({'type': 'peer_direct', 'node': self.node_id, 'message': message})
+
+    def handle_inbound(self, client_socket, reader, hello, trusted=False):
+        """Serve an inbound connection from a peer node until it closes.
+
+        A hello without the right token is dropped before anything is
+        registered or dialled; the caller closes the socket.
+        """
+        node = hello.get('node')
+        if not self.authenticate(hello, trusted):
+            self.server.metrics.increment('peers_rejected')
+            print(f"Rejected peer_hello from unauthenticated node {node!r}")
+            return False
+        if hello.get('address'):
+            # Make sure we can send to this peer as well
+            self.add_peer(hello['address'])
+
+        with self.lock:
+            self.inbound_counts[node] = self.inbound_counts.get(node, 0) + 1
+        self.server.send_to_client(client_socket, {'type': 'peer_welcome', 'node': self.node_id})
+        print(f"Peer {node} connected")
+
+        try:
+            while True:
+                data = reader.readline()
+                if not data:
+                    break
+                try:
+                    frame = json.loads(data)
+                except json.JSONDecodeError:
+                    print(f"Invalid frame from peer {node}")
+                    continue
+
+                frame_type = frame.get('type')
+                if frame_type == 'peer_presence':
+                    added, removed = self.apply_presence(node, frame)
+                    self.server.record_presence(added, removed)
+                elif frame_type == 'peer_broadcast':
+                    self.server.deliver_peer_broadcast(frame.get('message', {}))
+                elif frame_type == 'peer_direct':
+                    self.server.deliver_peer_direct(frame.get('message', {}))
+        finally:
+            with self.lock:
+                self.inbound_counts[node] -= 1
+                last_connection = self.inbound_counts[node] == 0
+                if last_connection:
+                    del self.inbound_counts[node]
+            if last_connection:
+                self.drop_node(node)
+            print(f"Peer {node} disconnected")
+        return True
+
+    def apply_presence(self, node, frame):
+        """Update the names held by a peer; returns the (added, removed) remote names"""
+        added, removed = [], []
+        with self.lock:
+            names = self.node_clients.setdefault(node, set())
+            if frame.get('snapshot'):
+                current = set(frame.get('clients', []))
+                gone = names - current
+                new = current - names
+                names.clear()
+                names.update(current)
+            else:
+                gone = set(frame.get('removed', []))
+                new = set(frame.get('added', [])) - gone
+                names.update(new)
+                names.difference_update(gone)
+
+            for name in gone:
+                if self.remote_clients.get(name) == node:
+                    del self.remote_clients[name]
+                    removed.append(name)
+            for name in new:
+                if name not in self.remote_clients:
+                    added.append(name)
+                self.remote_clients[name] = node
+        return added, removed
+
+    def drop_node(self, node):
+        """Forget the clients of a peer we can no longer hear from"""
+        with self.lock:
+            names = self.node_clients.pop(node, set())
+            for name in names:
+                if self.remote_clients.get(name) == node:
+                    del self.remote_clients[name]
+
+        if names:
+            self.server.record_presence(removed=sorted(names))
+            self.server.broadcast({
+                'type': 'system',
+                'message': f"Lost contact with node {node}; {len(names)} remote clients removed",
+                'timestamp': time.time()
+            })
+
+    def stop(self):
+        with self.lock:
+            links = list(self.links_by_address.values())
+        for link in links:
+            link.close()
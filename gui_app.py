@@ -347,7 +347,7 @@ class DistributedSystemGUI:
 
             # Create client
             from client import DistributedClient
-            self.comm_client = DistributedClient(name, host, port)
+            self.comm_client = DistributedClient(name, host, port, history=20)
 
             if self.comm_client.connect():
                 self.status_var.set(f"Conectado como Cliente: {name}")
@@ -477,6 +477,11 @@ class DistributedSystemGUI:
             msg_text = message.get('message', '')
             self.add_to_client_messages(f"[Broadcast] {sender}: {msg_text}")
 
+        elif message_type == 'publish':
+            sender = message.get('sender', 'Unknown')
+            msg_text = message.get('message', '')
+            self.add_to_client_messages(f"[#{message.get('channel')}] {sender}: {msg_text}")
+
         elif message_type == 'direct':
             sender = message.get('sender', 'Unknown')
             msg_text = message.get('message', '')
@@ -489,6 +494,14 @@ class DistributedSystemGUI:
         elif message_type == 'client_list':
             self.update_clients_listbox(message.get('clients', []))
 
+        elif message_type == 'presence_delta':
+            # The client already applied the delta to its list
+            self.update_clients_listbox(self.comm_client.client_list)
+
+        elif message_type == 'history':
+            for entry in message.get('messages', []):
+                self.add_to_client_messages(f"[History] {entry.get('sender')}: {entry.get('message')}")
+
     def handle_task_client_message(self, message):
         """Handle a message received by the task client"""
         message_type = message.get('type')
@@ -519,6 +532,10 @@ class DistributedSystemGUI:
             workers = [c for c in clients if c.startswith("Worker-")]
             self.update_workers_listbox(workers)
 
+        elif message_type == 'presence_delta':
+            workers = [c for c in self.task_client.client_list if c.startswith("Worker-")]
+            self.update_workers_listbox(workers)
+
     def handle_worker_message(self, message):
         """Handle a message received by the worker"""
         message_type = message.get('type')
@@ -782,7 +799,7 @@ def patch_task_client_class():
         self.new_messages.append(message)
 
         # Flag for client list updates
-        if message.get('type') == 'client_list':
+        if message.get('type') in ('client_list', 'presence_delta'):
             self.client_list_updated = True
 
     DistributedTaskClient.process_message = patched_process_message
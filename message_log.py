@@ -0,0 +1,519 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+SEGMENT_BYTES = 64 * 1024 * 1024  # A new segment is started once the active one reaches this size
+INDEX_BYTES = 64 * 1024  # One sparse index entry per this many bytes of log
+REMAP_BYTES = 1024 * 1024  # The active segment is mapped again once this much was appended past its map
+
+# Record: payload length, CRC32 of the payload, payload (JSON), payload length again.
+# The trailing length lets readers walk a segment backwards from its end.
+HEADER = struct.Struct('<II')
+TRAILER = struct.Struct('<I')
+# Index entry: timestamp, message id, byte offset of the record in the segment
+INDEX_ENTRY = struct.Struct('<dQQ')
+
+
+class Segment:
+    """One log file plus its sparse (timestamp, id, offset) index"""
+
+    def __init__(self, directory, first_id):
+        self.first_id = first_id
+        self.path = os.path.join(directory, f"{first_id:020d}.log")
+        self.index_path = os.path.join(directory, f"{first_id:020d}.idx")
+        # Exists once a record older than its predecessor was appended (imports, batched presence)
+        self.unordered_path = os.path.join(directory, f"{first_id:020d}.unordered")
+        self.index = []  # (timestamp, id, offset), in log order
+        self.size = 0
+        self.last_id = first_id - 1
+        self.min_timestamp = None
+        self.max_timestamp = None
+        self.last_timestamp = None  # Of the newest record, to notice one that goes back in time
+        self.ordered = True  # Timestamps never decrease, so the index can be bisected by time
+        self.next_index_offset = 0
+        self._fd = None
+        self._map = None
+        self._map_size = 0
+        self._retired = []  # Replaced maps, closed once no reader uses them
+        self._readers = 0
+        # Reentrant: a scan dropped half-way releases its views from the garbage collector
+        self._view_lock = threading.RLock()
+
+    def open_view(self, size):
+        """A reader's view of the first `size` bytes (None if empty); release() it when done.
+
+        Appends do not replace the map: the bytes written since it was made
+        are read with pread, until REMAP_BYTES of them make a new map worth it.
+        """
+        if size == 0:
+            return None
+        with self._view_lock:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDONLY)
+            if self._map is None or size - self._map_size >= REMAP_BYTES:
+                if self._map is not None:
+                    self._retired.append(self._map)
+                self._map = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+                self._map_size = size
+                self._close_retired()
+            self._readers += 1
+            return SegmentView(self, self._map, self._map_size, self._fd, size)
+
+    def release(self):
+        with self._view_lock:
+            self._readers -= 1
+            self._close_retired()
+
+    def _close_retired(self):
+        if self._readers == 0:
+            for old_map in self._retired:
+                old_map.close()
+            self._retired = []
+
+    def close(self):
+        """Close the map and the file descriptor; no view may still be in use"""
+        with self._view_lock:
+            if self._map is not None:
+                self._retired.append(self._map)
+            self._close_retired()
+            self._map = None
+            self._map_size = 0
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def mark_unordered(self):
+        """Remember for good that timestamps in this segment go back in time"""
+        if self.ordered:
+            self.ordered = False
+            # Created before the record is written, so a crash can only leave it set too early
+            open(self.unordered_path, 'ab').close()
+
+    def note_timestamp(self, timestamp):
+        if self.last_timestamp is not None and timestamp < self.last_timestamp:
+            self.mark_unordered()
+        self.min_timestamp = timestamp if self.min_timestamp is None else min(self.min_timestamp, timestamp)
+        self.max_timestamp = timestamp if self.max_timestamp is None else max(self.max_timestamp, timestamp)
+        self.last_timestamp = timestamp
+
+
+class SegmentView:
+    """Bytes of a segment as far as it was written when a read started: the map, then the tail past it"""
+
+    def __init__(self, segment, segment_map, map_size, fd, size):
+        self.segment = segment
+        self.map = segment_map
+        self.map_size = map_size
+        self.fd = fd
+        self.size = size
+        self.tail = None  # Read in one pread on first use
+
+    def __len__(self):
+        return self.size
+
+    def read(self, offset, length):
+        end = offset + length
+        if end <= self.map_size:
+            return self.map[offset:end]
+        if self.tail is None:
+            self.tail = os.pread(self.fd, self.size - self.map_size, self.map_size)
+        if offset >= self.map_size:
+            return self.tail[offset - self.map_size:end - self.map_size]
+        return self.map[offset:self.map_size] + self.tail[:end - self.map_size]
+
+    def unpack(self, layout, offset):
+        return layout.unpack(self.read(offset, layout.size))
+
+    def release(self):
+        self.segment.release()
+
+
+class MessageLog:
+    """Append-only segmented log for chat and system messages.
+
+    Messages are written once and read mostly newest-first or by time range,
+    so instead of a B-tree insert per message they are appended to the end
+    of the active segment file. Segments roll over by size, reads go through
+    memory maps (pread for what was appended since the map was made), and a sparse per-segment index of (timestamp, id, offset)
+    lets range and keyset queries skip straight to the right place. The
+    method signatures match the message methods of DatabaseManager.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, index_bytes=INDEX_BYTES, fsync=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_bytes = index_bytes
+        # fsync after every append. Off by default, the log never syncs: appends survive a
+        # process crash but not a power loss or OS crash (SQLite syncs on every commit)
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.segments = []
+        self._file = None
+        self._index_file = None
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+
+    def _open(self):
+        first_ids = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.log'))
+        for first_id in first_ids:
+            segment = Segment(self.directory, first_id)
+            self._recover(segment)
+            self.segments.append(segment)
+
+        if not self.segments:
+            self.segments.append(Segment(self.directory, 1))
+        self._open_active()
+
+    def _recover(self, segment):
+        """Load a segment's index and bounds; a torn tail from a crash is cut off.
+
+        Records up to the last index entry were written before it, so only
+        the tail after that entry is read and checked, through the segment's
+        view. A segment without a usable index, or whose timestamps go back
+        in time (its bounds need every record), is scanned from the start.
+        """
+        segment.size = os.path.getsize(segment.path)
+        segment.ordered = not os.path.exists(segment.unordered_path)
+        view = segment.open_view(segment.size)
+        if view is None:
+            self._rewrite_index(segment)
+            return
+
+        try:
+            index = []
+            if segment.ordered and os.path.exists(segment.index_path):
+                with open(segment.index_path, 'rb') as f:
+                    index_data = f.read()
+                usable = len(index_data) - len(index_data) % INDEX_ENTRY.size
+                index = [INDEX_ENTRY.unpack_from(index_data, i) for i in range(0, usable, INDEX_ENTRY.size)]
+                index = [entry for entry in index if entry[2] < segment.size]
+            first = _decode(view, 0)
+            last_indexed = _decode(view, index[-1][2]) if index else None
+            if first is not None and last_indexed is not None and last_indexed[0]['id'] == index[-1][1]:
+                segment.index = index[:-1]
+                offset = index[-1][2]
+                segment.min_timestamp = first[0]['timestamp']
+                segment.last_timestamp = first[0]['timestamp']
+            else:
+                segment.index = []
+                offset = 0
+
+            # Walk forward to the last complete record, indexing as appends do
+            scanned_from = offset
+            segment.next_index_offset = offset
+            while True:
+                record = _decode(view, offset)
+                if record is None:
+                    break
+                message, length = record
+                if offset >= segment.next_index_offset:
+                    segment.index.append((message['timestamp'], message['id'], offset))
+                    segment.next_index_offset = offset + self.index_bytes
+                segment.note_timestamp(message['timestamp'])
+                if not segment.ordered and scanned_from > 0:
+                    # The unscanned head counts towards the bounds now; start over
+                    segment.index = []
+                    segment.min_timestamp = segment.max_timestamp = segment.last_timestamp = None
+                    offset = scanned_from = segment.next_index_offset = 0
+                    continue
+                segment.last_id = message['id']
+                offset += length
+        finally:
+            view.release()
+
+        if offset < segment.size:
+            print(f"Truncating torn record at {segment.path}:{offset}")
+            segment.close()
+            with open(segment.path, 'r+b') as f:
+                f.truncate(offset)
+            segment.size = offset
+
+        segment.next_index_offset = (segment.index[-1][2] + self.index_bytes) if segment.index else 0
+        self._rewrite_index(segment)
+
+    def _rewrite_index(self, segment):
+        with open(segment.index_path, 'wb') as f:
+            for entry in segment.index:
+                f.write(INDEX_ENTRY.pack(*entry))
+
+    def _open_active(self):
+        if self._file is not None:
+            self._file.close()
+            self._index_file.close()
+        segment = self.segments[-1]
+        self._file = open(segment.path, 'ab')
+        self._index_file = open(segment.index_path, 'ab')
+
+    def _roll_over(self):
+        segment = Segment(self.directory, self.segments[-1].last_id + 1)
+        self.segments.append(segment)
+        self._open_active()
+
+    def append(self, message_type, sender, content, target=None, timestamp=None):
+        """Append one message and return its id"""
+        return self.append_many([(message_type, sender, target, content, timestamp)])[-1]
+
+    def append_many(self, rows):
+        """Append (message_type, sender, target, content, timestamp) rows; returns their ids"""
+        ids = []
+        with self.lock:
+            for message_type, sender, target, content, timestamp in rows:
+                segment = self.segments[-1]
+                if segment.size >= self.segment_bytes:
+                    self._roll_over()
+                    segment = self.segments[-1]
+
+                message_id = segment.last_id + 1
+                if timestamp is None:
+                    timestamp = time.time()
+                payload = json.dumps({
+                    'id': message_id,
+                    'type': message_type,
+                    'sender': sender,
+                    'target': target,
+                    'content': content,
+                    'timestamp': timestamp
+                }).encode('utf-8')
+                record = HEADER.pack(len(payload), zlib.crc32(payload)) + payload + TRAILER.pack(len(payload))
+
+                if segment.size >= segment.next_index_offset:
+                    entry = (timestamp, message_id, segment.size)
+                    segment.index.append(entry)
+                    self._index_file.write(INDEX_ENTRY.pack(*entry))
+                    segment.next_index_offset = segment.size + self.index_bytes
+
+                segment.note_timestamp(timestamp)
+                self._file.write(record)
+                segment.size += len(record)
+                segment.last_id = message_id
+                ids.append(message_id)
+
+            self._file.flush()
+            self._index_file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+        return ids
+
+    def _snapshot(self):
+        """Segments with the size, view, (min, max) timestamps and order each had when the read started.
+
+        Release the views with _release() once the read is over.
+        """
+        with self.lock:
+            return [(segment, segment.size, segment.open_view(segment.size), segment.min_timestamp,
+                     segment.max_timestamp, segment.ordered) for segment in self.segments]
+
+    def _scan_backward(self, before_id=None, since=None, until=None):
+        """Yield messages newest first, starting below before_id if given.
+
+        since/until let the sparse index skip what lies outside that time
+        range: segments whose bounds miss it are passed over, and an ordered
+        segment is entered at the last record up to until and left at the
+        first one before since. Out-of-order segments are walked in full, so
+        callers still check each message's timestamp.
+        """
+        snapshot = self._snapshot()
+        try:
+            for segment, size, view, min_timestamp, max_timestamp, ordered in reversed(snapshot):
+                if view is None or (before_id is not None and segment.first_id >= before_id):
+                    continue
+                if since is not None and max_timestamp < since:
+                    continue
+                if until is not None and min_timestamp > until:
+                    continue
+                end = size
+                if before_id is not None:
+                    # Start at the first indexed record at or past before_id
+                    position = bisect.bisect_left([entry[1] for entry in segment.index], before_id)
+                    if position < len(segment.index):
+                        end = segment.index[position][2]
+                if ordered and until is not None:
+                    # The first indexed record past until, and everything after it, is too new
+                    position = bisect.bisect_right([entry[0] for entry in segment.index], until)
+                    if position < len(segment.index):
+                        end = min(end, segment.index[position][2])
+                while end > 0:
+                    length = view.unpack(TRAILER, end - TRAILER.size)[0]
+                    start = end - TRAILER.size - length
+                    message = json.loads(view.read(start, length))
+                    end = start - HEADER.size
+                    if ordered and since is not None and message['timestamp'] < since:
+                        break
+                    if before_id is None or message['id'] < before_id:
+                        yield message
+        finally:
+            _release(snapshot)
+
+    def _scan_range(self, start_time, end_time):
+        """Yield messages with start_time <= timestamp <= end_time, in log order.
+
+        Timestamps are not monotonic across the log (imports and batched
+        presence events keep their original times), so every segment whose
+        bounds overlap the range is visited. Only a segment whose timestamps
+        never go back in time is bisected and cut short past end_time; the
+        others are scanned from start to end.
+        """
+        snapshot = self._snapshot()
+        try:
+            for segment, size, view, min_timestamp, max_timestamp, ordered in snapshot:
+                if view is None or min_timestamp is None:
+                    continue
+                if start_time is not None and max_timestamp < start_time:
+                    continue
+                if end_time is not None and min_timestamp > end_time:
+                    continue
+                offset = 0
+                if ordered and start_time is not None:
+                    position = bisect.bisect_left([entry[0] for entry in segment.index], start_time)
+                    if position > 0:
+                        offset = segment.index[position - 1][2]
+                while offset < size:
+                    length = view.unpack(HEADER, offset)[0]
+                    start = offset + HEADER.size
+                    message = json.loads(view.read(start, length))
+                    offset = start + length + TRAILER.size
+                    if start_time is not None and message['timestamp'] < start_time:
+                        continue
+                    if end_time is not None and message['timestamp'] > end_time:
+                        if ordered:
+                            break
+                        continue
+                    yield message
+        finally:
+            _release(snapshot)
+
+    def store_message(self, message_type, sender, content, target=None):
+        """Store a message and return its id"""
+        return self.append(message_type, sender, content, target)
+
+    def get_recent_messages(self, limit=50, target=None):
+        """Get recent messages, optionally filtered by target"""
+        messages = []
+        for message in self._scan_backward():
+            if target and message['target'] is not None and message['target'] != target:
+                continue
+            messages.append(_public(message))
+            if len(messages) == limit:
+                break
+        return messages
+
+    def get_messages_before(self, message_type, target, before_id=None, limit=50, include_broadcasts=False):
+        """Get one page of a target's messages with id below before_id, newest first"""
+        messages = []
+        for message in self._scan_backward(before_id):
+            matches = message['type'] == message_type and message['target'] == target
+            if not matches and include_broadcasts:
+                matches = message['type'] == 'broadcast' and message['target'] is None
+            if matches:
+                messages.append(dict(_public(message), id=message['id']))
+                if len(messages) == limit:
+                    break
+        return messages
+
+    def query_messages(self, message_type=None, sender=None, target=None, since=None, until=None,
+                       before_id=None, limit=100, participant=None):
+        """Get one page of messages matching the given filters, newest first"""
+        messages = []
+        for message in self._scan_backward(before_id, since, until):
+            if message_type is not None and message['type'] != message_type:
+                continue
+            if sender is not None and message['sender'] != sender:
+                continue
+            if target is not None and message['target'] != target:
+                continue
+            if since is not None and message['timestamp'] < since:
+                continue
+            if until is not None and message['timestamp'] > until:
+                continue
+            if participant is not None and message['type'] == 'direct' and \
+                    participant not in (message['sender'], message['target']):
+                continue
+            messages.append(dict(_public(message), id=message['id']))
+            if len(messages) == limit:
+                break
+        return messages
+
+    def search_messages(self, words, sender=None, target=None, since=None, until=None,
+                        before_id=None, limit=50, participant=None):
+        """Messages containing every word (case-insensitively), newest first; the log has no text index"""
+        words = [word.lower() for word in words]
+        hits = []
+        for message in self._scan_backward(before_id, since, until):
+            if sender is not None and message['sender'] != sender:
+                continue
+            if target is not None and message['target'] != target:
+                continue
+            if since is not None and message['timestamp'] < since:
+                continue
+            if until is not None and message['timestamp'] > until:
+                continue
+            if participant is not None and message['type'] == 'direct' and \
+                    participant not in (message['sender'], message['target']):
+                continue
+            content = message['content'].lower()
+            if not all(word in content for word in words):
+                continue
+            hits.append(dict(_public(message), id=message['id']))
+            if len(hits) == limit:
+                break
+        return hits
+
+    def get_messages_between(self, start_time=None, end_time=None):
+        """Get the messages of a time range, oldest first, using the sparse index where timestamps allow"""
+        messages = [dict(_public(message), id=message['id']) for message in self._scan_range(start_time, end_time)]
+        # Log order is not time order once old timestamps were appended
+        messages.sort(key=lambda message: (message['timestamp'], message['id']))
+        return messages
+
+    def iter_messages(self):
+        """Yield every message in the order it was appended, without loading the log into memory"""
+        return self._scan_range(None, None)
+
+    def get_last_message_id(self):
+        with self.lock:
+            return self.segments[-1].last_id
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._index_file.close()
+                self._file = None
+            for segment in self.segments:
+                segment.close()
+
+
+def _decode(view, offset):
+    """Decode the record at offset of a SegmentView; None if it is incomplete or corrupt"""
+    if offset + HEADER.size > len(view):
+        return None
+    length, checksum = view.unpack(HEADER, offset)
+    end = offset + HEADER.size + length + TRAILER.size
+    if end > len(view):
+        return None
+    payload = view.read(offset + HEADER.size, length)
+    if zlib.crc32(payload) != checksum or view.unpack(TRAILER, end - TRAILER.size)[0] != length:
+        return None
+    return json.loads(payload), end - offset
+
+
+def _release(snapshot):
+    for _, _, view, _, _, _ in snapshot:
+        if view is not None:
+            view.release()
+
+
+def _public(message):
+    """Message in the shape DatabaseManager.get_recent_messages returns"""
+    return {
+        "type": message['type'],
+        "sender": message['sender'],
+        "target": message['target'],
+        "content": message['content'],
+        "timestamp": message['timestamp']
+    }
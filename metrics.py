@@ -0,0 +1,66 @@
+import threading
+import time
+
+
+class Timing:
+    """Count, sum and maximum of a series of durations"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max
+        }
+
+
+class ServerMetrics:
+    """Counters and timings the server exposes through the 'stats' request.
+
+    Names are dotted strings such as "task_wait.high"; both kinds are
+    created on first use. Gauges are callables evaluated when a snapshot is
+    taken, for values like queue depths that are owned by another object.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = Timing()
+            timing.add(value)
+
+    def register_gauge(self, name, function):
+        self.gauges[name] = function
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            timings = {name: timing.snapshot() for name, timing in self.timings.items()}
+        return {
+            'uptime': time.time() - self.started_at,
+            'counters': counters,
+            'timings': timings,
+            # Evaluated outside our lock; gauges take their owners' locks
+            'gauges': {name: function() for name, function in self.gauges.items()}
+        }
@@ -0,0 +1,117 @@
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class SamplingProfiler:
+    """Statistical profiler that samples the stacks of every thread in the process.
+
+    Nothing runs while the profiler is stopped, so leaving it installed in a
+    production process costs nothing. Results are written as collapsed stacks
+    ("frame;frame;frame count" per line), the input format of flamegraph.pl
+    and speedscope.
+    """
+
+    def __init__(self, interval=0.005, output_dir='.'):
+        self.interval = interval
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        self.samples = Counter()
+        self.sample_count = 0
+        self.started_at = None
+        self._stop_event = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start sampling; returns False if the profiler was already running"""
+        with self.lock:
+            if self._thread is not None:
+                return False
+
+            self.samples = Counter()
+            self.sample_count = 0
+            self.started_at = time.time()
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(target=self._sample_loop, args=(self._stop_event,), name="profiler")
+            self._thread.daemon = True
+            self._thread.start()
+            return True
+
+    def stop(self, path=None):
+        """Stop sampling and write the collapsed stacks; returns the file path or None"""
+        with self.lock:
+            if self._thread is None:
+                return None
+
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+            if path is None:
+                os.makedirs(self.output_dir, exist_ok=True)
+                timestamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))
+                path = os.path.join(self.output_dir, f"profile-{os.getpid()}-{timestamp}.collapsed")
+
+            with open(path, 'w') as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            return path
+
+    def toggle(self):
+        """Start the profiler if it is stopped, otherwise stop it and dump the results"""
+        if self.running:
+            path = self.stop()
+            print(f"Profiler stopped after {self.sample_count} samples, written to {path}")
+            return path
+
+        self.start()
+        print(f"Profiler started (sampling every {self.interval * 1000:.1f} ms)")
+        return None
+
+    def _sample_loop(self, stop_event):
+        own_ident = threading.get_ident()
+        while not stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(_thread_group(names.get(ident, 'unknown')))
+                stack.reverse()
+                self.samples[';'.join(stack)] += 1
+            self.sample_count += 1
+
+
+def _thread_group(name):
+    """Collapse "Thread-12 (handle_client)" style names so per-client threads merge"""
+    if name.startswith('Thread-') and '(' in name:
+        return name[name.index('(') + 1:name.rindex(')')]
+    return name
+
+
+def install_signal_toggle(profiler, signum=None):
+    """Toggle the profiler with a signal (SIGUSR1 by default); returns False if unsupported"""
+    if signum is None:
+        signum = getattr(signal, 'SIGUSR1', None)
+    if signum is None or threading.current_thread() is not threading.main_thread():
+        # Windows has no SIGUSR1, and handlers can only be set from the main thread
+        return False
+
+    def handler(signum, frame):
+        # Writing the profile joins the sampler thread; keep that out of the handler
+        threading.Thread(target=profiler.toggle, daemon=True).start()
+
+    signal.signal(signum, handler)
+    return True
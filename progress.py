@@ -0,0 +1,92 @@
+import threading
+import time
+
+PROGRESS_INTERVAL = 0.25  # Least time between two progress updates relayed for a task
+PROGRESS_IDLE = 300  # Seconds without updates after which a task's relay state is dropped
+
+
+class TaskProgress:
+    """Relay state of one task: when its last update went out and the newest one held back"""
+
+    def __init__(self):
+        self.last_sent = 0.0
+        self.last_seen = 0.0
+        self.pending = None  # (message, target) waiting for the interval to pass
+
+
+class ProgressRelay:
+    """Relays worker progress updates to requesters, coalescing fast ones.
+
+    At most one update per task goes out every `interval` seconds. An update
+    that arrives sooner replaces any other held back for the task and is
+    sent by the flush thread once the interval has passed, so the requester
+    always ends up with the newest state but a chatty worker cannot flood
+    its connection. finish() discards what is held back once the result is in.
+    An interval of 0 relays every update as it comes, with no flush thread.
+    """
+
+    def __init__(self, send, metrics, interval=PROGRESS_INTERVAL):
+        self.send = send  # send(message, target)
+        self.metrics = metrics
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.tasks = {}  # task_id -> TaskProgress
+        self._stop_event = threading.Event()
+
+    def start(self):
+        if self.interval <= 0:
+            # Nothing is ever held back, so there is nothing to flush
+            return
+        self._stop_event.clear()
+        thread = threading.Thread(target=self._flush_loop, name="progress-relay")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def update(self, task_id, target, message):
+        """Relay an update now, or hold it back if the task's last one went out too recently"""
+        now = time.time()
+        with self.lock:
+            progress = self.tasks.get(task_id)
+            if progress is None:
+                progress = self.tasks[task_id] = TaskProgress()
+            progress.last_seen = now
+            if now - progress.last_sent < self.interval:
+                if progress.pending is not None:
+                    self.metrics.increment('progress_coalesced')
+                progress.pending = (message, target)
+                return
+            progress.last_sent = now
+            progress.pending = None
+        self.send(message, target)
+        self.metrics.increment('progress_relayed')
+
+    def finish(self, task_id):
+        """Forget a task whose result has arrived; held-back progress is dropped"""
+        with self.lock:
+            progress = self.tasks.pop(task_id, None)
+        if progress is not None and progress.pending is not None:
+            self.metrics.increment('progress_coalesced')
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.interval / 2):
+            self.flush()
+
+    def flush(self):
+        """Send the held-back updates whose interval has passed"""
+        now = time.time()
+        due = []
+        with self.lock:
+            for task_id, progress in list(self.tasks.items()):
+                if progress.pending is not None and now - progress.last_sent >= self.interval:
+                    due.append(progress.pending)
+                    progress.pending = None
+                    progress.last_sent = now
+                elif progress.pending is None and now - progress.last_seen > PROGRESS_IDLE:
+                    # The worker went away without a result; don't keep the entry forever
+                    del self.tasks[task_id]
+        for message, target in due:
+            self.send(message, target)
+            self.metrics.increment('progress_relayed')
@@ -0,0 +1,82 @@
+import time
+
+# 'all' applies to every message a client sends, on top of its category's limit
+CATEGORIES = ('broadcast', 'direct', 'task', 'all')
+
+
+class TokenBucket:
+    """Allows `rate` messages per second on average and bursts of up to `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take a token and return how long to wait before it may be used (0 if at once).
+
+        The token is taken even when the bucket is empty, going into debt,
+        so a caller that waits the returned time is never overtaken.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+def parse_limit(text):
+    """Parse "task=2:5" (2 per second, bursts of 5) into ('task', 2.0, 5.0); the burst defaults to the rate"""
+    category, _, value = text.partition('=')
+    category = category.strip()
+    if category not in CATEGORIES:
+        raise ValueError(f"Unknown rate limit category: {category}")
+    rate, _, burst = value.partition(':')
+    rate = float(rate)
+    burst = float(burst) if burst else max(rate, 1.0)
+    if rate <= 0 or burst < 1:
+        raise ValueError("A rate limit needs a positive rate and a burst of at least 1")
+    return category, rate, burst
+
+
+def message_category(message):
+    """Rate limit category of a client message, or None for messages that are not limited"""
+    message_type = message.get('type')
+    if message_type in ('broadcast', 'publish'):
+        return 'broadcast'
+    if message_type == 'direct':
+        # Task results are direct messages too, but they answer work the server handed out
+        if 'task_data' in message:
+            return 'task'
+        if 'task_result' not in message:
+            return 'direct'
+    return None
+
+
+class ClientRateLimiter:
+    """The token buckets of one client connection.
+
+    Used only by the thread that reads the client's socket, so it needs no
+    lock. delay() tells that thread how long to pause before handling a
+    message; while it sleeps nothing is read, the socket buffers fill up,
+    and TCP flow control slows the sender down without losing anything.
+    """
+
+    def __init__(self, limits):
+        self.buckets = {category: TokenBucket(rate, burst) for category, (rate, burst) in limits.items()}
+
+    def delay(self, message):
+        """Seconds to wait before handling the message, and the category that imposed it"""
+        category = message_category(message)
+        wait = 0.0
+        limited_by = None
+        for name in (category, 'all'):
+            bucket = self.buckets.get(name) if name else None
+            if bucket is not None:
+                bucket_wait = bucket.take()
+                if bucket_wait > wait:
+                    wait, limited_by = bucket_wait, name
+        return wait, limited_by
@@ -0,0 +1,317 @@
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from db_manager import DatabaseManager
+
+MANIFEST = 'manifest.json'
+CHUNK_SIZE = 1000  # Rows moved per transaction; the database lock is held for one chunk at a time
+SEGMENT_ROWS = 100000  # Rows per archive segment before a new file is started
+VACUUM_PAGES = 200  # Free pages returned to the file system after each chunk
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(text):
+    """Parse "90", "15m", "12h" or "30d" into seconds"""
+    text = str(text).strip()
+    if text and text[-1] in DURATION_UNITS:
+        return float(text[:-1]) * DURATION_UNITS[text[-1]]
+    return float(text)
+
+
+class RetentionPolicy:
+    """Which messages stay in the live table.
+
+    A message matching `message_types` (all types if None) is archived once
+    it is older than `max_age` seconds, or once more than `max_count` newer
+    messages of those types exist.
+    """
+
+    def __init__(self, max_age=None, max_count=None, message_types=None):
+        if max_age is None and max_count is None:
+            raise ValueError("A retention policy needs max_age, max_count or both")
+        self.max_age = max_age
+        self.max_count = max_count
+        self.message_types = list(message_types) if message_types else None
+
+    @classmethod
+    def parse(cls, text):
+        """Parse "max_age=30d,max_count=100000,types=broadcast+system" """
+        options = {}
+        for part in text.split(','):
+            key, _, value = part.partition('=')
+            key = key.strip()
+            if key == 'max_age':
+                options['max_age'] = parse_duration(value)
+            elif key == 'max_count':
+                options['max_count'] = int(value)
+            elif key == 'types':
+                options['message_types'] = [t for t in value.split('+') if t]
+            else:
+                raise ValueError(f"Unknown retention option: {key}")
+        return cls(**options)
+
+    def type_filter(self):
+        """SQL condition and parameters that restrict a query to the policy's types"""
+        if not self.message_types:
+            return "", []
+        placeholders = ', '.join('?' for _ in self.message_types)
+        return f" AND message_type IN ({placeholders})", list(self.message_types)
+
+    def __repr__(self):
+        return f"RetentionPolicy(max_age={self.max_age}, max_count={self.max_count}, types={self.message_types})"
+
+
+class MessageArchiver:
+    """Moves messages out of the live table into compressed archive segments.
+
+    Rows are copied to gzip-compressed JSON-lines segments in `archive_dir`,
+    deleted from the database and their pages released with an incremental
+    vacuum, one small chunk at a time so the server is never blocked for
+    long. A manifest lists each segment with its id and time range, which
+    lets query_archive read only the segments a query needs.
+    """
+
+    def __init__(self, db, archive_dir, policies, chunk_size=CHUNK_SIZE, pause=0.05):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.policies = list(policies)
+        self.chunk_size = chunk_size
+        self.pause = pause  # Seconds between chunks, leaving the lock to the server
+        self.manifest_lock = threading.Lock()
+        self.archived = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def start(self, interval=60):
+        """Apply the policies every `interval` seconds in a background thread"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run_loop, args=(interval,), name="archiver")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run_loop(self, interval):
+        while not self._stop_event.is_set():
+            try:
+                moved = self.run_once()
+                if moved:
+                    print(f"Archived {moved} messages to {self.archive_dir}")
+            except (sqlite3.Error, OSError) as e:
+                print(f"Archiving failed: {e}")
+            self._stop_event.wait(interval)
+
+    def run_once(self):
+        """Apply every policy once; returns the number of messages archived"""
+        moved = 0
+        for policy in self.policies:
+            cutoff_id = self.cutoff_id(policy)
+            before = time.time() - policy.max_age if policy.max_age is not None else None
+            if cutoff_id or before is not None:
+                moved += self.archive_matching(policy, cutoff_id, before)
+        return moved
+
+    def connect(self):
+        return sqlite3.connect(self.db.db_path)
+
+    def cutoff_id(self, policy):
+        """Highest message id beyond the policy's max_count newest messages (0 if none)"""
+        if policy.max_count is None:
+            return 0
+        type_condition, type_params = policy.type_filter()
+        with self.db.lock:
+            conn = self.connect()
+            try:
+                row = conn.execute(
+                    f"SELECT id FROM messages WHERE 1 = 1{type_condition} ORDER BY id DESC LIMIT 1 OFFSET ?",
+                    type_params + [policy.max_count]
+                ).fetchone()
+            finally:
+                conn.close()
+        return row[0] if row else 0
+
+    def archive_matching(self, policy, cutoff_id, before=None):
+        """Archive the policy's messages with id <= cutoff_id or timestamp < before, chunk by chunk.
+
+        Ages are compared on the timestamp itself: imported rows and batched
+        presence events carry older times than their ids suggest, so an id
+        range cannot stand in for a time range.
+        """
+        type_condition, type_params = policy.type_filter()
+        age_condition, age_params = (" OR timestamp < ?", [before]) if before is not None else ("", [])
+        last_id = 0
+        moved = 0
+        while not self._stop_event.is_set():
+            with self.db.lock:
+                conn = self.connect()
+                try:
+                    rows = conn.execute(
+                        f"""
+                        SELECT id, message_type, sender, target, content, timestamp FROM messages
+                        WHERE id > ? AND (id <= ?{age_condition}){type_condition} ORDER BY id LIMIT ?
+                        """,
+                        [last_id, cutoff_id] + age_params + type_params + [self.chunk_size]
+                    ).fetchall()
+                finally:
+                    conn.close()
+            if not rows:
+                break
+
+            # Messages are never updated, so the copy can be written without the lock
+            self.write_segment(rows)
+
+            with self.db.lock:
+                conn = self.connect()
+                try:
+                    conn.executemany("DELETE FROM messages WHERE id = ?", [(row[0],) for row in rows])
+                    conn.commit()
+                    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                        # executescript steps the pragma to completion; execute() frees a single page
+                        conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES});")
+                finally:
+                    conn.close()
+
+            last_id = rows[-1][0]
+            moved += len(rows)
+            self.archived += len(rows)
+            if self.pause:
+                time.sleep(self.pause)
+        return moved
+
+    def load_manifest(self):
+        path = os.path.join(self.archive_dir, MANIFEST)
+        if not os.path.exists(path):
+            return {'segments': []}
+        with open(path) as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest):
+        path = os.path.join(self.archive_dir, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def write_segment(self, rows):
+        """Append rows to the open segment (a new gzip member) and record them in the manifest"""
+        with self.manifest_lock:
+            manifest = self.load_manifest()
+            segments = manifest['segments']
+            if not segments or segments[-1]['count'] + len(rows) > SEGMENT_ROWS:
+                segments.append({
+                    'file': f"messages-{rows[0][0]:012d}.jsonl.gz",
+                    'first_id': rows[0][0],
+                    'last_id': rows[0][0],
+                    'first_timestamp': rows[0][5],
+                    'last_timestamp': rows[0][5],
+                    'count': 0
+                })
+            segment = segments[-1]
+
+            with gzip.open(os.path.join(self.archive_dir, segment['file']), 'at', encoding='utf-8') as f:
+                for message_id, message_type, sender, target, content, timestamp in rows:
+                    f.write(json.dumps({
+                        'id': message_id,
+                        'type': message_type,
+                        'sender': sender,
+                        'target': target,
+                        'content': content,
+                        'timestamp': timestamp
+                    }) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            # Several policies may archive into the same segment, so ranges only widen
+            segment['first_id'] = min(segment['first_id'], rows[0][0])
+            segment['last_id'] = max(segment['last_id'], rows[-1][0])
+            segment['first_timestamp'] = min(segment['first_timestamp'], min(row[5] for row in rows))
+            segment['last_timestamp'] = max(segment['last_timestamp'], max(row[5] for row in rows))
+            segment['count'] += len(rows)
+            self.save_manifest(manifest)
+
+    def query_archive(self, start_time=None, end_time=None, message_type=None, sender=None, target=None):
+        """Yield archived messages in the time range, reading only the overlapping segments.
+
+        A crash between writing a segment and deleting the rows can archive a
+        message twice; such duplicates are skipped.
+        """
+        with self.manifest_lock:
+            segments = list(self.load_manifest()['segments'])
+
+        seen = set()
+        for segment in segments:
+            if start_time is not None and segment['last_timestamp'] < start_time:
+                continue
+            if end_time is not None and segment['first_timestamp'] > end_time:
+                continue
+            with gzip.open(os.path.join(self.archive_dir, segment['file']), 'rt', encoding='utf-8') as f:
+                for line in f:
+                    message = json.loads(line)
+                    if start_time is not None and message['timestamp'] < start_time:
+                        continue
+                    if end_time is not None and message['timestamp'] > end_time:
+                        continue
+                    if message_type is not None and message['type'] != message_type:
+                        continue
+                    if sender is not None and message['sender'] != sender:
+                        continue
+                    if target is not None and message['target'] != target:
+                        continue
+                    if message['id'] in seen:
+                        continue
+                    seen.add(message['id'])
+                    yield message
+
+
+def enable_incremental_vacuum(db_path):
+    """Switch an existing database to incremental auto-vacuum (rewrites the file once)"""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old messages and query the archive")
+    parser.add_argument('--db', default='distributed_system.db', help="SQLite database path")
+    parser.add_argument('--archive-dir', default='archive', help="Directory for archive segments")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    archive = subparsers.add_parser('archive', help="Apply retention policies once")
+    archive.add_argument('--retention', action='append', required=True, metavar='POLICY',
+                         help="e.g. max_age=30d or max_count=100000,types=system (repeatable)")
+    archive.add_argument('--enable-incremental-vacuum', action='store_true',
+                         help="Convert the database to incremental auto-vacuum first (one full VACUUM)")
+
+    query = subparsers.add_parser('query', help="Print archived messages as JSON lines")
+    query.add_argument('--since', type=float, help="Start timestamp (seconds since the epoch)")
+    query.add_argument('--until', type=float, help="End timestamp (seconds since the epoch)")
+    query.add_argument('--type', help="Message type")
+    query.add_argument('--sender')
+    query.add_argument('--target')
+    args = parser.parse_args()
+
+    if args.command == 'archive':
+        if args.enable_incremental_vacuum:
+            enable_incremental_vacuum(args.db)
+        policies = [RetentionPolicy.parse(text) for text in args.retention]
+        archiver = MessageArchiver(DatabaseManager(args.db, task_cache_size=0), args.archive_dir, policies, pause=0)
+        print(f"Archived {archiver.run_once()} messages to {args.archive_dir}")
+    else:
+        archiver = MessageArchiver(None, args.archive_dir, [])
+        for message in archiver.query_archive(args.since, args.until, args.type, args.sender, args.target):
+            print(json.dumps(message))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,489 @@
+import heapq
+import itertools
+import math
+import random
+import threading
+import time
+from collections import deque
+
+PRIORITIES = ('high', 'normal', 'low')  # Highest first
+DEFAULT_PRIORITY = 'normal'
+PRIORITY_WEIGHTS = {'high': 4, 'normal': 2, 'low': 1}  # Dispatch shares while every class has work queued
+WORKER_SLOTS = 1  # Tasks sent to a worker before it reports a result; DistributedTaskWorker runs one
+SWEEP_INTERVAL = 1.0  # Seconds between scans for queued tasks whose deadline passed
+HEDGE_PERCENTILE = 95  # Hedge a task once it has run longer than this percentile of recent ones
+HEDGE_WINDOW = 100  # Recent completion times kept per hedged task type
+HEDGE_MIN_SAMPLES = 20  # Completions of a type seen before its tasks are hedged
+HEDGE_CHECK_INTERVAL = 0.1  # Seconds between scans for stragglers while hedging is on
+HEDGE_TIMEOUT = 30.0  # Seconds a hedged copy may hold its worker before it is given up
+
+
+def parse_priority(value):
+    """Priority class of a submission: a class name or its index (0 = high); the default otherwise"""
+    if isinstance(value, int) and not isinstance(value, bool) and 0 <= value < len(PRIORITIES):
+        return PRIORITIES[value]
+    if isinstance(value, str) and value.lower() in PRIORITIES:
+        return value.lower()
+    return DEFAULT_PRIORITY
+
+
+def parse_deadline(value):
+    """Absolute deadline of a submission (seconds since the epoch), or None"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+        return float(value)
+    return None
+
+
+def parse_weights(text):
+    """Parse "high=8,normal=2,low=1"; classes left out keep their default weight"""
+    weights = dict(PRIORITY_WEIGHTS)
+    for part in text.split(','):
+        name, _, value = part.partition('=')
+        name = name.strip()
+        if name not in PRIORITIES:
+            raise ValueError(f"Unknown priority class: {name}")
+        weights[name] = int(value)
+        if weights[name] < 1:
+            raise ValueError("Priority weights must be at least 1")
+    return weights
+
+
+class QueuedTask:
+    """A task message waiting for, or running on, its worker"""
+
+    sequence = itertools.count()
+
+    def __init__(self, task_id, worker, priority, message, deadline=None):
+        self.task_id = task_id
+        self.worker = worker
+        self.priority = priority
+        self.message = message
+        self.deadline = deadline  # Absolute time after which the task is not worth starting
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.hedge = None  # The Hedge this task is a copy in, once it has been hedged
+        # Earliest deadline first, tasks without one after those with one, ties in arrival order
+        self.key = (deadline if deadline is not None else math.inf, next(self.sequence))
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def expired(self, now):
+        return self.deadline is not None and self.deadline <= now
+
+    @property
+    def task_type(self):
+        return (self.message.get('task_data') or {}).get('task_type')
+
+
+class Hedge:
+    """Copies of one task running on different workers; the first result wins"""
+
+    def __init__(self, primary):
+        self.primary = primary
+        self.copies = [primary]  # Copies still running
+        self.winner = None
+
+
+class WorkerQueue:
+    """The per-priority queues of one worker and the tasks it is running.
+
+    Each queue is a heap ordered by deadline, so within a class the task
+    that must start soonest goes first; a task put back keeps its place.
+    """
+
+    def __init__(self):
+        self.queues = {priority: [] for priority in PRIORITIES}
+        self.credit = {priority: 0 for priority in PRIORITIES}
+        self.running = {}  # task_id -> QueuedTask
+
+    def pop(self, weights):
+        """Next task by smooth weighted round-robin over the classes that have work.
+
+        Each such class earns its weight in credit, the one with the most
+        credit is served and pays back the sum. While all classes are busy
+        they are served in proportion to their weights, interleaved rather
+        than in bursts, so low-priority work keeps moving.
+        """
+        ready = [priority for priority in PRIORITIES if self.queues[priority]]
+        if not ready:
+            return None
+        for priority in ready:
+            self.credit[priority] += weights[priority]
+        # max() keeps the first of equals, so ties go to the higher class
+        chosen = max(ready, key=lambda priority: self.credit[priority])
+        self.credit[chosen] -= sum(weights[priority] for priority in ready)
+        task = heapq.heappop(self.queues[chosen])
+        if not self.queues[chosen]:
+            # Credit is only meaningful while a class competes
+            self.credit[chosen] = 0
+        return task
+
+    def push(self, task):
+        heapq.heappush(self.queues[task.priority], task)
+
+    def remove_expired(self, now):
+        """Take the tasks whose deadline has passed out of the queues"""
+        expired = []
+        for priority, queue in self.queues.items():
+            if any(task.expired(now) for task in queue):
+                expired += [task for task in queue if task.expired(now)]
+                queue[:] = [task for task in queue if not task.expired(now)]
+                heapq.heapify(queue)
+        return expired
+
+
+class TaskScheduler:
+    """Holds the tasks for local workers and hands them out as the workers free up.
+
+    Submissions used to be forwarded on arrival, and a busy worker simply
+    ignored them. Now each worker gets at most `slots` tasks at a time; the
+    rest wait in per-priority queues and are dispatched by weighted
+    round-robin when a result comes back, earliest deadline first within a
+    class. Tasks whose deadline passes before they start are handed to
+    on_expire instead of a worker. Waiting and running times are recorded
+    per priority in the server metrics.
+
+    Task types listed in hedge_types (they must be idempotent) are hedged:
+    once such a task has run longer than hedge_percentile of the recent
+    completion times of its type, a copy goes to an idle worker. The first
+    result to come back is delivered and the other copy is cancelled; its
+    worker's slot is free at once, and a result it still sends is dropped.
+    A copy that has not answered within HEDGE_TIMEOUT is given up the same way.
+    """
+
+    def __init__(self, send, metrics, weights=None, slots=WORKER_SLOTS, on_expire=None,
+                 hedge_types=None, hedge_percentile=HEDGE_PERCENTILE, connected_workers=None):
+        self.send = send  # send(message, worker) -> False if the worker is not connected
+        self.on_expire = on_expire  # on_expire(task) for tasks that missed their deadline in the queue
+        self.metrics = metrics
+        self.weights = dict(weights or PRIORITY_WEIGHTS)
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.workers = {}  # Worker name -> WorkerQueue
+        self._stop_event = threading.Event()
+        self.hedge_types = set(hedge_types or ())
+        self.hedge_percentile = hedge_percentile
+        self.connected_workers = connected_workers  # connected_workers() -> names of the local workers
+        self.durations = {}  # Hedged task type -> recent completion times
+        self.hedge_stats = {}  # Hedged task type -> {'completed', 'hedged', 'won'}
+        self.abandoned = {}  # (worker, task_id) of cancelled copies -> when they were given up
+
+    def start(self, interval=SWEEP_INTERVAL):
+        """Expire overdue queued tasks every `interval` seconds, also for workers that are away"""
+        if self.hedge_types:
+            # Stragglers are worth catching well within a second
+            interval = min(interval, HEDGE_CHECK_INTERVAL)
+        self._stop_event.clear()
+        thread = threading.Thread(target=self._sweep_loop, args=(interval,), name="task-sweeper")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _sweep_loop(self, interval):
+        while not self._stop_event.wait(interval):
+            self.expire_overdue()
+            self.expire_hedges()
+            self.hedge_stragglers()
+
+    def expire_overdue(self):
+        """Drop every queued task whose deadline has passed; returns how many"""
+        now = time.time()
+        with self.lock:
+            expired = []
+            for queue in self.workers.values():
+                expired += queue.remove_expired(now)
+        for task in expired:
+            self.expire(task)
+        return len(expired)
+
+    def expire(self, task):
+        self.metrics.increment(f"tasks_expired.{task.priority}")
+        if self.on_expire is not None:
+            self.on_expire(task)
+
+    def submit(self, task_id, worker, priority, message, deadline=None):
+        """Queue a task for a worker and dispatch it right away if the worker is free"""
+        task = QueuedTask(task_id, worker, priority, message, deadline)
+        with self.lock:
+            queue = self.workers.get(worker)
+            if queue is None:
+                queue = self.workers[worker] = WorkerQueue()
+            queue.push(task)
+        self.metrics.increment(f"tasks_submitted.{priority}")
+        self.dispatch(worker)
+
+    def claim(self, worker, task_id):
+        """Whether the worker's result for a task goes to the requester: False once a hedged copy has answered"""
+        with self.lock:
+            if (worker, task_id) in self.abandoned:
+                return False
+            queue = self.workers.get(worker)
+            task = queue.running.get(task_id) if queue is not None else None
+            if task is None or task.hedge is None:
+                return True
+            if task.hedge.winner is None:
+                task.hedge.winner = task
+            return task.hedge.winner is task
+
+    def complete(self, worker, task_id):
+        """Free the worker's slot once it reports a result; returns the task, None if unknown or a losing copy"""
+        now = time.time()
+        losers = []
+        with self.lock:
+            if self.abandoned.pop((worker, task_id), None) is not None:
+                # A copy given up earlier; its slot is already free
+                return None
+            queue = self.workers.get(worker)
+            task = queue.running.pop(task_id, None) if queue is not None else None
+            if task is None:
+                return None
+            hedge = task.hedge
+            if hedge is not None:
+                hedge.copies.remove(task)
+                if hedge.winner is None:
+                    hedge.winner = task
+                if hedge.winner is task:
+                    losers = list(hedge.copies)
+                    for loser in losers:
+                        self._abandon(loser, now)
+            if hedge is None or hedge.winner is task:
+                self._record_completion(task, now)
+
+        if hedge is not None and hedge.winner is not task:
+            # The requester already has the other copy's result; this one was cancelled or too late
+            self.dispatch(worker)
+            return None
+
+        self.metrics.observe(f"task_run.{task.priority}", now - task.started_at)
+        for loser in losers:
+            self.send({'type': 'cancel_task', 'task_id': task_id, 'timestamp': now}, loser.worker)
+            self.dispatch(loser.worker)
+        self.dispatch(worker)
+        return task
+
+    def _abandon(self, task, now):
+        """Free the slot of a copy that is no longer wanted and drop what it sends later; caller holds the lock"""
+        queue = self.workers.get(task.worker)
+        if queue is not None and queue.running.get(task.task_id) is task:
+            del queue.running[task.task_id]
+        self.abandoned[(task.worker, task.task_id)] = now
+
+    def expire_hedges(self):
+        """Give up hedged copies that have not answered within HEDGE_TIMEOUT; returns how many"""
+        now = time.time()
+        given_up = []
+        with self.lock:
+            for key, since in list(self.abandoned.items()):
+                # Long enough for any late result of a cancelled copy
+                if now - since > HEDGE_TIMEOUT:
+                    del self.abandoned[key]
+            for queue in self.workers.values():
+                for task in queue.running.values():
+                    hedge = task.hedge
+                    if hedge is not None and task is not hedge.primary and now - task.started_at > HEDGE_TIMEOUT:
+                        given_up.append(task)
+            for task in given_up:
+                self._abandon(task, now)
+                task.hedge.copies.remove(task)
+                if len(task.hedge.copies) == 1 and task.hedge.winner is None:
+                    task.hedge.copies[0].hedge = None
+
+        # Sent without our lock; send() takes the server lock
+        for task in given_up:
+            self.send({'type': 'cancel_task', 'task_id': task.task_id, 'timestamp': now}, task.worker)
+            self.dispatch(task.worker)
+        return len(given_up)
+
+    def _record_completion(self, task, now):
+        """Keep the completion time of a hedged type and count how its hedges fared; caller holds the lock"""
+        task_type = task.task_type
+        if task_type not in self.hedge_types:
+            return
+        hedge = task.hedge
+        primary = hedge.primary if hedge is not None else task
+        samples = self.durations.get(task_type)
+        if samples is None:
+            samples = self.durations[task_type] = deque(maxlen=HEDGE_WINDOW)
+        stats = self.hedge_stats.get(task_type)
+        if stats is None:
+            stats = self.hedge_stats[task_type] = {'completed': 0, 'hedged': 0, 'won': 0}
+        elapsed = now - primary.started_at
+        stats['completed'] += 1
+        if hedge is not None and task is not primary:
+            # The copy won. Estimate when the primary would have finished from the
+            # recent tasks that ran at least as long as it already had
+            stats['won'] += 1
+            longer = [duration for duration in samples if duration > elapsed]
+            expected = sum(longer) / len(longer) if longer else elapsed
+            self.metrics.observe(f"hedge_latency_saved.{task_type}", expected - elapsed)
+        samples.append(elapsed)
+
+    def hedge_threshold(self, task_type):
+        """Running time after which a task of the type is hedged, None while there is too little history"""
+        samples = self.durations.get(task_type)
+        if samples is None or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    def hedge_stragglers(self):
+        """Start a copy of each hedgeable task that runs unusually long on an idle worker; returns how many"""
+        if not self.hedge_types or self.connected_workers is None:
+            return 0
+        connected = self.connected_workers()
+        now = time.time()
+        launched = []
+        with self.lock:
+            idle = [worker for worker in connected
+                    if worker not in self.workers
+                    or not (self.workers[worker].running or any(self.workers[worker].queues.values()))]
+            random.shuffle(idle)
+            thresholds = {task_type: self.hedge_threshold(task_type) for task_type in self.hedge_types}
+            for queue in list(self.workers.values()):
+                for task in list(queue.running.values()):
+                    if not idle:
+                        break
+                    threshold = thresholds.get(task.task_type)
+                    if (threshold is None or task.hedge is not None or task.expired(now)
+                            or now - task.started_at <= threshold):
+                        continue
+                    worker = idle.pop()
+                    # Addressed to its own worker; the rest of the submission stays as it was
+                    copy = QueuedTask(task.task_id, worker, task.priority, dict(task.message, target=worker),
+                                      task.deadline)
+                    copy.started_at = now
+                    task.hedge = copy.hedge = Hedge(task)
+                    task.hedge.copies.append(copy)
+                    copy_queue = self.workers.get(copy.worker)
+                    if copy_queue is None:
+                        copy_queue = self.workers[copy.worker] = WorkerQueue()
+                    copy_queue.running[copy.task_id] = copy
+                    launched.append(copy)
+
+        # Sent without our lock; send() takes the server lock
+        for copy in launched:
+            if self.send(copy.message, copy.worker):
+                with self.lock:
+                    self.hedge_stats[copy.task_type]['hedged'] += 1
+                continue
+            with self.lock:
+                # The worker left meanwhile; the task may be hedged again on the next scan
+                queue = self.workers.get(copy.worker)
+                if queue is not None and queue.running.get(copy.task_id) is copy:
+                    del queue.running[copy.task_id]
+                if copy in copy.hedge.copies:
+                    copy.hedge.copies.remove(copy)
+                if len(copy.hedge.copies) == 1 and copy.hedge.winner is None:
+                    copy.hedge.copies[0].hedge = None
+        return len(launched)
+
+    def hedge_rates(self):
+        """Per hedged task type: completions, hedges started, hedges that won, and the hedge rate"""
+        with self.lock:
+            return {task_type: dict(stats, rate=stats['hedged'] / stats['completed'] if stats['completed'] else 0.0)
+                    for task_type, stats in self.hedge_stats.items()}
+
+    def worker_disconnected(self, worker):
+        """Put what a departed worker was running back at the front of its queues"""
+        with self.lock:
+            for key in [key for key in self.abandoned if key[0] == worker]:
+                del self.abandoned[key]
+            queue = self.workers.get(worker)
+            if queue is None:
+                return
+            for task in queue.running.values():
+                hedge = task.hedge
+                if hedge is not None:
+                    hedge.copies.remove(task)
+                    if hedge.copies or hedge.winner is not None:
+                        # Another copy is still running, or the requester already has a result
+                        if len(hedge.copies) == 1 and hedge.winner is None:
+                            hedge.copies[0].hedge = None
+                        continue
+                    task.hedge = None
+                queue.push(task)
+            queue.running.clear()
+
+    def dispatch(self, worker):
+        """Send queued tasks to the worker while it has free slots"""
+        while True:
+            with self.lock:
+                queue = self.workers.get(worker)
+                if queue is None or len(queue.running) >= self.slots:
+                    return
+                task = queue.pop(self.weights)
+                if task is None:
+                    if not queue.running:
+                        del self.workers[worker]
+                    return
+                task.started_at = time.time()
+                if not task.expired(task.started_at):
+                    queue.running[task.task_id] = task
+
+            if task.expired(task.started_at):
+                # Too late to be of use; don't spend the worker on it
+                self.expire(task)
+                continue
+
+            # Sent without our lock; send() takes the server lock
+            if not self.send(task.message, worker):
+                # Not connected (any more); keep the task until the worker registers again
+                with self.lock:
+                    queue = self.workers.get(worker)
+                    if queue is None:
+                        queue = self.workers[worker] = WorkerQueue()
+                    queue.running.pop(task.task_id, None)
+                    queue.push(task)
+                return
+
+            self.metrics.observe(f"task_wait.{task.priority}", task.started_at - task.enqueued_at)
+            self.metrics.increment(f"tasks_dispatched.{task.priority}")
+
+    def cancel(self, task_id):
+        """Take a queued task out of its queue.
+
+        Returns ('queued', task) if it had not been dispatched yet,
+        ('running', copies) with the copies running on workers, who have to
+        be told to stop, or (None, None) if the task is not here.
+        """
+        with self.lock:
+            running = []
+            for queue in self.workers.values():
+                for tasks in queue.queues.values():
+                    for task in tasks:
+                        if task.task_id == task_id:
+                            tasks.remove(task)
+                            heapq.heapify(tasks)
+                            return 'queued', task
+                if task_id in queue.running:
+                    running.append(queue.running[task_id])
+        if running:
+            return 'running', running
+        return None, None
+
+    def least_loaded(self, workers):
+        """The worker with the fewest tasks running or queued, None if there are no workers"""
+        def load(worker):
+            queue = self.workers.get(worker)
+            if queue is None:
+                return 0
+            return len(queue.running) + sum(len(tasks) for tasks in queue.queues.values())
+
+        with self.lock:
+            return min(workers, key=load, default=None)
+
+    def depths(self):
+        """Queued (not yet dispatched) tasks per priority class, over all workers"""
+        with self.lock:
+            depths = {priority: 0 for priority in PRIORITIES}
+            for queue in self.workers.values():
+                for priority in PRIORITIES:
+                    depths[priority] += len(queue.queues[priority])
+            return depths
+
+    def running_count(self):
+        with self.lock:
+            return sum(len(queue.running) for queue in self.workers.values())
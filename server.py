@@ -2,33 +2,177 @@ import socket
 import threading
 import json
 import time
-from db_manager import DatabaseManager
+import argparse
+from collections import deque
+import hmac
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import uuid
+from db_manager import DatabaseManager, TASK_CACHE_SIZE
+from federation import Federation
+from metrics import ServerMetrics
+from rate_limit import ClientRateLimiter, parse_limit
+from profiler import SamplingProfiler, install_signal_toggle
+from progress import PROGRESS_INTERVAL, ProgressRelay
+from retention import MessageArchiver, RetentionPolicy
+from scheduler import HEDGE_PERCENTILE, TaskScheduler, parse_deadline, parse_priority, parse_weights
+from workflow import WorkflowEngine
+
+DEFAULT_CHANNEL = 'general'  # Channel that plain 'broadcast' messages go to
+PRESENCE_LOG_SIZE = 1024  # Presence deltas kept for clients that ask for changes since a version
+PRESENCE_SUMMARY_NAMES = 10  # Names spelled out in a batched join/leave notification
+HISTORY_SIZE = 200  # Recent messages kept in memory per channel and per direct-message recipient
+HISTORY_PAGE_MAX = 500  # Largest page a history request may ask for
+QUERY_PAGE_SIZE = 100  # Rows per frame of a task_query or history_query response
+QUERY_LIMIT_MAX = 10000  # Most rows one query may return; continue with its cursor
+LISTEN_BACKLOG = 128  # Connections the kernel queues before accept()
+MAX_HANDLERS = 512  # Connection handler threads running at once
+REJECT_RETRY_AFTER = 1.0  # Seconds a rejected client is told to wait before retrying
+CLIENT_TYPES = ('worker', 'task_client', 'regular')
+SEARCH_PAGE_MAX = 100  # Most hits in one page of search results
+OUTBOX_TTL = 24 * 3600  # Seconds a direct message or task result waits for an offline recipient
 
 class DistributedServer:
-    def __init__(self, host='localhost', port=5000):
+    def __init__(self, host='localhost', port=5000, db_path='distributed_system.db',
+                 admin_token=None, profile_dir='.', node_id=None, peers=(), advertise_host=None,
+                 reuse_port=False, ipc_path=None, persist_remote=True, presence_window=0.1,
+                 history_size=HISTORY_SIZE, task_cache_size=TASK_CACHE_SIZE,
+                 retention_policies=(), archive_dir='archive', retention_interval=60,
+                 message_store='sqlite', message_log_dir=None, message_log_fsync=False,
+                 priority_weights=None, rate_limits=None,
+                 backlog=LISTEN_BACKLOG, max_handlers=MAX_HANDLERS, session_quotas=None,
+                 hedge_types=None, hedge_percentile=HEDGE_PERCENTILE, progress_interval=PROGRESS_INTERVAL,
+                 outbox_ttl=OUTBOX_TTL, peer_token=None):
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Several processes accept on the same port; the kernel spreads connections
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.ipc_path = ipc_path  # Unix socket where sibling processes connect as peers
+        self.ipc_socket = None
         self.clients = {}  # Dictionary to store client connections
         self.client_names = {}  # Dictionary to map client addresses to names
+        self.subscriptions = {}  # Channel name -> set of subscribed client addresses
+        self.client_channels = {}  # Client address -> set of channels it subscribed to
+        # Versioned presence: snapshots carry a version, later changes are sent as deltas
+        self.presence_version = 0
+        self.presence_epoch = f"{os.getpid()}-{int(time.time() * 1000)}"  # Changes on restart
+        self.presence_log = deque(maxlen=PRESENCE_LOG_SIZE)  # (version, added, removed)
+        self.presence_watchers = set()  # Client addresses that receive presence deltas
+        # Joins and leaves within the window are announced and persisted as one batch
+        self.presence_window = presence_window
+        self.presence_events = []  # (event, name, client_type, timestamp) not yet announced
+        self.presence_timer = None
+        self.presence_lock = threading.Lock()  # Guards presence_events and presence_timer
+        self.presence_flush_lock = threading.Lock()  # Keeps batches in order
         self.lock = threading.Lock()  # Lock for thread-safe operations
-        self.db = DatabaseManager()  # Database manager for persistence
+        self.db = DatabaseManager(db_path, task_cache_size=task_cache_size,  # Database manager for persistence
+                                  message_store=message_store, message_log_dir=message_log_dir,
+                                  message_log_fsync=message_log_fsync)
+        # Ring buffers of recent messages: ('channel', name) or ('direct', recipient) -> deque
+        self.history_size = history_size
+        self.history = {}
+        self.history_floors = {}  # Key -> highest message id evicted from its ring
+        self.history_start_id = self.db.get_last_message_id()  # Older ids are only on disk
+        self.history_lock = threading.Lock()
+        # Old messages move to compressed archive segments in the background
+        self.archiver = None
+        self.retention_interval = retention_interval
+        if retention_policies:
+            self.archiver = MessageArchiver(self.db, archive_dir, retention_policies)
+        # Counters and timings reported by the 'stats' request
+        self.metrics = ServerMetrics()
+        # Tasks for local workers wait here, per priority, until the worker is free
+        # Stragglers of the idempotent task types in hedge_types get a copy on an idle worker
+        self.scheduler = TaskScheduler(self.send_direct_message, self.metrics, weights=priority_weights,
+                                       on_expire=self.expire_task, hedge_types=hedge_types,
+                                       hedge_percentile=hedge_percentile, connected_workers=self.local_worker_names)
+        self.metrics.register_gauge('task_queue_depth', self.scheduler.depths)
+        self.metrics.register_gauge('tasks_running', self.scheduler.running_count)
+        self.metrics.register_gauge('hedging', self.scheduler.hedge_rates)
+        # Progress reports of running tasks, relayed to the requesters at most every progress_interval
+        self.progress = ProgressRelay(self.relay_progress, self.metrics, interval=progress_interval)
+        # DAGs of tasks run step by step on the local workers
+        self.workflows = WorkflowEngine(self.db, self.scheduler, self.local_worker_names, self.deliver_or_store)
+        # Direct messages and task results for offline clients wait in the database (0 drops them)
+        self.outbox_ttl = outbox_ttl
+        self.outbox_lock = threading.Lock()
+        # Token-bucket limits per client: category -> (messages per second, burst)
+        self.rate_limits = dict(rate_limits or {})
+        # Admission control: a bounded number of handler threads, and sessions per client type
+        self.backlog = backlog
+        self.max_handlers = max_handlers
+        self.handler_slots = threading.BoundedSemaphore(max_handlers)
+        self.session_quotas = dict(session_quotas or {})  # Client type -> most sessions at once
+        self.session_counts = {client_type: 0 for client_type in CLIENT_TYPES}
+        self.metrics.register_gauge('sessions', lambda: dict(self.session_counts))
+        self.running = False
+        self.admin_token = admin_token  # Required for control messages; None disables them
+        self.profiler = SamplingProfiler(output_dir=profile_dir)
+        # Other server nodes this one routes to (empty for a standalone server)
+        advertise_address = (advertise_host or host, port)
+        node_id = node_id or f"{advertise_address[0]}:{advertise_address[1]}"
+        if ipc_path:
+            advertise_address = ('unix', ipc_path)
+        self.federation = Federation(self, node_id, advertise_address, peers, persist_remote=persist_remote,
+                                     peer_token=peer_token)
 
     def start(self):
         """Start the server and listen for connections"""
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(self.backlog)
+        self.running = True
+        if self.outbox_ttl > 0:
+            self.db.purge_outbox()
+        removed = self.db.delete_unused_blobs()
+        if removed:
+            print(f"Removed {removed} unused blobs")
         print(f"Server started on {self.host}:{self.port}")
 
+        # SIGUSR1 starts/stops the profiler without restarting the server
+        install_signal_toggle(self.profiler)
+
+        if self.ipc_path:
+            if os.path.exists(self.ipc_path):
+                os.unlink(self.ipc_path)
+            self.ipc_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.ipc_socket.bind(self.ipc_path)
+            self.ipc_socket.listen(16)
+            ipc_thread = threading.Thread(target=self.accept_ipc)
+            ipc_thread.daemon = True
+            ipc_thread.start()
+
+        self.federation.start()
+        self.scheduler.start()
+        self.progress.start()
+
+        if self.archiver is not None:
+            self.archiver.start(self.retention_interval)
+
         try:
-            while True:
-                client_socket, client_address = self.server_socket.accept()
+            while self.running:
+                try:
+                    client_socket, client_address = self.server_socket.accept()
+                except OSError:
+                    # The listening socket was closed by stop()
+                    if not self.running:
+                        break
+                    raise
                 print(f"New connection from {client_address}")
 
+                # Never more than max_handlers handler threads; beyond that, turn the connection away
+                if not self.handler_slots.acquire(blocking=False):
+                    self.reject(client_socket, 'server_full')
+                    continue
+
                 # Start a new thread to handle the client
                 client_thread = threading.Thread(
-                    target=self.handle_client,
+                    target=self.run_handler,
                     args=(client_socket, client_address)
                 )
                 client_thread.daemon = True
@@ -36,24 +180,105 @@ class DistributedServer:
         except KeyboardInterrupt:
             print("Server shutting down...")
         finally:
+            self.running = False
             self.server_socket.close()
 
+    def stop(self):
+        """Stop accepting new connections"""
+        self.running = False
+        # Announce and persist the joins/leaves still waiting for their window
+        with self.presence_lock:
+            timer = self.presence_timer
+        if timer is not None:
+            timer.cancel()
+        self.flush_presence_events()
+        self.federation.stop()
+        self.scheduler.stop()
+        self.progress.stop()
+        if self.archiver is not None:
+            self.archiver.stop()
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server_socket.close()
+        if self.ipc_socket is not None:
+            self.ipc_socket.close()
+            if os.path.exists(self.ipc_path):
+                os.unlink(self.ipc_path)
+
+    def accept_ipc(self):
+        """Accept peer connections from sibling server processes on the IPC socket"""
+        connection_count = 0
+        while self.running:
+            try:
+                ipc_connection, _ = self.ipc_socket.accept()
+            except OSError:
+                break
+            connection_count += 1
+
+            ipc_thread = threading.Thread(
+                target=self.handle_client,
+                args=(ipc_connection, ('ipc', connection_count))
+            )
+            ipc_thread.daemon = True
+            ipc_thread.start()
+
+    def run_handler(self, client_socket, client_address):
+        """Handle a client in one of the max_handlers handler slots"""
+        try:
+            self.handle_client(client_socket, client_address)
+        finally:
+            self.handler_slots.release()
+
+    def reject(self, client_socket, reason, client_type=None):
+        """Send a rejection frame that tells the client when to retry, then hang up"""
+        self.metrics.increment(f"sessions_rejected.{reason}")
+        try:
+            # Never let a slow client hold up the accept loop
+            client_socket.settimeout(0.5)
+            client_socket.sendall((json.dumps({
+                'type': 'rejected',
+                'reason': reason,
+                'client_type': client_type,
+                'retry_after': REJECT_RETRY_AFTER,
+                'timestamp': time.time()
+            }) + '\n').encode('utf-8'))
+            client_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        client_socket.close()
+
+    def admit_session(self, client_type):
+        """Count a new session of the given type; False if its quota is used up"""
+        with self.lock:
+            quota = self.session_quotas.get(client_type)
+            if quota is not None and self.session_counts[client_type] >= quota:
+                return False
+            self.session_counts[client_type] += 1
+            return True
+
     def handle_client(self, client_socket, client_address):
         """Handle communication with a client"""
         client_name = None
+        session_type = None
         try:
-            # Register the client in memory
-            with self.lock:
-                self.clients[client_address] = client_socket
+            # Messages are newline-delimited JSON documents
+            reader = client_socket.makefile('r', encoding='utf-8')
 
             # First message should be the client's name
-            name_data = client_socket.recv(1024).decode('utf-8')
+            name_data = reader.readline()
             try:
                 name_msg = json.loads(name_data)
+                if name_msg.get('type') == 'peer_hello':
+                    # Another server node; it never joins the client tables.
+                    # Sibling processes on the private IPC socket need no token
+                    self.federation.handle_inbound(client_socket, reader, name_msg,
+                                                   trusted=client_address[0] == 'ipc')
+                    return
+
                 if name_msg.get('type') == 'register':
                     client_name = name_msg.get('name', f"Client-{client_address[1]}")
-                    with self.lock:
-                        self.client_names[client_address] = client_name
 
                     # Determine client type based on name prefix
                     client_type = "regular"
@@ -62,28 +287,62 @@ class DistributedServer:
                     elif client_name.startswith("TaskClient-"):
                         client_type = "task_client"
 
-                    # Register client in database
-                    self.db.register_client(client_name, client_type)
+                    if not self.admit_session(client_type):
+                        self.reject(client_socket, 'quota_exceeded', client_type)
+                        return
+                    session_type = client_type
+
+                # Register the client in memory
+                with self.lock:
+                    self.clients[client_address] = client_socket
+
+                if name_msg.get('type') == 'register':
+                    with self.lock:
+                        self.client_names[client_address] = client_name
+
+                    # Chat clients follow the default channel; workers and task clients opt in
+                    channels = name_msg.get('channels')
+                    if channels is None:
+                        channels = [DEFAULT_CHANNEL] if client_type == "regular" else []
+                    elif isinstance(channels, str):
+                        channels = [channels]
+                    self.subscribe(client_address, channels)
+
+                    # Register in the database and notify all clients, batched with other joins
+                    self.queue_presence_event('joined', client_name, client_type)
+
+                    if client_type == "worker":
+                        # Hand over tasks that were queued while the worker was away
+                        self.scheduler.dispatch(client_name)
 
-                    # Store system message in database
-                    system_message = f"{client_name} joined the system"
-                    self.db.store_message("system", "Server", system_message)
+                    # Send the client list snapshot, then keep the client up to date with deltas.
+                    # Clients that never look at the list (workers) can opt out with presence=False
+                    if name_msg.get('presence', True):
+                        self.send_client_list(client_socket, watch_address=client_address)
 
-                    # Notify all clients about the new client
-                    self.broadcast({
-                        'type': 'system',
-                        'message': system_message,
-                        'timestamp': time.time()
-                    }, exclude=None)
+                    # Optional catch-up: the last N messages of each channel and of the inbox
+                    replay = name_msg.get('history')
+                    if replay:
+                        for channel in sorted(channels):
+                            self.handle_history_request(client_socket, client_address,
+                                                        {'channel': channel, 'limit': replay})
+                        self.handle_history_request(client_socket, client_address,
+                                                    {'direct': True, 'limit': replay})
 
-                    # Send the list of connected clients to the new client
-                    self.send_client_list(client_socket)
+                    # What was sent to the client while it was offline
+                    if self.outbox_ttl > 0:
+                        self.flush_outbox(client_name)
             except json.JSONDecodeError:
                 print(f"Invalid registration message from {client_address}")
+                with self.lock:
+                    self.clients[client_address] = client_socket
+
+            # Each connection gets its own buckets
+            limiter = ClientRateLimiter(self.rate_limits) if self.rate_limits else None
 
             # Handle client messages
             while True:
-                data = client_socket.recv(1024).decode('utf-8')
+                data = reader.readline()
                 if not data:
                     break
 
@@ -91,17 +350,58 @@ class DistributedServer:
                     message = json.loads(data)
                     message_type = message.get('type')
 
+                    if limiter is not None:
+                        wait, limited_by = limiter.delay(message)
+                        if wait > 0:
+                            # Stop reading from this client for a while instead of dropping
+                            # anything; TCP flow control pushes back on the sender
+                            self.metrics.increment(f"throttled.{limited_by}")
+                            self.metrics.observe(f"throttle_delay.{limited_by}", wait)
+                            time.sleep(wait)
+
                     if message_type == 'broadcast':
-                        # Add sender information and broadcast to all clients
+                        # Add sender information and publish to the default channel
                         sender = self.client_names.get(client_address, f"Client-{client_address[1]}")
                         message['sender'] = sender
                         message['timestamp'] = time.time()
 
                         # Store message in database
-                        self.db.store_message("broadcast", sender, message.get('message', ''))
+                        message_id = self.db.store_message("broadcast", sender, message.get('message', ''))
+                        self.remember_message(('channel', DEFAULT_CHANNEL), message_id, message)
+
+                        # Deliver to the subscribers of the default channel
+                        self.publish_all(DEFAULT_CHANNEL, message)
+
+                    elif message_type == 'publish':
+                        # Message to the subscribers of a named channel
+                        channel = message.get('channel') or DEFAULT_CHANNEL
+                        sender = self.client_names.get(client_address, f"Client-{client_address[1]}")
+                        message['channel'] = channel
+                        message['sender'] = sender
+                        message['timestamp'] = time.time()
 
-                        # Broadcast to all clients
-                        self.broadcast(message, exclude=None)
+                        # The channel is stored as the target of the message
+                        message_id = self.db.store_message("publish", sender, message.get('message', ''), channel)
+                        self.remember_message(('channel', channel), message_id, message)
+
+                        self.publish_all(channel, message)
+
+                    elif message_type in ('subscribe', 'unsubscribe'):
+                        # Accept a single 'channel' or a list of 'channels'
+                        channels = message.get('channels') or [message.get('channel')]
+                        channels = [channel for channel in channels if channel]
+                        if message_type == 'subscribe':
+                            self.subscribe(client_address, channels)
+                        else:
+                            self.unsubscribe(client_address, channels)
+
+                        with self.lock:
+                            current = sorted(self.client_channels.get(client_address, ()))
+                        self.send_to_client(client_socket, {
+                            'type': 'subscriptions',
+                            'channels': current,
+                            'timestamp': time.time()
+                        })
 
                     elif message_type == 'direct':
                         # Direct message to a specific client
@@ -110,33 +410,110 @@ class DistributedServer:
                         message['sender'] = sender
                         message['timestamp'] = time.time()
 
-                        # Check if this is a task submission
-                        if 'task_data' in message and 'task_id' in message:
-                            # Store task in database
-                            task_data = message.get('task_data', {})
-                            task_id = message.get('task_id')
-                            task_type = task_data.get('task_type', 'unknown')
-                            params = task_data.get('params', {})
+                        if 'task_result' in message and not self.scheduler.claim(sender, message['task_result'].get('task_id')):
+                            # A hedged copy of the task answered first; drop this result and free the worker
+                            self.scheduler.complete(sender, message['task_result'].get('task_id'))
+                            continue
 
-                            self.db.store_task(task_id, task_type, target, sender, params)
+                        # Results of workflow steps feed later steps; the requester only gets the final result
+                        if not ('task_result' in message and self.workflows.owns(message['task_result'].get('task_id'))):
+                            # Store message (and the task it carries) in database
+                            self.persist_direct(message, sender, target)
 
-                        # Store message in database
-                        self.db.store_message("direct", sender, message.get('message', ''), target)
+                            # Send direct message, possibly through the node that owns the target;
+                            # kept for later if the target is offline
+                            self.deliver_or_store(message, target)
 
-                        # Send direct message
-                        self.send_direct_message(message, target)
+                    elif message_type == 'progress':
+                        # A worker's report on a running task; only the newest reaches the requester
+                        # when reports come faster than the relay interval
+                        target = message.get('target')
+                        message['sender'] = self.client_names.get(client_address, f"Client-{client_address[1]}")
+                        message['timestamp'] = time.time()
+                        self.metrics.increment('progress_received')
+                        if target and message.get('task_id'):
+                            self.progress.update(message['task_id'], target, message)
 
                     elif message_type == 'status':
                         # Send the list of connected clients
                         self.send_client_list(client_socket)
 
+                    elif message_type == 'presence_sync':
+                        # Changes since the version the client already has
+                        self.send_presence_changes(client_socket, message.get('since'), message.get('epoch'))
+
+                    elif message_type == 'history':
+                        # A page of older messages for a channel or for the client's own inbox
+                        self.handle_history_request(client_socket, client_address, message)
+
+                    elif message_type == 'search':
+                        # Full-text search over the message history, best matches first
+                        self.handle_search_request(client_socket, client_address, message)
+
+                    elif message_type in ('task_query', 'history_query'):
+                        # Filtered, paged reads of the task table or the message store
+                        self.handle_query_request(client_socket, client_address, message)
+
+                    elif message_type == 'cancel':
+                        # Stop one of the client's tasks, queued or running
+                        self.handle_cancel_request(client_socket, client_address, message)
+
+                    elif message_type == 'workflow':
+                        # A DAG of tasks the server runs without further round-trips to the client
+                        self.handle_workflow_request(client_socket, client_address, message)
+
+                    elif message_type == 'workflow_status':
+                        # Stored state of one of the client's workflows and of each of its nodes
+                        name = self.client_names.get(client_address, f"Client-{client_address[1]}")
+                        workflow = self.db.get_workflow(message.get('workflow_id'))
+                        if workflow is not None and workflow['requester'] != name:
+                            workflow = None
+                        self.send_to_client(client_socket, {
+                            'type': 'workflow_status',
+                            'workflow_id': message.get('workflow_id'),
+                            'workflow': workflow,
+                            'timestamp': time.time()
+                        })
+
+                    elif message_type == 'stats':
+                        # Queue depths, wait times and other server metrics
+                        reply = self.metrics.snapshot()
+                        reply.update({'type': 'stats', 'timestamp': time.time()})
+                        self.send_to_client(client_socket, reply)
+
+                    elif message_type == 'profile':
+                        # Admin-only control of the sampling profiler
+                        self.handle_profile_request(client_socket, message)
+
                     # Check if this is a task result
                     if 'task_result' in message:
                         task_result = message.get('task_result')
                         task_id = task_result.get('task_id')
+                        # Progress still held back is outdated by the result
+                        self.progress.finish(task_id)
+
+                        # Update task result in database; workers report tasks that reached them too late
+                        # and tasks they stopped on request
+                        status = 'completed'
+                        if task_result.get('expired'):
+                            status = 'expired'
+                        elif task_result.get('cancelled'):
+                            status = 'cancelled'
+                        deadline_missed = self.db.update_task_result(task_id, task_result, status)
 
-                        # Update task result in database
-                        self.db.update_task_result(task_id, task_result)
+                        # The worker is free again; send it the next queued task
+                        task = self.scheduler.complete(self.client_names.get(client_address), task_id)
+                        if task is not None:
+                            if status == 'expired':
+                                self.metrics.increment(f"tasks_expired.{task.priority}")
+                            elif status == 'cancelled':
+                                self.metrics.increment(f"tasks_cancelled.{task.priority}")
+                            elif deadline_missed is not None:
+                                outcome = 'missed' if deadline_missed else 'met'
+                                self.metrics.increment(f"deadline_{outcome}.{task.priority}")
+
+                        # Start the workflow steps that were waiting for this one
+                        self.workflows.task_finished(task_id, task_result)
 
                 except json.JSONDecodeError:
                     print(f"Invalid message format from {client_address}")
@@ -146,34 +523,36 @@ class DistributedServer:
 
         finally:
             # Clean up when client disconnects
+            registered = False
             with self.lock:
+                if session_type is not None:
+                    self.session_counts[session_type] -= 1
                 if client_address in self.clients:
-                    client_name = self.client_names.get(client_address, f"Client-{client_address[1]}")
                     del self.clients[client_address]
-                    if client_address in self.client_names:
-                        del self.client_names[client_address]
-
-                    # Update client status in database
-                    if client_name:
-                        self.db.disconnect_client(client_name)
-
-                    # Store system message in database
-                    system_message = f"{client_name} left the system"
-                    self.db.store_message("system", "Server", system_message)
+                if client_address in self.client_names:
+                    client_name = self.client_names.pop(client_address)
+                    registered = True
+                self.presence_watchers.discard(client_address)
+                for channel in self.client_channels.pop(client_address, ()):
+                    subscribers = self.subscriptions.get(channel)
+                    if subscribers is not None:
+                        subscribers.discard(client_address)
+                        if not subscribers:
+                            del self.subscriptions[channel]
 
-                    # Notify all clients about the disconnection
-                    self.broadcast({
-                        'type': 'system',
-                        'message': system_message,
-                        'timestamp': time.time()
-                    }, exclude=None)
+            # Notify outside the lock: broadcast() acquires it again
+            if registered:
+                # Mark disconnected and notify all clients, batched with other leaves
+                self.queue_presence_event('left', client_name)
+                if client_name.startswith("Worker-"):
+                    self.scheduler.worker_disconnected(client_name)
 
             client_socket.close()
             print(f"Connection closed with {client_address}")
 
     def broadcast(self, message, exclude=None):
         """Send a message to all connected clients except the excluded one"""
-        message_json = json.dumps(message)
+        message_json = json.dumps(message) + '\n'
 
         with self.lock:
             for addr, client in self.clients.items():
@@ -184,9 +563,249 @@ class DistributedServer:
                         # If sending fails, the client will be removed in the handle_client method
                         pass
 
+    def queue_presence_event(self, event, client_name, client_type=None):
+        """Queue a join or leave; the first event of a window schedules the flush"""
+        with self.presence_lock:
+            self.presence_events.append((event, client_name, client_type, time.time()))
+            if self.presence_window <= 0:
+                schedule = False
+            elif self.presence_timer is None:
+                self.presence_timer = threading.Timer(self.presence_window, self.flush_presence_events)
+                self.presence_timer.daemon = True
+                schedule = True
+            else:
+                return
+
+        if schedule:
+            self.presence_timer.start()
+        else:
+            self.flush_presence_events()
+
+    def flush_presence_events(self):
+        """Persist, announce and broadcast the queued joins and leaves as one batch"""
+        with self.presence_flush_lock:
+            with self.presence_lock:
+                events = self.presence_events
+                self.presence_events = []
+                self.presence_timer = None
+            if not events:
+                return
+
+            # One transaction for the client rows and the per-client system messages
+            self.db.record_presence_events(events)
+
+            # Net effect per name: a client that left and came back is simply present
+            present = {}
+            for event, name, _, _ in events:
+                present[name] = event == 'joined'
+            added = [name for name, is_present in present.items() if is_present]
+            removed = [name for name, is_present in present.items() if not is_present]
+
+            self.federation.announce_presence(added=added, removed=removed)
+            self.record_presence(added=added, removed=removed)
+            self.broadcast_all({
+                'type': 'system',
+                'message': presence_summary(events),
+                'timestamp': time.time()
+            })
+
+    def broadcast_all(self, message):
+        """Broadcast to local clients and relay once to each peer node"""
+        self.broadcast(message, exclude=None)
+        self.federation.relay_broadcast(message)
+
+    def subscribe(self, client_address, channels):
+        """Add a client to the subscriber sets of the given channels"""
+        with self.lock:
+            own = self.client_channels.setdefault(client_address, set())
+            for channel in channels:
+                self.subscriptions.setdefault(channel, set()).add(client_address)
+                own.add(channel)
+
+    def unsubscribe(self, client_address, channels):
+        """Remove a client from the subscriber sets of the given channels"""
+        with self.lock:
+            own = self.client_channels.get(client_address, set())
+            for channel in channels:
+                own.discard(channel)
+                subscribers = self.subscriptions.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(client_address)
+                    if not subscribers:
+                        del self.subscriptions[channel]
+
+    def publish(self, channel, message):
+        """Send a message to the local subscribers of a channel only"""
+        message_json = (json.dumps(message) + '\n').encode('utf-8')
+
+        with self.lock:
+            for addr in self.subscriptions.get(channel, ()):
+                client = self.clients.get(addr)
+                if client is None:
+                    continue
+                try:
+                    client.sendall(message_json)
+                except:
+                    # If sending fails, the client will be removed in the handle_client method
+                    pass
+
+    def publish_all(self, channel, message):
+        """Publish to local subscribers and relay once to each peer node"""
+        self.publish(channel, message)
+        self.federation.relay_broadcast(message)
+
+    def persist_direct(self, message, sender, target):
+        """Store a direct message, and the task it submits if any, in the database"""
+        if 'task_data' in message and 'task_id' in message:
+            task_data = message.get('task_data', {})
+            task_id = message.get('task_id')
+            task_type = task_data.get('task_type', 'unknown')
+            params = task_data.get('params', {})
+
+            self.db.store_task(task_id, task_type, target, sender, params,
+                               priority=parse_priority(message.get('priority')),
+                               deadline=parse_deadline(message.get('deadline')))
+
+        message_id = self.db.store_message("direct", sender, message.get('message', ''), target)
+        self.remember_message(('direct', target), message_id, message)
+
+    def route_direct(self, message, target):
+        """Deliver a direct message locally or forward it to the node that owns the target"""
+        if self.queue_task(message, target) or self.send_direct_message(message, target):
+            return True
+        return self.federation.forward_direct(message, target)
+
+    def deliver_or_store(self, message, target):
+        """Route a direct message or task result; if the target is offline, keep it in the target's outbox"""
+        if self.route_direct(message, target):
+            return True
+        # Task submissions are not kept: they would skip the scheduler when the worker comes back
+        if self.outbox_ttl <= 0 or 'task_data' in message or not target:
+            return False
+        if not self.db.store_outbox_frame(target, json.dumps(message), self.outbox_ttl):
+            return False
+        self.metrics.increment('outbox_stored')
+        if target in self.local_client_names():
+            # The target registered while the frame was being stored; don't leave it behind
+            self.flush_outbox(target)
+        return True
+
+    def flush_outbox(self, name):
+        """Send a client the frames of its outbox in one write and mark them delivered together"""
+        # One flush per server at a time, so no frame goes out twice
+        with self.outbox_lock:
+            frames = self.db.get_outbox_frames(name)
+            if not frames:
+                return 0
+            payload = ''.join(frame + '\n' for _, frame in frames).encode('utf-8')
+            with self.lock:
+                client = None
+                for addr, client_name in self.client_names.items():
+                    if client_name == name:
+                        client = self.clients.get(addr)
+                        break
+                if client is None:
+                    return 0
+                try:
+                    client.sendall(payload)
+                except OSError:
+                    # Still undelivered; the next registration tries again
+                    return 0
+            self.db.mark_outbox_delivered([frame_id for frame_id, _ in frames])
+        self.metrics.increment('outbox_delivered', len(frames))
+        self.db.purge_outbox()
+        return len(frames)
+
+    def queue_task(self, message, target):
+        """Hand a task submission for a local worker to the scheduler; False for anything else"""
+        if 'task_data' not in message or 'task_id' not in message:
+            return False
+        if target not in self.local_client_names():
+            return False
+        message['priority'] = parse_priority(message.get('priority'))
+        self.scheduler.submit(message['task_id'], target, message['priority'], message,
+                              deadline=parse_deadline(message.get('deadline')))
+        return True
+
+    def expire_task(self, task):
+        """Fail a task whose deadline passed before a worker started it, and tell the requester"""
+        task_result = {
+            'task_id': task.task_id,
+            'error': "Deadline passed before the task started",
+            'expired': True
+        }
+        self.db.update_task_result(task.task_id, task_result, status='expired')
+        requester = task.message.get('sender')
+        if requester:
+            self.deliver_or_store({
+                'type': 'direct',
+                'sender': 'Server',
+                'target': requester,
+                'message': f"Task {task.task_id} expired before it started",
+                'task_result': task_result,
+                'timestamp': time.time()
+            }, requester)
+
+    def deliver_peer_broadcast(self, message):
+        """Fan out a broadcast or channel message relayed by a peer node to the local clients"""
+        message_type = message.get('type')
+        if self.federation.persist_remote:
+            if message_type == 'system':
+                self.db.store_message("system", "Server", message.get('message', ''))
+            elif message_type == 'publish':
+                message_id = self.db.store_message("publish", message.get('sender', 'Unknown'),
+                                                   message.get('message', ''), message.get('channel'))
+                self.remember_message(('channel', message.get('channel')), message_id, message)
+            else:
+                message_id = self.db.store_message("broadcast", message.get('sender', 'Unknown'),
+                                                   message.get('message', ''))
+                self.remember_message(('channel', DEFAULT_CHANNEL), message_id, message)
+
+        if message_type == 'system':
+            self.broadcast(message, exclude=None)
+        elif message_type == 'publish':
+            self.publish(message.get('channel') or DEFAULT_CHANNEL, message)
+        else:
+            self.publish(DEFAULT_CHANNEL, message)
+
+    def deliver_peer_direct(self, message):
+        """Deliver a direct message forwarded by a peer node to a local client"""
+        target = message.get('target')
+        if message.get('type') == 'progress':
+            # Progress is transient; never stored
+            self.send_direct_message(message, target)
+            return
+        if message.get('type') == 'cancel_task':
+            # A requester on another node cancels a task of one of our workers
+            status = self.cancel_task(message.get('task_id'), target)
+            requester = message.get('sender')
+            if status == 'error' and requester:
+                reply = self.cancel_result(message.get('task_id'), status, target)
+                self.send_direct_message(reply, requester) or self.federation.forward_direct(reply, requester)
+            return
+        if self.federation.persist_remote:
+            self.persist_direct(message, message.get('sender', 'Unknown'), target)
+            if 'task_result' in message:
+                self.db.update_task_result(message['task_result'].get('task_id'), message['task_result'])
+        if not self.queue_task(message, target):
+            self.send_direct_message(message, target)
+
+    def local_client_names(self):
+        """Names of the clients connected to this node"""
+        with self.lock:
+            return list(self.client_names.values())
+
+    def relay_progress(self, message, target):
+        """Send a progress report to its requester, locally or through the node that owns it"""
+        return self.send_direct_message(message, target) or self.federation.forward_direct(message, target)
+
+    def local_worker_names(self):
+        """Names of the workers connected to this node"""
+        return [name for name in self.local_client_names() if name.startswith("Worker-")]
+
     def send_direct_message(self, message, target):
         """Send a message to a specific client by name"""
-        message_json = json.dumps(message)
+        message_json = json.dumps(message) + '\n'
 
         with self.lock:
             target_address = None
@@ -201,24 +820,598 @@ class DistributedServer:
                 except:
                     # If sending fails, the client will be removed in the handle_client method
                     pass
+                return True
+        return False
 
-    def send_client_list(self, client_socket):
-        """Send the list of connected clients to a client"""
-        with self.lock:
-            client_list = list(self.client_names.values())
+    def remember_message(self, key, message_id, message):
+        """Append a stored message to the in-memory history of its channel or recipient"""
+        if self.history_size <= 0:
+            return
+
+        entry = {
+            'id': message_id,
+            'type': message.get('type'),
+            'sender': message.get('sender', 'Unknown'),
+            'message': message.get('message', ''),
+            'timestamp': message.get('timestamp')
+        }
+        entry['channel' if key[0] == 'channel' else 'target'] = key[1]
+
+        with self.history_lock:
+            ring = self.history.get(key)
+            if ring is None:
+                ring = self.history[key] = deque(maxlen=self.history_size)
+            elif len(ring) == self.history_size:
+                # The oldest entry drops out; from now on it is only on disk
+                self.history_floors[key] = ring[0]['id']
+
+            if ring and ring[-1]['id'] > message_id:
+                # Another handler stored a newer message first; keep the ring in id order
+                entries = sorted(list(ring) + [entry], key=lambda item: item['id'])
+                ring.clear()
+                ring.extend(entries)
+            else:
+                ring.append(entry)
+
+    def read_history(self, key, before_id=None, limit=50):
+        """Newest-first page of messages below before_id; older ranges come from the database"""
+        page = []
+        with self.history_lock:
+            floor = self.history_floors.get(key, self.history_start_id)
+            for entry in reversed(self.history.get(key, ())):
+                if before_id is not None and entry['id'] >= before_id:
+                    continue
+                page.append(entry)
+                if len(page) == limit:
+                    return page, 'memory'
 
-        message = {
-            'type': 'client_list',
-            'clients': client_list,
+        # Everything above the floor was in memory; only older rows are worth a query
+        cutoff = floor + 1
+        if page:
+            cutoff = min(cutoff, page[-1]['id'])
+        if before_id is not None:
+            cutoff = min(cutoff, before_id)
+        if cutoff <= 1:
+            return page, 'memory'
+
+        kind, name = key
+        rows = self.db.get_messages_before(
+            'publish' if kind == 'channel' else 'direct', name, before_id=cutoff,
+            limit=limit - len(page), include_broadcasts=(key == ('channel', DEFAULT_CHANNEL))
+        )
+        for row in rows:
+            entry = {
+                'id': row['id'],
+                'type': row['type'],
+                'sender': row['sender'],
+                'message': row['content'],
+                'timestamp': row['timestamp']
+            }
+            entry['channel' if kind == 'channel' else 'target'] = name
+            page.append(entry)
+        return page, ('memory+database' if len(page) > len(rows) else 'database')
+
+    def handle_history_request(self, client_socket, client_address, message):
+        """Answer a history request with one page, oldest message first"""
+        try:
+            limit = max(1, min(int(message.get('limit', 50)), HISTORY_PAGE_MAX))
+        except (TypeError, ValueError):
+            limit = 50
+        before_id = message.get('before_id')
+        if not isinstance(before_id, int):
+            before_id = None
+
+        if message.get('direct'):
+            # Only a client's own inbox can be read
+            name = self.client_names.get(client_address, f"Client-{client_address[1]}")
+            key = ('direct', name)
+        else:
+            key = ('channel', message.get('channel') or DEFAULT_CHANNEL)
+
+        page, source = self.read_history(key, before_id, limit)
+        reply = {
+            'type': 'history',
+            'messages': page[::-1],
+            # Pass back as before_id to get the previous page
+            'next_before_id': page[-1]['id'] if len(page) == limit else None,
+            'source': source,
+            'timestamp': time.time()
+        }
+        if key[0] == 'channel':
+            reply['channel'] = key[1]
+        else:
+            reply['direct'] = True
+        self.send_to_client(client_socket, reply)
+
+    def handle_workflow_request(self, client_socket, client_address, message):
+        """Start a workflow; a malformed one is answered at once with a failed workflow_result"""
+        name = self.client_names.get(client_address, f"Client-{client_address[1]}")
+        workflow_id = message.get('workflow_id') or str(uuid.uuid4())
+        try:
+            self.workflows.submit(workflow_id, name, message.get('nodes'), message.get('output'),
+                                  priority=parse_priority(message.get('priority')))
+        except ValueError as e:
+            self.send_to_client(client_socket, {
+                'type': 'workflow_result',
+                'workflow_id': workflow_id,
+                'status': 'rejected',
+                'result': None,
+                'error': str(e),
+                'timestamp': time.time()
+            })
+
+    def handle_cancel_request(self, client_socket, client_address, message):
+        """Cancel one of the client's pending tasks and say what became of it"""
+        name = self.client_names.get(client_address, f"Client-{client_address[1]}")
+        task_id = message.get('task_id')
+        task = self.db.get_task(task_id) if isinstance(task_id, str) else None
+        if task is None or task['requester'] != name:
+            status = 'not_found'
+        elif task['status'] != 'pending':
+            # Too late; report how it ended
+            status = task['status']
+        else:
+            status = self.cancel_task(task_id, task['worker'], name)
+        self.send_to_client(client_socket, self.cancel_result(task_id, status, task['worker'] if task else None))
+
+    def cancel_result(self, task_id, status, worker=None):
+        """The cancel_result frame for a cancellation outcome"""
+        reply = {
+            'type': 'cancel_result',
+            'task_id': task_id,
+            'status': status,
             'timestamp': time.time()
         }
+        if status == 'error':
+            reply['error'] = f"Worker {worker} could not be reached; the task may still be running"
+        return reply
+
+    def cancel_task(self, task_id, worker, requester=None):
+        """Cancel a pending task: 'cancelled' if it had not started, 'cancelling' if its worker was signalled.
+
+        A queued task leaves the scheduler at once and its requester gets a
+        cancelled task_result. A running one is signalled with cancel_task;
+        the worker stops at its next check and reports the cancelled result
+        itself, which frees its slot. Tasks of workers on other nodes are
+        cancelled by those nodes ('forwarded'). A task this node neither
+        queues nor runs is left alone ('error'): its worker may still finish it.
+        """
+        state, tasks = self.scheduler.cancel(task_id)
+        if state == 'running':
+            for copy in tasks:
+                self.send_direct_message({'type': 'cancel_task', 'task_id': task_id, 'timestamp': time.time()},
+                                         copy.worker)
+            return 'cancelling'
+
+        if state is None:
+            # Only the node that queues or runs the task can tell whether it stopped
+            if worker not in self.local_client_names() and self.federation.forward_direct({
+                    'type': 'cancel_task', 'task_id': task_id, 'target': worker, 'sender': requester,
+                    'timestamp': time.time()}, worker):
+                return 'forwarded'
+            return 'error'
+
+        # Still queued here, so it can never run
+        task_result = {
+            'task_id': task_id,
+            'error': "Task cancelled",
+            'cancelled': True
+        }
+        self.db.update_task_result(task_id, task_result, status='cancelled')
+        self.metrics.increment(f"tasks_cancelled.{tasks.priority}")
+        if self.workflows.task_finished(task_id, task_result):
+            # A workflow step; the workflow fails and reports that itself
+            return 'cancelled'
+        requester = tasks.message.get('sender')
+        if requester:
+            self.deliver_or_store({
+                'type': 'direct',
+                'sender': 'Server',
+                'target': requester,
+                'message': f"Task {task_id} cancelled",
+                'task_result': task_result,
+                'timestamp': time.time()
+            }, requester)
+        return 'cancelled'
+
+    def handle_search_request(self, client_socket, client_address, message):
+        """Answer a search request with one page of ranked hits and a cursor for the next"""
+        name = self.client_names.get(client_address, f"Client-{client_address[1]}")
+        try:
+            limit = max(1, min(int(message.get('limit', 20)), SEARCH_PAGE_MAX))
+        except (TypeError, ValueError):
+            limit = 20
+        filters = {}
+        for key in ('sender', 'target'):
+            if isinstance(message.get(key), str):
+                filters[key] = message[key]
+        for key in ('since', 'until'):
+            if isinstance(message.get(key), (int, float)) and not isinstance(message.get(key), bool):
+                filters[key] = message[key]
+        # A cursor is what the previous page returned: [rank, id], or [id] without a text index
+        cursor = message.get('cursor')
+        if not (isinstance(cursor, list) and 1 <= len(cursor) <= 2
+                and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in cursor)):
+            cursor = None
 
+        reply = {
+            'type': 'search_result',
+            'search_id': message.get('search_id'),
+            'query': message.get('query'),
+            'timestamp': time.time()
+        }
+        started = time.perf_counter()
         try:
-            client_socket.sendall(json.dumps(message).encode('utf-8'))
+            # Direct messages of other clients never show up
+            reply['hits'], reply['next_cursor'] = self.db.search_messages(
+                str(message.get('query') or ''), cursor=cursor, limit=limit, participant=name, **filters
+            )
+        except sqlite3.Error as e:
+            reply.update({'hits': [], 'next_cursor': None, 'error': str(e)})
+        reply['took'] = time.perf_counter() - started
+        self.metrics.observe('search', reply['took'])
+        self.send_to_client(client_socket, reply)
+
+    def handle_query_request(self, client_socket, client_address, message):
+        """Stream the rows matching a task_query or history_query, one page per frame.
+
+        Pages are read from the database one at a time (keyset on id, newest
+        first), so a large result never sits in memory at once. The last frame
+        has done=True and a next_before_id to continue from if the limit cut
+        the result short. Clients only see their own tasks and direct messages.
+        """
+        name = self.client_names.get(client_address, f"Client-{client_address[1]}")
+        message_type = message.get('type')
+        try:
+            limit = max(1, min(int(message.get('limit', QUERY_PAGE_SIZE)), QUERY_LIMIT_MAX))
+            page_size = max(1, min(int(message.get('page_size', QUERY_PAGE_SIZE)), HISTORY_PAGE_MAX))
+            since = float(message['since']) if message.get('since') is not None else None
+            until = float(message['until']) if message.get('until') is not None else None
+        except (TypeError, ValueError):
+            self.send_to_client(client_socket, {
+                'type': f"{message_type}_result",
+                'query_id': message.get('query_id'),
+                'error': 'invalid query',
+                'items': [],
+                'done': True,
+                'timestamp': time.time()
+            })
+            return
+        before_id = message.get('before_id')
+        if not isinstance(before_id, int):
+            before_id = None
+
+        if message_type == 'task_query':
+            # A worker asks about the tasks assigned to it, anyone else about those it submitted
+            role = 'worker' if message.get('role') == 'worker' else 'requester'
+            task_ids = message.get('task_ids')
+            if message.get('task_id'):
+                task_ids = [message['task_id']]
+            filters = {
+                role: name,
+                'status': message.get('status'),
+                'task_type': message.get('task_type'),
+                'task_ids': list(task_ids) if isinstance(task_ids, list) else None,
+                'since': since,
+                'until': until
+            }
+            # The rows go out as JSON, so payloads kept in the blobs table are read in
+            fetch = lambda cursor, count: self.db.query_tasks(before_id=cursor, limit=count, load_blobs=True,
+                                                              **filters)
+        else:
+            filters = {
+                'message_type': message.get('message_type'),
+                'sender': message.get('sender'),
+                'target': message.get('target'),
+                'since': since,
+                'until': until,
+                'participant': name
+            }
+            fetch = lambda cursor, count: self.db.query_messages(before_id=cursor, limit=count, **filters)
+
+        sent = 0
+        page_number = 0
+        while True:
+            count = min(page_size, limit - sent)
+            items = fetch(before_id, count)
+            sent += len(items)
+            if items:
+                before_id = items[-1]['id']
+            exhausted = len(items) < count
+            done = exhausted or sent >= limit
+            self.send_to_client(client_socket, {
+                'type': f"{message_type}_result",
+                'query_id': message.get('query_id'),
+                'page': page_number,
+                'items': items,
+                'done': done,
+                # Pass back as before_id to continue after the limit
+                'next_before_id': None if exhausted else before_id,
+                'timestamp': time.time()
+            })
+            page_number += 1
+            if done:
+                break
+
+    def handle_profile_request(self, client_socket, message):
+        """Start or stop the profiler if the request carries the admin token"""
+        token = str(message.get('token') or '')
+        action = message.get('action')
+
+        if not self.admin_token or not hmac.compare_digest(token, self.admin_token):
+            reply = {'status': 'denied'}
+        elif action == 'start':
+            reply = {'status': 'started' if self.profiler.start() else 'already_running'}
+        elif action == 'stop':
+            path = self.profiler.stop()
+            reply = {'status': 'stopped' if path else 'not_running', 'path': path}
+        else:
+            reply = {'status': 'invalid_action'}
+
+        reply.update({'type': 'profile', 'action': action, 'timestamp': time.time()})
+        self.send_to_client(client_socket, reply)
+
+    def send_to_client(self, client_socket, message):
+        """Send a message to a single client socket"""
+        try:
+            client_socket.sendall((json.dumps(message) + '\n').encode('utf-8'))
         except:
             # If sending fails, the client will be removed in the handle_client method
             pass
 
-if __name__ == "__main__":
-    server = DistributedServer()
+    def presence_names(self):
+        """Names of all reachable clients, local and on peer nodes; call with the lock held"""
+        names = list(self.client_names.values())
+        local = set(names)
+        # Clients on peer nodes are reachable too
+        names += [name for name in self.federation.remote_client_names() if name not in local]
+        return names
+
+    def record_presence(self, added=(), removed=()):
+        """Bump the presence version and send the delta to every watching client"""
+        if not added and not removed:
+            return
+
+        with self.lock:
+            self.presence_version += 1
+            self.presence_log.append((self.presence_version, list(added), list(removed)))
+            message_json = (json.dumps({
+                'type': 'presence_delta',
+                'epoch': self.presence_epoch,
+                'since': self.presence_version - 1,
+                'version': self.presence_version,
+                'added': list(added),
+                'removed': list(removed)
+            }) + '\n').encode('utf-8')
+
+            # Sent under the lock so every watcher sees the versions in order
+            for addr in self.presence_watchers:
+                client = self.clients.get(addr)
+                if client is None:
+                    continue
+                try:
+                    client.sendall(message_json)
+                except:
+                    # If sending fails, the client will be removed in the handle_client method
+                    pass
+
+    def send_presence_changes(self, client_socket, since, epoch):
+        """Send the merged presence changes after `since`, or a snapshot if they are no longer logged"""
+        with self.lock:
+            oldest = self.presence_log[0][0] if self.presence_log else self.presence_version + 1
+            if (epoch != self.presence_epoch or not isinstance(since, int)
+                    or since > self.presence_version or since < oldest - 1):
+                message = None
+            else:
+                # Net effect of the logged deltas: True if the name is present at the end
+                present = {}
+                for version, added, removed in self.presence_log:
+                    if version <= since:
+                        continue
+                    for name in added:
+                        present[name] = True
+                    for name in removed:
+                        present[name] = False
+                message = {
+                    'type': 'presence_delta',
+                    'epoch': self.presence_epoch,
+                    'since': since,
+                    'version': self.presence_version,
+                    'added': [name for name, is_present in present.items() if is_present],
+                    'removed': [name for name, is_present in present.items() if not is_present]
+                }
+                self.send_to_client(client_socket, message)
+
+        if message is None:
+            self.send_client_list(client_socket)
+
+    def send_client_list(self, client_socket, watch_address=None):
+        """Send a versioned snapshot of the connected clients to a client.
+
+        With watch_address, the client also starts receiving presence deltas;
+        both happen under the lock so no delta can slip in between.
+        """
+        with self.lock:
+            message = {
+                'type': 'client_list',
+                'clients': self.presence_names(),
+                'epoch': self.presence_epoch,
+                'version': self.presence_version,
+                'timestamp': time.time()
+            }
+            self.send_to_client(client_socket, message)
+            if watch_address is not None:
+                self.presence_watchers.add(watch_address)
+
+def parse_quota(text):
+    """Parse "worker=50" into ('worker', 50)"""
+    client_type, _, value = text.partition('=')
+    client_type = client_type.strip()
+    if client_type not in CLIENT_TYPES:
+        raise ValueError(f"Unknown client type: {client_type}")
+    return client_type, int(value)
+
+def presence_summary(events):
+    """Text of the system notification for a batch of join/leave events"""
+    if len(events) == 1:
+        event, name, _, _ = events[0]
+        return f"{name} {event} the system"
+
+    parts = []
+    for event in ('joined', 'left'):
+        names = [name for kind, name, _, _ in events if kind == event]
+        if not names:
+            continue
+        if len(names) == 1:
+            parts.append(f"{names[0]} {event} the system")
+            continue
+        listed = ', '.join(names[:PRESENCE_SUMMARY_NAMES])
+        if len(names) > PRESENCE_SUMMARY_NAMES:
+            listed += f" and {len(names) - PRESENCE_SUMMARY_NAMES} more"
+        parts.append(f"{len(names)} clients {event} the system: {listed}")
+    return '; '.join(parts)
+
+def run_server_process(index, args, ipc_paths):
+    """Entry point of one server process in multi-process mode"""
+    peers = [('unix', path) for i, path in enumerate(ipc_paths) if i != index]
+    node_id = f"{args.node_id or f'{args.host}:{args.port}'}/{index}"
+
+    server = DistributedServer(args.host, args.port, args.db,
+                               admin_token=args.admin_token, profile_dir=args.profile_dir,
+                               node_id=node_id, peers=peers, reuse_port=True,
+                               ipc_path=ipc_paths[index], persist_remote=False,
+                               presence_window=args.presence_window,
+                               # Siblings write to the shared database behind our back, so
+                               # history comes from disk and task records are not cached
+                               history_size=0, task_cache_size=0,
+                               # One process is enough to archive the shared database
+                               retention_policies=args.retention if index == 0 else (),
+                               archive_dir=args.archive_dir, retention_interval=args.retention_interval,
+                               priority_weights=args.priority_weights,
+                               rate_limits={category: (rate, burst) for category, rate, burst in args.rate_limit},
+                               # Each process admits its share of the sessions
+                               backlog=args.backlog, max_handlers=max(1, args.max_handlers // args.processes),
+                               session_quotas={client_type: max(1, quota // args.processes)
+                                               for client_type, quota in args.session_quota},
+                               hedge_types=args.hedge, hedge_percentile=args.hedge_percentile,
+                               progress_interval=args.progress_interval, outbox_ttl=args.outbox_ttl)
     server.start()
+
+def serve_multiprocess(args):
+    """Run several server processes that share the listening port.
+
+    Each process owns the connections the kernel hands it. The processes
+    federate with each other over Unix sockets, so direct messages and
+    broadcasts still reach clients held by a sibling. They share one
+    database, so forwarded traffic is only persisted by the process that
+    received it from the client.
+    """
+    # Create the schema once, then let the processes read while another one writes
+    DatabaseManager(args.db)
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.close()
+
+    ipc_dir = tempfile.mkdtemp(prefix='ds-server-')
+    ipc_paths = [os.path.join(ipc_dir, f"node-{i}.sock") for i in range(args.processes)]
+    processes = [
+        multiprocessing.Process(target=run_server_process, args=(i, args, ipc_paths), name=f"server-{i}")
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    print(f"Started {args.processes} server processes on {args.host}:{args.port}")
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("Stopping server processes...")
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    finally:
+        shutil.rmtree(ipc_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed system server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--db', default='distributed_system.db', help="SQLite database path")
+    parser.add_argument('--admin-token', default=os.environ.get('DS_ADMIN_TOKEN'),
+                        help="Token required for admin control messages (default: $DS_ADMIN_TOKEN)")
+    parser.add_argument('--profile-dir', default='.', help="Directory for profiler output")
+    parser.add_argument('--peer', action='append', default=[], metavar='HOST:PORT',
+                        help="Another server node to federate with (repeatable)")
+    parser.add_argument('--peer-token', default=os.environ.get('DS_PEER_TOKEN'),
+                        help="Shared secret peer nodes must present (default: $DS_PEER_TOKEN)")
+    parser.add_argument('--node-id', help="Name of this node (default: advertised host:port)")
+    parser.add_argument('--advertise-host', help="Host name peers use to reach this node (default: --host)")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Server processes sharing the port (Linux/BSD; requires SO_REUSEPORT)")
+    parser.add_argument('--presence-window', type=float, default=0.1,
+                        help="Seconds during which joins/leaves are batched into one notification (0 disables)")
+    parser.add_argument('--history-size', type=int, default=HISTORY_SIZE,
+                        help="Recent messages kept in memory per channel and recipient (0 reads history from disk)")
+    parser.add_argument('--retention', action='append', default=[], type=RetentionPolicy.parse, metavar='POLICY',
+                        help="Archive old messages, e.g. max_age=30d or max_count=100000,types=system (repeatable)")
+    parser.add_argument('--archive-dir', default='archive', help="Directory for archived message segments")
+    parser.add_argument('--retention-interval', type=float, default=60,
+                        help="Seconds between retention passes")
+    parser.add_argument('--message-store', choices=['sqlite', 'log'], default='sqlite',
+                        help="Where messages are stored: the SQLite table or an append-only segmented log")
+    parser.add_argument('--message-log-dir', help="Directory of the message log (default: <db>-messages)")
+    parser.add_argument('--message-log-fsync', action='store_true',
+                        help="fsync the message log after every append (SQLite syncs every commit)")
+    parser.add_argument('--rate-limit', action='append', default=[], type=parse_limit, metavar='CATEGORY=RATE[:BURST]',
+                        help="Per-client limit for broadcast, direct, task or all messages, e.g. task=2:5 (repeatable)")
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG, help="Listen backlog")
+    parser.add_argument('--max-handlers', type=int, default=MAX_HANDLERS,
+                        help="Most connections handled at once; further ones are rejected")
+    parser.add_argument('--session-quota', action='append', default=[], type=parse_quota, metavar='TYPE=N',
+                        help="Most sessions of a client type (worker, task_client, regular) at once (repeatable)")
+    parser.add_argument('--priority-weights', type=parse_weights, metavar='WEIGHTS',
+                        help="Dispatch shares of the task priority classes (default: high=4,normal=2,low=1)")
+    parser.add_argument('--hedge', action='append', default=[], metavar='TASK_TYPE',
+                        help="Hedge stragglers of this idempotent task type on an idle worker (repeatable)")
+    parser.add_argument('--hedge-percentile', type=float, default=HEDGE_PERCENTILE,
+                        help="Hedge a task once it runs longer than this percentile of recent ones")
+    parser.add_argument('--progress-interval', type=float, default=PROGRESS_INTERVAL,
+                        help="Least seconds between progress updates relayed for a task (0 relays them all)")
+    parser.add_argument('--outbox-ttl', type=float, default=OUTBOX_TTL,
+                        help="Seconds direct messages and task results wait for offline clients (0 to drop them)")
+    args = parser.parse_args()
+
+    if args.message_store == 'log' and (args.processes > 1 or args.retention):
+        parser.error("--message-store log supports a single process and no --retention")
+
+    if args.progress_interval < 0:
+        parser.error("--progress-interval cannot be negative")
+
+    if args.peer and not args.peer_token:
+        parser.error("--peer requires --peer-token (or $DS_PEER_TOKEN)")
+
+    if args.processes > 1:
+        if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+            parser.error("--processes requires SO_REUSEPORT and Unix sockets")
+        if args.peer:
+            parser.error("--processes cannot be combined with --peer")
+        serve_multiprocess(args)
+    else:
+        server = DistributedServer(args.host, args.port, args.db,
+                                   admin_token=args.admin_token, profile_dir=args.profile_dir,
+                                   node_id=args.node_id, peers=args.peer, advertise_host=args.advertise_host,
+                                   presence_window=args.presence_window, history_size=args.history_size,
+                                   retention_policies=args.retention, archive_dir=args.archive_dir,
+                                   retention_interval=args.retention_interval,
+                                   message_store=args.message_store, message_log_dir=args.message_log_dir,
+                                   message_log_fsync=args.message_log_fsync,
+                                   priority_weights=args.priority_weights,
+                                   rate_limits={category: (rate, burst) for category, rate, burst in args.rate_limit},
+                                   backlog=args.backlog, max_handlers=args.max_handlers,
+                                   session_quotas=dict(args.session_quota),
+                                   hedge_types=args.hedge, hedge_percentile=args.hedge_percentile,
+                                   progress_interval=args.progress_interval, outbox_ttl=args.outbox_ttl,
+                                   peer_token=args.peer_token)
+        server.start()
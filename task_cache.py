@@ -0,0 +1,106 @@
+from collections import OrderedDict
+
+
+class TaskIndex:
+    """Newest-first task ids of one requester or worker that are held in the cache.
+
+    The ids are the `depth` newest tasks of that requester or worker, with no
+    gaps, unless `complete` is set, in which case they are all of its tasks.
+    """
+
+    def __init__(self, task_ids, complete):
+        self.task_ids = task_ids
+        self.complete = complete
+
+    def covers(self, limit):
+        return self.complete or len(self.task_ids) >= limit
+
+
+class TaskCache:
+    """LRU cache of task records with per-requester and per-worker indexes.
+
+    DatabaseManager writes every change through the cache while it holds its
+    lock, so the cache never disagrees with the tasks table it fronts. Records
+    are the dicts get_task returns; callers receive shallow copies.
+    """
+
+    INDEXED_FIELDS = ('requester', 'worker')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.records = OrderedDict()  # task_id -> record, least recently used first
+        self.indexes = {field: {} for field in self.INDEXED_FIELDS}  # field -> value -> TaskIndex
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, task_id):
+        record = self.records.get(task_id)
+        if record is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.records.move_to_end(task_id)
+        return dict(record)
+
+    def get_many(self, field, value, limit):
+        """The `limit` newest tasks for a requester or worker, or None if not fully cached"""
+        index = self.indexes[field].get(value)
+        if index is None or not index.covers(limit):
+            self.misses += 1
+            return None
+        self.hits += 1
+        task_ids = index.task_ids[:limit]
+        for task_id in task_ids:
+            self.records.move_to_end(task_id)
+        return [dict(self.records[task_id]) for task_id in task_ids]
+
+    def add(self, record):
+        """Cache a task that was just stored; it is the newest task of its requester and worker"""
+        self.put(record)
+        for field in self.INDEXED_FIELDS:
+            index = self.indexes[field].get(record[field])
+            if index is not None:
+                index.task_ids.insert(0, record['task_id'])
+        self.evict()
+
+    def update(self, task_id, changes):
+        """Apply an update that was just written to the database, if the task is cached"""
+        record = self.records.get(task_id)
+        if record is not None:
+            record.update(changes)
+            self.records.move_to_end(task_id)
+
+    def fill(self, field, value, records, limit):
+        """Cache the result of a get_tasks_by_* query and remember how deep it goes"""
+        if len(records) > self.capacity // 2:
+            # Caching it would evict most of what is already here
+            return
+        for record in records:
+            if record['task_id'] not in self.records:
+                self.put(record)
+        self.indexes[field][value] = TaskIndex([record['task_id'] for record in records], len(records) < limit)
+        self.evict()
+
+    def put(self, record):
+        self.records[record['task_id']] = record
+        self.records.move_to_end(record['task_id'])
+
+    def evict(self):
+        while len(self.records) > self.capacity:
+            task_id, record = self.records.popitem(last=False)
+            for field in self.INDEXED_FIELDS:
+                index = self.indexes[field].get(record[field])
+                if index is None or task_id not in index.task_ids:
+                    continue
+                # Only the tasks newer than the evicted one are still known to be complete
+                position = index.task_ids.index(task_id)
+                if position == 0:
+                    del self.indexes[field][record[field]]
+                else:
+                    del index.task_ids[position:]
+                    index.complete = False
+
+    def clear(self):
+        self.records.clear()
+        for field in self.INDEXED_FIELDS:
+            self.indexes[field].clear()
@@ -3,6 +3,7 @@ import threading
 import json
 import time
 import sys
+import random
 import uuid
 
 class DistributedTaskClient:
@@ -13,8 +14,19 @@ class DistributedTaskClient:
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connected = False
         self.client_list = []
+        self.presence_epoch = None  # Server presence epoch and version of client_list
+        self.presence_version = None
+        self.presence_resync = False
         self.task_results = {}
         self.tasks_pending = {}
+        self.task_progress = {}  # task_id -> newest progress report of a pending task
+        self.queries = {}  # query_id -> {'items', 'next_before_id', 'done' Event, 'on_page'}
+        self.workflows_pending = {}  # workflow_id -> submit time
+        self.workflow_results = {}  # workflow_id -> final 'workflow_result' message
+        self.workflow_status = {}  # workflow_id -> stored state answered by the server
+        self.priority = 'normal'  # Priority class of submitted tasks: high, normal or low
+        self.deadline = None  # Seconds a submitted task's result stays useful; None for no deadline
+        self.rejection = None  # The last 'rejected' frame from the server
         
     def connect(self):
         """Connect to the server"""
@@ -39,10 +51,37 @@ class DistributedTaskClient:
             print(f"Error connecting to server: {e}")
             return False
     
+    def connect_with_backoff(self, attempts=5, settle=0.3):
+        """Connect, backing off and retrying while the server turns us away"""
+        for attempt in range(attempts):
+            self.rejection = None
+            if self.connect():
+                # A full server rejects at once, a used-up quota right after registering
+                settle_until = time.time() + settle
+                while self.connected and self.rejection is None and time.time() < settle_until:
+                    time.sleep(0.05)
+                if self.connected and self.rejection is None:
+                    return True
+            if attempt + 1 == attempts:
+                break
+            # Exponential backoff from the server's hint, with jitter so rejected clients spread out
+            retry_after = (self.rejection or {}).get('retry_after', 1.0)
+            delay = retry_after * 2 ** attempt * random.uniform(0.5, 1.5)
+            print(f"Retrying in {delay:.1f}s...")
+            time.sleep(delay)
+            self.client_socket.close()
+            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        return False
+    
     def disconnect(self):
         """Disconnect from the server"""
         if self.connected:
             self.connected = False
+            try:
+                # Wake up the receive thread, which holds a file object on the socket
+                self.client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.client_socket.close()
             print(f"Task Client {self.name} disconnected from server")
     
@@ -53,7 +92,7 @@ class DistributedTaskClient:
             return False
         
         try:
-            message_json = json.dumps(message)
+            message_json = json.dumps(message) + '\n'
             self.client_socket.sendall(message_json.encode('utf-8'))
             return True
         except Exception as e:
@@ -67,8 +106,53 @@ class DistributedTaskClient:
             'type': 'status'
         })
     
-    def submit_task(self, worker, task_type, params):
-        """Submit a task to a worker"""
+    def request_stats(self):
+        """Request the server metrics, including task queue depths and wait times"""
+        return self.send_message({
+            'type': 'stats'
+        })
+    
+    def request_presence_changes(self):
+        """Ask for the presence changes since the version of our client list"""
+        self.presence_resync = True
+        return self.send_message({
+            'type': 'presence_sync',
+            'epoch': self.presence_epoch,
+            'since': self.presence_version
+        })
+    
+    def apply_presence_delta(self, message):
+        """Apply a presence delta to client_list; returns True if the list changed"""
+        if self.presence_version is None or message.get('epoch') != self.presence_epoch:
+            # No snapshot yet, or the server restarted
+            if not self.presence_resync:
+                self.request_presence_changes()
+            return False
+        
+        if message.get('version', 0) <= self.presence_version:
+            return False  # Already applied
+        
+        if message.get('since') != self.presence_version:
+            # A delta went missing; catch up from the server's log
+            if not self.presence_resync:
+                self.request_presence_changes()
+            return False
+        
+        removed = set(message.get('removed', []))
+        client_list = [name for name in self.client_list if name not in removed]
+        known = set(client_list)
+        client_list += [name for name in message.get('added', []) if name not in known]
+        self.client_list = client_list
+        self.presence_version = message['version']
+        self.presence_resync = False
+        return True
+    
+    def submit_task(self, worker, task_type, params, priority=None, deadline=None, on_progress=None):
+        """Submit a task to a worker; priority and deadline (in seconds) default to the client's.
+        
+        on_progress(report) is called with each progress report the worker
+        sends for the task (percent, partial_result, throughput).
+        """
         if not worker.startswith("Worker-"):
             print("Invalid worker name. Worker names should start with 'Worker-'")
             return None
@@ -89,15 +173,21 @@ class DistributedTaskClient:
                 'task_type': task_type,
                 'params': params
             },
-            'task_id': task_id
+            'task_id': task_id,
+            'priority': priority or self.priority
         }
+        deadline = deadline if deadline is not None else self.deadline
+        if deadline is not None:
+            # Sent as an absolute time so every hop can compare it with its clock
+            task_message['deadline'] = time.time() + deadline
         
         # Store the task in pending tasks
         self.tasks_pending[task_id] = {
             'worker': worker,
             'task_type': task_type,
             'params': params,
-            'submit_time': time.time()
+            'submit_time': time.time(),
+            'on_progress': [on_progress] if on_progress else []
         }
         
         # Send the task
@@ -109,6 +199,25 @@ class DistributedTaskClient:
             del self.tasks_pending[task_id]
             return None
     
+    def cancel_task(self, task_id):
+        """Ask the server to cancel one of our tasks; the outcome arrives as a cancel_result.
+        
+        A task that had not started is dropped from its queue, a running one
+        is stopped by its worker; either way its result reports cancelled.
+        """
+        return self.send_message({
+            'type': 'cancel',
+            'task_id': task_id
+        })
+    
+    def add_progress_callback(self, task_id, callback):
+        """Call callback(report) for each further progress report of a pending task; False if not pending"""
+        task_info = self.tasks_pending.get(task_id)
+        if task_info is None:
+            return False
+        task_info.setdefault('on_progress', []).append(callback)
+        return True
+    
     def get_task_result(self, task_id, timeout=None):
         """Get the result of a task, optionally waiting for it to complete"""
         if task_id in self.task_results:
@@ -133,11 +242,127 @@ class DistributedTaskClient:
         # Task is still pending
         return None
     
+    def submit_workflow(self, nodes, output=None, priority=None):
+        """Submit a DAG of tasks that the server runs on its own; returns the workflow ID.
+        
+        Each node is {'id', 'task_type', 'params'}, optionally with 'worker'
+        and 'after'. {'$ref': 'node'} inside params stands for the result of
+        that node. Only the result of the output node (by default the one
+        node nothing depends on) comes back, as a workflow_result.
+        """
+        workflow_id = str(uuid.uuid4())
+        self.workflows_pending[workflow_id] = time.time()
+        if self.send_message({
+            'type': 'workflow',
+            'workflow_id': workflow_id,
+            'nodes': nodes,
+            'output': output,
+            'priority': priority or self.priority
+        }):
+            print(f"Workflow {workflow_id} submitted ({len(nodes)} tasks)")
+            return workflow_id
+        del self.workflows_pending[workflow_id]
+        return None
+    
+    def get_workflow_result(self, workflow_id, timeout=None):
+        """The workflow_result of a workflow, optionally waiting for it"""
+        deadline = time.time() + (timeout or 0)
+        while workflow_id not in self.workflow_results and time.time() < deadline:
+            time.sleep(0.1)
+        return self.workflow_results.get(workflow_id)
+    
+    def request_workflow_status(self, workflow_id, timeout=5):
+        """Stored state of a workflow and its nodes, None if unknown or no answer came"""
+        self.workflow_status.pop(workflow_id, None)
+        if not self.send_message({'type': 'workflow_status', 'workflow_id': workflow_id}):
+            return None
+        deadline = time.time() + timeout
+        while workflow_id not in self.workflow_status and time.time() < deadline:
+            time.sleep(0.05)
+        return self.workflow_status.get(workflow_id)
+    
+    def query_tasks(self, status=None, task_type=None, task_ids=None, since=None, until=None,
+                    limit=100, before_id=None, role='requester', timeout=10, on_page=None):
+        """Ask the server for our tasks matching the filters, newest first.
+        
+        Returns (tasks, next_before_id), or None if no answer came within
+        timeout. Results arrive in pages; on_page(items) is called for each.
+        Pass next_before_id back as before_id to continue past the limit.
+        """
+        return self.run_query({
+            'type': 'task_query',
+            'status': status,
+            'task_type': task_type,
+            'task_ids': task_ids,
+            'since': since,
+            'until': until,
+            'limit': limit,
+            'before_id': before_id,
+            'role': role
+        }, timeout, on_page)
+    
+    def query_history(self, message_type=None, sender=None, target=None, since=None, until=None,
+                      limit=100, before_id=None, timeout=10, on_page=None):
+        """Ask the server for stored messages matching the filters, newest first"""
+        return self.run_query({
+            'type': 'history_query',
+            'message_type': message_type,
+            'sender': sender,
+            'target': target,
+            'since': since,
+            'until': until,
+            'limit': limit,
+            'before_id': before_id
+        }, timeout, on_page)
+    
+    def run_query(self, message, timeout, on_page=None):
+        """Send a query and wait until its last page has arrived"""
+        query_id = str(uuid.uuid4())
+        query = {'items': [], 'next_before_id': None, 'done': threading.Event(), 'on_page': on_page}
+        self.queries[query_id] = query
+        message['query_id'] = query_id
+        try:
+            if not self.send_message({key: value for key, value in message.items() if value is not None}):
+                return None
+            if not query['done'].wait(timeout):
+                return None
+            return query['items'], query['next_before_id']
+        finally:
+            self.queries.pop(query_id, None)
+    
+    def recover_tasks(self, timeout=10):
+        """Rebuild tasks_pending from the server after a restart; returns the number recovered.
+        
+        Only our pending tasks are fetched, page by page. Their results are
+        then picked up as they arrive, as for tasks submitted in this session.
+        """
+        recovered = 0
+        before_id = None
+        while True:
+            answer = self.query_tasks(status='pending', limit=1000, before_id=before_id, timeout=timeout)
+            if answer is None:
+                break
+            tasks, before_id = answer
+            for task in tasks:
+                if task['task_id'] not in self.tasks_pending and task['task_id'] not in self.task_results:
+                    self.tasks_pending[task['task_id']] = {
+                        'worker': task['worker'],
+                        'task_type': task['task_type'],
+                        'params': task['parameters'],
+                        'submit_time': task['submit_time']
+                    }
+                    recovered += 1
+            if before_id is None:
+                break
+        return recovered
+    
     def receive_messages(self):
         """Receive and process messages from the server"""
+        # Messages are newline-delimited JSON documents
+        reader = self.client_socket.makefile('r', encoding='utf-8')
         while self.connected:
             try:
-                data = self.client_socket.recv(1024).decode('utf-8')
+                data = reader.readline()
                 if not data:
                     print("Connection to server lost")
                     self.connected = False
@@ -170,13 +395,26 @@ class DistributedTaskClient:
                     self.task_results[task_id] = task_result
                     # Remove from pending tasks
                     task_info = self.tasks_pending.pop(task_id)
+                    self.task_progress.pop(task_id, None)
                     
                     # Calculate task duration
                     submit_time = task_info.get('submit_time', 0)
                     duration = time.time() - submit_time
                     
-                    print(f"Task {task_id} completed by {sender} in {duration:.2f}s")
-                    print(f"Result: {task_result.get('result')}")
+                    if task_result.get('expired'):
+                        print(f"Task {task_id} expired after {duration:.2f}s without being started")
+                    elif task_result.get('cancelled'):
+                        print(f"Task {task_id} cancelled after {duration:.2f}s")
+                    else:
+                        print(f"Task {task_id} completed by {sender} in {duration:.2f}s")
+                        print(f"Result: {task_result.get('result')}")
+                        if task_result.get('deadline_missed'):
+                            print("The result arrived after the task's deadline")
+                elif task_id and task_id not in self.task_results:
+                    # Kept by the server while we were offline, e.g. before this client restarted
+                    self.task_results[task_id] = task_result
+                    print(f"Task {task_id} finished while you were away (by {sender})")
+                    print(f"Result: {task_result.get('result', task_result.get('error'))}")
             else:
                 print(f"[Direct from {sender}] {msg_text}")
         
@@ -184,15 +422,95 @@ class DistributedTaskClient:
             msg_text = message.get('message', '')
             print(f"[System] {msg_text}")
         
+        elif message_type == 'rejected':
+            # Sent instead of accepting the session; connect_with_backoff retries later
+            self.rejection = message
+            print(f"Server rejected the connection ({message.get('reason')}), retry after {message.get('retry_after')}s")
+            self.connected = False
+        
         elif message_type == 'client_list':
             self.client_list = message.get('clients', [])
+            self.presence_epoch = message.get('epoch')
+            self.presence_version = message.get('version')
+            self.presence_resync = False
             print("Connected clients:")
             for client in self.client_list:
                 print(f"- {client}")
+        
+        elif message_type == 'presence_delta':
+            self.apply_presence_delta(message)
+        
+        elif message_type == 'stats':
+            depths = message.get('gauges', {}).get('task_queue_depth', {})
+            print("Task queues:")
+            for priority, depth in depths.items():
+                wait = message.get('timings', {}).get(f"task_wait.{priority}", {})
+                print(f"- {priority}: {depth} queued, average wait {wait.get('avg', 0):.2f}s, max {wait.get('max', 0):.2f}s")
+            for task_type, hedging in message.get('gauges', {}).get('hedging', {}).items():
+                saved = message.get('timings', {}).get(f"hedge_latency_saved.{task_type}", {})
+                print(f"Hedged {task_type}: {hedging['hedged']} of {hedging['completed']} tasks ({hedging['rate']:.0%}), "
+                      f"{hedging['won']} won, average {saved.get('avg', 0):.2f}s saved")
+        
+        elif message_type == 'cancel_result':
+            status = message.get('status')
+            if status in ('cancelling', 'forwarded'):
+                print(f"Task {message.get('task_id')} is being stopped by its worker")
+            elif status == 'not_found':
+                print(f"Task {message.get('task_id')} not found")
+            elif status == 'error':
+                print(f"Task {message.get('task_id')} could not be cancelled: {message.get('error')}")
+            elif status != 'cancelled':
+                print(f"Task {message.get('task_id')} could not be cancelled: {status}")
+        
+        elif message_type == 'progress':
+            task_id = message.get('task_id')
+            task_info = self.tasks_pending.get(task_id)
+            if task_info is None:
+                return
+            self.task_progress[task_id] = message
+            callbacks = task_info.get('on_progress')
+            if callbacks:
+                for callback in callbacks:
+                    callback(message)
+            else:
+                details = f"Task {task_id}: {message.get('percent') or 0:.0f}%"
+                if message.get('throughput') is not None:
+                    details += f", {message['throughput']:.1f} items/s"
+                if message.get('partial_result') is not None:
+                    details += f", partial result {message['partial_result']}"
+                print(details)
+        
+        elif message_type == 'workflow_result':
+            workflow_id = message.get('workflow_id')
+            self.workflow_results[workflow_id] = message
+            submit_time = self.workflows_pending.pop(workflow_id, None)
+            duration = f" in {time.time() - submit_time:.2f}s" if submit_time else ""
+            if message.get('status') == 'completed':
+                print(f"Workflow {workflow_id} completed{duration}")
+                print(f"Result: {message.get('result')}")
+            else:
+                print(f"Workflow {workflow_id} {message.get('status')}{duration}: {message.get('error')}")
+        
+        elif message_type == 'workflow_status':
+            self.workflow_status[message.get('workflow_id')] = message.get('workflow')
+        
+        elif message_type in ('task_query_result', 'history_query_result'):
+            query = self.queries.get(message.get('query_id'))
+            if query is None:
+                return
+            if message.get('error'):
+                print(f"Query failed: {message['error']}")
+            items = message.get('items', [])
+            query['items'].extend(items)
+            if query['on_page'] and items:
+                query['on_page'](items)
+            if message.get('done'):
+                query['next_before_id'] = message.get('next_before_id')
+                query['done'].set()
     
     def run_interactive(self):
         """Run an interactive task client session"""
-        if not self.connect():
+        if not self.connect_with_backoff():
             return
         
         print("\nCommands:")
@@ -201,6 +519,13 @@ class DistributedTaskClient:
         print("  /calculate <worker> <operation> <numbers> - Submit a calculation task")
         print("  /text <worker> <operation> <text> - Submit a text processing task")
         print("  /results - Show task results")
+        print("  /cancel <task_id> - Cancel one of your pending tasks")
+        print("  /wordcount <text> [| <text> ...] - Count the words of each text in uppercase and sum them on the server")
+        print("  /priority <high|normal|low> - Priority of the tasks you submit next")
+        print("  /deadline <seconds|off> - Deadline of the tasks you submit next")
+        print("  /stats - Show task queue depths and wait times")
+        print("  /tasks [status] - List your tasks stored on the server")
+        print("  /recover - Resume tracking your pending tasks after a restart")
         print("  /quit - Disconnect and exit")
         
         try:
@@ -252,6 +577,56 @@ class DistributedTaskClient:
                         print("Usage: /text <worker> <operation> <text>")
                         print("Operations: count_words, count_chars, uppercase, lowercase")
                 
+                elif user_input.lower().startswith('/cancel '):
+                    self.cancel_task(user_input[8:].strip())
+                
+                elif user_input.lower().startswith('/wordcount '):
+                    # One workflow: uppercase each text, count its words, then sum the counts
+                    texts = [text.strip() for text in user_input[11:].split('|') if text.strip()]
+                    nodes = []
+                    for index, text in enumerate(texts):
+                        nodes.append({'id': f"upper{index}", 'task_type': 'process_text',
+                                      'params': {'operation': 'uppercase', 'text': text}})
+                        nodes.append({'id': f"count{index}", 'task_type': 'process_text',
+                                      'params': {'operation': 'count_words', 'text': {'$ref': f"upper{index}"}}})
+                    nodes.append({'id': 'total', 'task_type': 'calculate',
+                                  'params': {'operation': 'sum',
+                                             'numbers': [{'$ref': f"count{index}"} for index in range(len(texts))]}})
+                    self.submit_workflow(nodes)
+                
+                elif user_input.lower() == '/tasks' or user_input.lower().startswith('/tasks '):
+                    status = user_input[7:].strip() or None
+                    answer = self.query_tasks(status=status, limit=20)
+                    if answer is None:
+                        print("No answer from server")
+                    elif not answer[0]:
+                        print("No tasks found")
+                    else:
+                        for task in answer[0]:
+                            print(f"Task {task['task_id']} [{task['status']}] {task['task_type']} on {task['worker']}")
+                
+                elif user_input.lower().startswith('/priority '):
+                    priority = user_input[10:].strip().lower()
+                    if priority in ('high', 'normal', 'low'):
+                        self.priority = priority
+                        print(f"New tasks will be submitted with {priority} priority")
+                    else:
+                        print("Usage: /priority <high|normal|low>")
+                
+                elif user_input.lower().startswith('/deadline '):
+                    value = user_input[10:].strip().lower()
+                    try:
+                        self.deadline = None if value == 'off' else float(value)
+                        print(f"Deadline for new tasks: {value if self.deadline is None else f'{self.deadline}s'}")
+                    except ValueError:
+                        print("Usage: /deadline <seconds|off>")
+                
+                elif user_input.lower() == '/stats':
+                    self.request_stats()
+                
+                elif user_input.lower() == '/recover':
+                    print(f"Recovered {self.recover_tasks()} pending tasks")
+                
                 elif user_input.lower() == '/results':
                     if self.task_results:
                         print("Task results:")
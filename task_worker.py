@@ -4,6 +4,7 @@ import json
 import time
 import sys
 import random
+from profiler import SamplingProfiler, install_signal_toggle
 
 class DistributedTaskWorker:
     def __init__(self, name, host='localhost', port=5000):
@@ -14,6 +15,13 @@ class DistributedTaskWorker:
         self.connected = False
         self.client_list = []
         self.processing = False
+        self.current_task = None  # ID of the task being processed
+        self.cancel_event = threading.Event()  # Set when the server cancels the current task
+        self.processing_delay = (1, 5)  # Simulated processing time range in seconds
+        self.progress_interval = 0.5  # Seconds between progress reports while a task runs
+        self.deadline_stats = {'met': 0, 'missed': 0, 'expired': 0}  # Outcomes of tasks that had a deadline
+        self.profiler = SamplingProfiler()
+        self.rejection = None  # The last 'rejected' frame from the server
         
     def connect(self):
         """Connect to the server"""
@@ -23,9 +31,11 @@ class DistributedTaskWorker:
             print(f"Worker {self.name} connected to server at {self.host}:{self.port}")
             
             # Register with the server
+            # Workers do not use the client list, so skip presence updates
             self.send_message({
                 'type': 'register',
-                'name': f"Worker-{self.name}"
+                'name': f"Worker-{self.name}",
+                'presence': False
             })
             
             # Start a thread to receive messages
@@ -38,10 +48,37 @@ class DistributedTaskWorker:
             print(f"Error connecting to server: {e}")
             return False
     
+    def connect_with_backoff(self, attempts=5, settle=0.3):
+        """Connect, backing off and retrying while the server turns us away"""
+        for attempt in range(attempts):
+            self.rejection = None
+            if self.connect():
+                # A full server rejects at once, a used-up quota right after registering
+                settle_until = time.time() + settle
+                while self.connected and self.rejection is None and time.time() < settle_until:
+                    time.sleep(0.05)
+                if self.connected and self.rejection is None:
+                    return True
+            if attempt + 1 == attempts:
+                break
+            # Exponential backoff from the server's hint, with jitter so rejected clients spread out
+            retry_after = (self.rejection or {}).get('retry_after', 1.0)
+            delay = retry_after * 2 ** attempt * random.uniform(0.5, 1.5)
+            print(f"Retrying in {delay:.1f}s...")
+            time.sleep(delay)
+            self.client_socket.close()
+            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        return False
+    
     def disconnect(self):
         """Disconnect from the server"""
         if self.connected:
             self.connected = False
+            try:
+                # Wake up the receive thread, which holds a file object on the socket
+                self.client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.client_socket.close()
             print(f"Worker {self.name} disconnected from server")
     
@@ -52,7 +89,7 @@ class DistributedTaskWorker:
             return False
         
         try:
-            message_json = json.dumps(message)
+            message_json = json.dumps(message) + '\n'
             self.client_socket.sendall(message_json.encode('utf-8'))
             return True
         except Exception as e:
@@ -61,56 +98,122 @@ class DistributedTaskWorker:
             return False
     
     def broadcast_status(self, status):
-        """Broadcast worker status to all clients"""
+        """Publish worker status to the subscribers of the 'workers' channel"""
         return self.send_message({
-            'type': 'broadcast',
+            'type': 'publish',
+            'channel': 'workers',
             'message': f"Worker status: {status}"
         })
     
-    def process_task(self, task_data, task_id, requester):
+    def report_progress(self, task_id, requester, percent, partial_result=None, throughput=None):
+        """Tell the requester how far a task has got; the server coalesces frequent reports"""
+        return self.send_message({
+            'type': 'progress',
+            'target': requester,
+            'task_id': task_id,
+            'percent': percent,
+            'partial_result': partial_result,
+            'throughput': throughput
+        })
+    
+    def compute_result(self, task_type, task_params):
+        """Result of a task from its type and parameters"""
+        result = None
+        if task_type == 'calculate':
+            operation = task_params.get('operation')
+            numbers = task_params.get('numbers', [])
+            
+            if operation == 'sum':
+                result = sum(numbers)
+            elif operation == 'average':
+                result = sum(numbers) / len(numbers) if numbers else 0
+            elif operation == 'max':
+                result = max(numbers) if numbers else None
+            elif operation == 'min':
+                result = min(numbers) if numbers else None
+        
+        elif task_type == 'process_text':
+            text = task_params.get('text', '')
+            operation = task_params.get('operation')
+            
+            if operation == 'count_words':
+                result = len(text.split())
+            elif operation == 'count_chars':
+                result = len(text)
+            elif operation == 'uppercase':
+                result = text.upper()
+            elif operation == 'lowercase':
+                result = text.lower()
+        
+        return result
+    
+    def process_task(self, task_data, task_id, requester, deadline=None):
         """Process a task and return the result"""
-        self.processing = True
+        if deadline is not None and time.time() >= deadline:
+            # Nobody wants the result any more; report it instead of doing the work
+            self.deadline_stats['expired'] += 1
+            print(f"Task {task_id} from {requester} expired before it started")
+            self.processing = False
+            self.send_message({
+                'type': 'direct',
+                'target': requester,
+                'message': f"Task {task_id} expired before it started",
+                'task_result': {
+                    'task_id': task_id,
+                    'error': "Deadline passed before the task started",
+                    'expired': True
+                }
+            })
+            return
+        
         print(f"Processing task {task_id} from {requester}...")
         
-        # Simulate task processing with a delay
-        processing_time = random.uniform(1, 5)
-        time.sleep(processing_time)
+        task_type = task_data.get('task_type', 'unknown')
+        task_params = task_data.get('params', {})
+        numbers = task_params.get('numbers') if task_type == 'calculate' else None
+        
+        # Simulate task processing with a delay, reporting progress along the way.
+        # The wait is cut short if the server cancels the task
+        processing_time = random.uniform(*self.processing_delay)
+        start_time = time.time()
+        while True:
+            remaining = start_time + processing_time - time.time()
+            if remaining <= 0:
+                break
+            if self.cancel_event.wait(min(self.progress_interval, remaining)):
+                print(f"Task {task_id} from {requester} cancelled")
+                self.processing = False
+                self.send_message({
+                    'type': 'direct',
+                    'target': requester,
+                    'message': f"Task {task_id} cancelled",
+                    'task_result': {
+                        'task_id': task_id,
+                        'error': "Task cancelled",
+                        'cancelled': True
+                    }
+                })
+                return
+            
+            done = min(1.0, (time.time() - start_time) / processing_time)
+            partial_result = None
+            throughput = None
+            if isinstance(numbers, list) and numbers:
+                # A calculation over the numbers handled so far
+                processed = int(len(numbers) * done)
+                try:
+                    partial_result = self.compute_result(task_type, dict(task_params, numbers=numbers[:processed]))
+                except Exception:
+                    partial_result = None
+                throughput = processed / (time.time() - start_time)
+            self.report_progress(task_id, requester, round(done * 100, 1), partial_result, throughput)
         
         # Simple task processing logic
         try:
             # For demonstration, we'll just perform some basic operations based on task_type
-            task_type = task_data.get('task_type', 'unknown')
-            task_params = task_data.get('params', {})
-            
-            result = None
-            if task_type == 'calculate':
-                operation = task_params.get('operation')
-                numbers = task_params.get('numbers', [])
-                
-                if operation == 'sum':
-                    result = sum(numbers)
-                elif operation == 'average':
-                    result = sum(numbers) / len(numbers) if numbers else 0
-                elif operation == 'max':
-                    result = max(numbers) if numbers else None
-                elif operation == 'min':
-                    result = min(numbers) if numbers else None
-            
-            elif task_type == 'process_text':
-                text = task_params.get('text', '')
-                operation = task_params.get('operation')
-                
-                if operation == 'count_words':
-                    result = len(text.split())
-                elif operation == 'count_chars':
-                    result = len(text)
-                elif operation == 'uppercase':
-                    result = text.upper()
-                elif operation == 'lowercase':
-                    result = text.lower()
+            result = self.compute_result(task_type, task_params)
             
-            # Send the result back to the requester
-            self.send_message({
+            reply = {
                 'type': 'direct',
                 'target': requester,
                 'message': f"Task {task_id} completed in {processing_time:.2f}s",
@@ -119,14 +222,14 @@ class DistributedTaskWorker:
                     'result': result,
                     'processing_time': processing_time
                 }
-            })
+            }
             
             print(f"Task {task_id} completed. Result: {result}")
         
         except Exception as e:
             print(f"Error processing task: {e}")
             # Notify the requester about the error
-            self.send_message({
+            reply = {
                 'type': 'direct',
                 'target': requester,
                 'message': f"Error processing task {task_id}: {str(e)}",
@@ -134,16 +237,26 @@ class DistributedTaskWorker:
                     'task_id': task_id,
                     'error': str(e)
                 }
-            })
+            }
         
-        finally:
-            self.processing = False
+        if deadline is not None:
+            # Stored with the result by the server's update_task_result
+            missed = time.time() > deadline
+            self.deadline_stats['missed' if missed else 'met'] += 1
+            reply['task_result']['deadline_missed'] = missed
+        
+        # The server sends the next queued task as soon as it sees the result,
+        # so be ready for it before replying
+        self.processing = False
+        self.send_message(reply)
     
     def receive_messages(self):
         """Receive and process messages from the server"""
+        # Messages are newline-delimited JSON documents
+        reader = self.client_socket.makefile('r', encoding='utf-8')
         while self.connected:
             try:
-                data = self.client_socket.recv(1024).decode('utf-8')
+                data = reader.readline()
                 if not data:
                     print("Connection to server lost")
                     self.connected = False
@@ -173,9 +286,12 @@ class DistributedTaskWorker:
             
             if task_data and task_id and not self.processing:
                 # Process the task in a separate thread
+                self.processing = True
+                self.current_task = task_id
+                self.cancel_event.clear()
                 task_thread = threading.Thread(
                     target=self.process_task,
-                    args=(task_data, task_id, sender)
+                    args=(task_data, task_id, sender, message.get('deadline'))
                 )
                 task_thread.daemon = True
                 task_thread.start()
@@ -186,14 +302,29 @@ class DistributedTaskWorker:
             msg_text = message.get('message', '')
             print(f"[System] {msg_text}")
         
+        elif message_type == 'cancel_task':
+            # Sent when a hedged copy of the task finished first on another worker, and when the
+            # requester cancels the task; either way the task stops at its next check
+            if self.processing and message.get('task_id') == self.current_task:
+                self.cancel_event.set()
+        
+        elif message_type == 'rejected':
+            # Sent instead of accepting the session; connect_with_backoff retries later
+            self.rejection = message
+            print(f"Server rejected the connection ({message.get('reason')}), retry after {message.get('retry_after')}s")
+            self.connected = False
+        
         elif message_type == 'client_list':
             self.client_list = message.get('clients', [])
     
     def run(self):
         """Run the worker"""
-        if not self.connect():
+        if not self.connect_with_backoff():
             return
         
+        # SIGUSR1 starts/stops the profiler without restarting the worker
+        install_signal_toggle(self.profiler)
+        
         print(f"Worker {self.name} is running and waiting for tasks...")
         self.broadcast_status("ready for tasks")
         
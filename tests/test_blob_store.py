@@ -0,0 +1,70 @@
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blob_store import BlobRef
+from data_transfer import export_table, import_table
+from db_manager import DatabaseManager
+
+
+class BlobStoreTest(unittest.TestCase):
+    """Large payloads live in the blobs table, are read lazily and collected once unused"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.db = DatabaseManager(os.path.join(self.directory, 'test.db'), blob_threshold=1024)
+        self.numbers = list(range(1000))
+
+    def blob_count(self):
+        conn = sqlite3.connect(self.db.db_path)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_payloads_load_lazily_by_default(self):
+        self.db.store_task('t1', 'calculate', 'Worker-a', 'TaskClient-c', {'numbers': self.numbers})
+        for task in (self.db.get_task('t1'), self.db.get_tasks_by_requester('TaskClient-c')[0],
+                     self.db.query_tasks(task_ids=['t1'])[0]):
+            self.assertIsInstance(task['parameters'], BlobRef)
+            self.assertEqual(task['parameters'].load(), {'numbers': self.numbers})
+            self.assertEqual(json.loads(bytes(task['parameters'].view())), {'numbers': self.numbers})
+        self.assertEqual(self.db.get_task('t1', load_blobs=True)['parameters'], {'numbers': self.numbers})
+        # Loading a copy never puts the payload into the cache
+        self.assertIsInstance(self.db.get_task('t1')['parameters'], BlobRef)
+
+    def test_shared_payloads_are_stored_once(self):
+        for task_id in ('t1', 't2'):
+            self.db.store_task(task_id, 'calculate', 'Worker-a', 'TaskClient-c', {'numbers': self.numbers})
+        self.assertEqual(self.blob_count(), 1)
+
+    def test_replaced_payloads_are_collected(self):
+        self.db.store_task('t1', 'calculate', 'Worker-a', 'TaskClient-c', {'numbers': self.numbers})
+        self.db.update_task_result('t1', {'result': self.numbers})
+        self.db.update_task_result('t1', {'result': self.numbers[::-1]})
+        self.assertEqual(self.blob_count(), 3)
+        self.assertEqual(self.db.delete_unused_blobs(), 1)
+        self.assertEqual(self.db.get_task('t1', load_blobs=True)['result'], {'result': self.numbers[::-1]})
+
+    def test_import_collects_the_blobs_it_leaves_unused(self):
+        # Imports store blobs at the default threshold
+        self.numbers = list(range(20000))
+        self.db.store_task('t1', 'calculate', 'Worker-a', 'TaskClient-c', {'numbers': self.numbers})
+        self.db.update_task_result('t1', {'result': self.numbers})
+        path = os.path.join(self.directory, 'tasks.jsonl')
+        export_table(self.db.db_path, 'tasks', path)
+        # Change the result so the import replaces a blob
+        self.db.update_task_result('t1', {'result': self.numbers[::-1]})
+        import_table(self.db.db_path, 'tasks', path, keep_ids=True, on_conflict='replace')
+        self.assertEqual(self.blob_count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
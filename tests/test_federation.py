@@ -0,0 +1,71 @@
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import DistributedServer
+
+
+class PeerAuthenticationTest(unittest.TestCase):
+    """peer_hello on the client port needs the shared peer token"""
+
+    def start_server(self, peer_token):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        server = DistributedServer('localhost', 0, os.path.join(directory.name, 'test.db'),
+                                   peer_token=peer_token, outbox_ttl=0)
+        thread = threading.Thread(target=server.start, daemon=True)
+        thread.start()
+        deadline = time.time() + 5
+        while not server.running and time.time() < deadline:
+            time.sleep(0.01)
+        self.addCleanup(server.stop)
+        return server, server.server_socket.getsockname()[1]
+
+    def hello(self, port, token):
+        """Send a peer_hello and return the server's first frame (None if it hung up)"""
+        sock = socket.create_connection(('localhost', port), timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall((json.dumps({
+            'type': 'peer_hello',
+            'node': 'intruder',
+            'address': ['localhost', 1],
+            'token': token
+        }) + '\n').encode('utf-8'))
+        reply = sock.makefile('r', encoding='utf-8').readline()
+        return json.loads(reply) if reply else None
+
+    def assert_not_registered(self, server):
+        self.assertEqual(server.federation.inbound_counts, {})
+        self.assertEqual(server.federation.links_by_address, {})
+        self.assertEqual(server.metrics.snapshot()['counters'].get('peers_rejected'), 1)
+
+    def test_hello_without_token_is_rejected(self):
+        server, port = self.start_server('secret')
+        self.assertIsNone(self.hello(port, None))
+        self.assert_not_registered(server)
+
+    def test_hello_with_wrong_token_is_rejected(self):
+        server, port = self.start_server('secret')
+        self.assertIsNone(self.hello(port, 'guess'))
+        self.assert_not_registered(server)
+
+    def test_server_without_token_accepts_no_peers(self):
+        server, port = self.start_server(None)
+        self.assertIsNone(self.hello(port, None))
+        self.assert_not_registered(server)
+
+    def test_hello_with_token_is_welcomed(self):
+        server, port = self.start_server('secret')
+        welcome = self.hello(port, 'secret')
+        self.assertEqual(welcome['type'], 'peer_welcome')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_log import REMAP_BYTES, MessageLog
+
+
+class MessageLogRangeTest(unittest.TestCase):
+    """Time-range queries with timestamps that go back in time"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def open_log(self):
+        # Tiny segments and index blocks, so every code path is crossed
+        log = MessageLog(self.directory, segment_bytes=2048, index_bytes=256)
+        self.addCleanup(log.close)
+        return log
+
+    def append_out_of_order(self, log):
+        rows = [('broadcast', 'alice', None, f"live {i}", 1000.0 + i) for i in range(100)]
+        # Imported rows and batched presence events keep their original, older times
+        rows[40:40] = [('system', 'System', None, f"imported {i}", 500.0 + i) for i in range(30)]
+        rows += [('system', 'System', None, f"late {i}", 1050.5 + i) for i in range(10)]
+        log.append_many(rows)
+        return rows
+
+    def expected(self, rows, start_time, end_time):
+        return sorted(content for _, _, _, content, timestamp in rows if start_time <= timestamp <= end_time)
+
+    def assert_ranges(self, log, rows):
+        for start_time, end_time in [(500, 529), (510, 1010), (1040, 1060), (0, 2000), (1099, 1099)]:
+            messages = log.get_messages_between(start_time, end_time)
+            self.assertEqual(sorted(message['content'] for message in messages),
+                             self.expected(rows, start_time, end_time))
+            self.assertEqual([message['timestamp'] for message in messages],
+                             sorted(message['timestamp'] for message in messages))
+
+    def test_range_returns_out_of_order_timestamps(self):
+        log = self.open_log()
+        rows = self.append_out_of_order(log)
+        self.assertGreater(len(log.segments), 2)
+        self.assert_ranges(log, rows)
+
+    def test_range_after_reopening(self):
+        log = self.open_log()
+        rows = self.append_out_of_order(log)
+        log.close()
+        self.assert_ranges(self.open_log(), rows)
+
+    def test_query_by_time_uses_the_index_and_finds_every_row(self):
+        log = self.open_log()
+        rows = self.append_out_of_order(log)
+        for since, until in [(500, 529), (510, 1010), (1040, 1060), (None, 1020), (1090, None)]:
+            messages = log.query_messages(since=since, until=until, limit=1000)
+            expected = self.expected(rows, since if since is not None else 0, until if until is not None else 2000)
+            self.assertEqual(sorted(message['content'] for message in messages), expected)
+            # Newest first, by id
+            self.assertEqual([message['id'] for message in messages],
+                             sorted((message['id'] for message in messages), reverse=True))
+
+    def test_query_by_time_pages_with_before_id(self):
+        log = self.open_log()
+        log.append_many([('broadcast', 'alice', None, f"m {i}", 1000.0 + i) for i in range(200)])
+        seen = []
+        before_id = None
+        while True:
+            page = log.query_messages(since=1050, until=1149, before_id=before_id, limit=30)
+            if not page:
+                break
+            seen += [message['content'] for message in page]
+            before_id = page[-1]['id']
+        self.assertEqual(seen, [f"m {i}" for i in range(149, 49, -1)])
+
+    def test_appends_reuse_the_map_until_remap_bytes(self):
+        log = MessageLog(self.directory)
+        self.addCleanup(log.close)
+        log.append('broadcast', 'alice', 'first', timestamp=1000.0)
+        self.assertEqual(len(log.get_recent_messages()), 1)
+        segment = log.segments[-1]
+        first_map = segment._map
+        for i in range(10):
+            log.append('broadcast', 'alice', f"small {i}", timestamp=1001.0 + i)
+            # The appended records are read past the end of the same map
+            self.assertEqual(log.get_recent_messages(limit=1)[0]['content'], f"small {i}")
+        self.assertIs(segment._map, first_map)
+
+        log.append('broadcast', 'alice', 'x' * REMAP_BYTES, timestamp=2000.0)
+        self.assertEqual(log.get_recent_messages(limit=1)[0]['timestamp'], 2000.0)
+        self.assertIsNot(segment._map, first_map)
+        self.assertTrue(first_map.closed)
+        self.assertEqual(segment._retired, [])
+
+    def test_reopen_keeps_ordered_segments_and_cuts_torn_tail(self):
+        log = self.open_log()
+        log.append_many([('broadcast', 'alice', None, f"m {i}", 1000.0 + i) for i in range(20)])
+        log.close()
+        path = log.segments[-1].path
+        with open(path, 'ab') as f:
+            f.write(b'\x10\x00\x00\x00torn')
+        size = os.path.getsize(path)
+
+        reopened = self.open_log()
+        self.assertTrue(all(segment.ordered for segment in reopened.segments))
+        self.assertEqual(os.path.getsize(path), size - 8)
+        self.assertEqual(reopened.get_last_message_id(), 20)
+        self.assertEqual(len(reopened.get_messages_between(1005, 1010)), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
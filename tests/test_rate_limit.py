@@ -0,0 +1,46 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rate_limit import ClientRateLimiter, TokenBucket, message_category, parse_limit
+
+
+class RateLimitTest(unittest.TestCase):
+    """Token buckets allow bursts, then space messages out at their rate"""
+
+    def test_bucket_allows_the_burst_then_asks_to_wait(self):
+        bucket = TokenBucket(rate=10, burst=3)
+        self.assertEqual([bucket.take() for _ in range(3)], [0.0, 0.0, 0.0])
+        # Each token taken in debt waits one more interval
+        self.assertAlmostEqual(bucket.take(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.take(), 0.2, places=2)
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit('task=2:5'), ('task', 2.0, 5.0))
+        self.assertEqual(parse_limit('direct=0.5'), ('direct', 0.5, 1.0))
+        with self.assertRaises(ValueError):
+            parse_limit('chat=1')
+        with self.assertRaises(ValueError):
+            parse_limit('all=0')
+
+    def test_message_category(self):
+        self.assertEqual(message_category({'type': 'publish'}), 'broadcast')
+        self.assertEqual(message_category({'type': 'direct', 'task_data': {}}), 'task')
+        self.assertEqual(message_category({'type': 'direct'}), 'direct')
+        self.assertIsNone(message_category({'type': 'direct', 'task_result': {}}))
+        self.assertIsNone(message_category({'type': 'status'}))
+
+    def test_all_limit_applies_on_top_of_the_category(self):
+        limiter = ClientRateLimiter({'direct': (100, 10), 'all': (1, 1)})
+        self.assertEqual(limiter.delay({'type': 'direct'}), (0.0, None))
+        wait, limited_by = limiter.delay({'type': 'direct'})
+        self.assertGreater(wait, 0.9)
+        self.assertEqual(limited_by, 'all')
+        # Task results are never held back
+        self.assertEqual(limiter.delay({'type': 'direct', 'task_result': {}})[1], 'all')
+
+
+if __name__ == '__main__':
+    unittest.main()
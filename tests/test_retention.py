@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_manager import DatabaseManager
+from retention import MessageArchiver, RetentionPolicy
+
+
+class RetentionTest(unittest.TestCase):
+    """Policies pick messages by their own timestamp and type, whatever their id"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db = DatabaseManager(os.path.join(directory.name, 'test.db'), task_cache_size=0)
+        self.archive_dir = os.path.join(directory.name, 'archive')
+
+    def insert(self, rows):
+        """Store (message_type, content, age in seconds) rows in id order"""
+        now = time.time()
+        conn = sqlite3.connect(self.db.db_path)
+        conn.executemany(
+            "INSERT INTO messages (message_type, sender, target, content, timestamp) VALUES (?, 'alice', NULL, ?, ?)",
+            [(message_type, content, now - age) for message_type, content, age in rows]
+        )
+        conn.commit()
+        conn.close()
+
+    def contents(self):
+        return sorted(message['content'] for message in self.db.query_messages(limit=1000))
+
+    def archive(self, policy):
+        archiver = MessageArchiver(self.db, self.archive_dir, [RetentionPolicy.parse(policy)], pause=0)
+        return archiver.run_once()
+
+    def test_max_age_follows_timestamps_not_ids(self):
+        # Imported rows and late presence batches: old timestamps among new ids
+        self.insert([('broadcast', 'new 1', 10), ('broadcast', 'old 1', 7200),
+                     ('broadcast', 'new 2', 5), ('broadcast', 'old 2', 3 * 3600), ('broadcast', 'new 3', 1)])
+        self.assertEqual(self.archive('max_age=1h'), 2)
+        self.assertEqual(self.contents(), ['new 1', 'new 2', 'new 3'])
+
+    def test_max_age_only_archives_the_policy_types(self):
+        self.insert([('broadcast', 'old broadcast', 7200), ('system', 'old system', 7200),
+                     ('broadcast', 'older broadcast', 9000), ('system', 'new system', 0),
+                     ('broadcast', 'new broadcast', 0)])
+        self.assertEqual(self.archive('max_age=1h,types=system'), 1)
+        self.assertEqual(self.contents(), ['new broadcast', 'new system', 'old broadcast', 'older broadcast'])
+
+    def test_max_count_keeps_the_newest_of_the_policy_types(self):
+        self.insert([('system', f"system {i}", 0) for i in range(5)] + [('broadcast', 'broadcast', 0)])
+        self.assertEqual(self.archive('max_count=2,types=system'), 3)
+        self.assertEqual(self.contents(), ['broadcast', 'system 3', 'system 4'])
+
+    def test_archived_messages_can_be_queried(self):
+        self.insert([('broadcast', 'old', 7200), ('broadcast', 'new', 0)])
+        self.archive('max_age=1h')
+        archiver = MessageArchiver(self.db, self.archive_dir, [])
+        self.assertEqual([message['content'] for message in archiver.query_archive()], ['old'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+import unittest
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scheduler
+from metrics import ServerMetrics
+from scheduler import PRIORITY_WEIGHTS, QueuedTask, TaskScheduler, WorkerQueue, parse_weights
+
+
+class SchedulingTest(unittest.TestCase):
+    """Weighted round-robin over the classes, earliest deadline first within one"""
+
+    def setUp(self):
+        self.sent = []  # (message, worker)
+        self.expired = []
+        self.scheduler = TaskScheduler(self.send, ServerMetrics(), on_expire=self.expired.append)
+
+    def send(self, message, worker):
+        self.sent.append((message, worker))
+        return True
+
+    def submit(self, task_id, priority='normal', deadline=None):
+        self.scheduler.submit(task_id, 'w1', priority, {'task_id': task_id, 'target': 'w1'}, deadline)
+
+    def test_weighted_round_robin_interleaves_the_classes(self):
+        queue = WorkerQueue()
+        for priority in ('high', 'normal', 'low'):
+            for i in range(10):
+                queue.push(QueuedTask(f"{priority}-{i}", 'w1', priority, {}))
+        order = [queue.pop(PRIORITY_WEIGHTS).priority for _ in range(7)]
+        self.assertEqual(order, ['high', 'normal', 'high', 'low', 'high', 'normal', 'high'])
+
+    def test_a_class_left_alone_gets_every_turn(self):
+        queue = WorkerQueue()
+        queue.push(QueuedTask('low-0', 'w1', 'low', {}))
+        queue.push(QueuedTask('low-1', 'w1', 'low', {}))
+        self.assertEqual([queue.pop(PRIORITY_WEIGHTS).task_id for _ in range(2)], ['low-0', 'low-1'])
+        self.assertIsNone(queue.pop(PRIORITY_WEIGHTS))
+
+    def test_earliest_deadline_goes_first_within_a_class(self):
+        now = time.time()
+        self.submit('busy')
+        self.submit('later', deadline=now + 60)
+        self.submit('none')
+        self.submit('sooner', deadline=now + 30)
+        self.assertEqual([message['task_id'] for message, _ in self.sent], ['busy'])
+        for task_id in ('busy', 'sooner', 'later'):
+            self.scheduler.complete('w1', task_id)
+        self.assertEqual([message['task_id'] for message, _ in self.sent], ['busy', 'sooner', 'later', 'none'])
+
+    def test_sweep_expires_queued_tasks_past_their_deadline(self):
+        self.submit('busy')
+        self.submit('overdue', deadline=time.time() + 0.01)
+        self.submit('fine', deadline=time.time() + 60)
+        time.sleep(0.02)
+        self.assertEqual(self.scheduler.expire_overdue(), 1)
+        self.assertEqual([task.task_id for task in self.expired], ['overdue'])
+        self.assertEqual(self.scheduler.depths()['normal'], 1)
+
+    def test_parse_weights(self):
+        self.assertEqual(parse_weights('high=8,low=2'), {'high': 8, 'normal': 2, 'low': 2})
+        with self.assertRaises(ValueError):
+            parse_weights('urgent=3')
+        with self.assertRaises(ValueError):
+            parse_weights('low=0')
+
+
+class HedgingTest(unittest.TestCase):
+    """Hedged copies go to their own worker and never hold its slot for good"""
+
+    def setUp(self):
+        self.sent = []  # (message, worker)
+        self.scheduler = TaskScheduler(self.send, ServerMetrics(), hedge_types=['calculate'],
+                                       connected_workers=lambda: ['w1', 'w2'])
+        # Enough history for a threshold of about a second
+        self.scheduler.durations['calculate'] = deque([1.0] * scheduler.HEDGE_MIN_SAMPLES)
+        self.scheduler.hedge_stats['calculate'] = {'completed': scheduler.HEDGE_MIN_SAMPLES, 'hedged': 0, 'won': 0}
+
+    def send(self, message, worker):
+        self.sent.append((message, worker))
+        return True
+
+    def start_straggler(self):
+        message = {'type': 'direct', 'target': 'w1', 'sender': 'alice', 'task_id': 't1',
+                   'task_data': {'task_type': 'calculate'}}
+        self.scheduler.submit('t1', 'w1', 'normal', message)
+        self.scheduler.workers['w1'].running['t1'].started_at -= 5
+        self.assertEqual(self.scheduler.hedge_stragglers(), 1)
+        return self.sent[-1]
+
+    def test_copy_is_addressed_to_its_worker(self):
+        message, worker = self.start_straggler()
+        self.assertEqual(worker, 'w2')
+        self.assertEqual(message['target'], 'w2')
+        self.assertEqual(self.scheduler.workers['w1'].running['t1'].message['target'], 'w1')
+
+    def test_winner_frees_the_losers_slot_and_its_late_result_is_dropped(self):
+        self.start_straggler()
+        self.assertTrue(self.scheduler.claim('w1', 't1'))
+        self.assertIsNotNone(self.scheduler.complete('w1', 't1'))
+        self.assertEqual(self.sent[-1], ({'type': 'cancel_task', 'task_id': 't1',
+                                          'timestamp': self.sent[-1][0]['timestamp']}, 'w2'))
+        self.assertEqual(self.scheduler.running_count(), 0)
+        self.assertFalse(self.scheduler.claim('w2', 't1'))
+        self.assertIsNone(self.scheduler.complete('w2', 't1'))
+
+    def test_copy_that_never_answers_is_given_up(self):
+        self.start_straggler()
+        self.scheduler.workers['w2'].running['t1'].started_at -= scheduler.HEDGE_TIMEOUT + 1
+        self.assertEqual(self.scheduler.expire_hedges(), 1)
+        self.assertEqual(self.sent[-1][0]['type'], 'cancel_task')
+        self.assertEqual(self.sent[-1][1], 'w2')
+        self.assertNotIn('w2', self.scheduler.workers)
+        # The primary is no longer hedged and reports as usual
+        self.assertTrue(self.scheduler.claim('w1', 't1'))
+        self.assertIsNotNone(self.scheduler.complete('w1', 't1'))
+        self.assertEqual(self.scheduler.hedge_rates()['calculate']['won'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import json
+import os
+import socket
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import DistributedServer, parse_quota
+
+
+class ServerStateTest(unittest.TestCase):
+    """Presence versions, history rings and session quotas, without a running server"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_path = os.path.join(directory.name, 'test.db')
+        self.server = self.make_server()
+
+    def make_server(self, **options):
+        server = DistributedServer('localhost', 0, self.db_path, **options)
+        self.addCleanup(server.server_socket.close)
+        return server
+
+    def sync(self, server, since, epoch):
+        """Send a presence_sync answer to a socket pair and return the frame it wrote"""
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        server.send_presence_changes(ours, since, epoch)
+        return json.loads(theirs.makefile('r', encoding='utf-8').readline())
+
+    def test_presence_sync_merges_the_deltas_since_a_version(self):
+        epoch = self.server.presence_epoch
+        self.server.record_presence(added=['alice'])
+        self.server.record_presence(added=['bob'])
+        self.server.record_presence(removed=['alice'])
+        reply = self.sync(self.server, 1, epoch)
+        self.assertEqual(reply['type'], 'presence_delta')
+        self.assertEqual((reply['since'], reply['version']), (1, 3))
+        self.assertEqual(sorted(reply['added']), ['bob'])
+        self.assertEqual(reply['removed'], ['alice'])
+
+    def test_presence_sync_after_an_epoch_bump_gets_a_snapshot(self):
+        old_epoch = self.server.presence_epoch
+        self.server.record_presence(added=['alice'])
+        # A restarted server starts a new epoch with its own version numbers
+        restarted = self.make_server()
+        restarted.presence_epoch = old_epoch + '-restarted'
+        restarted.record_presence(added=['bob'])
+        reply = self.sync(restarted, 1, old_epoch)
+        self.assertEqual(reply['type'], 'client_list')
+        self.assertEqual(reply['epoch'], restarted.presence_epoch)
+        self.assertEqual(reply['version'], 1)
+        # From the new epoch on, deltas apply again
+        restarted.record_presence(added=['carol'])
+        reply = self.sync(restarted, 1, restarted.presence_epoch)
+        self.assertEqual((reply['type'], reply['added']), ('presence_delta', ['carol']))
+
+    def test_history_ring_keeps_the_newest_and_reads_older_from_disk(self):
+        server = self.make_server(history_size=3)
+        for i in range(5):
+            message = {'type': 'publish', 'sender': 'alice', 'message': f"m{i}", 'timestamp': i}
+            message_id = server.db.store_message('publish', 'alice', f"m{i}", 'news')
+            server.remember_message(('channel', 'news'), message_id, message)
+        ring = server.history[('channel', 'news')]
+        self.assertEqual([entry['message'] for entry in ring], ['m2', 'm3', 'm4'])
+        page, source = server.read_history(('channel', 'news'), limit=3)
+        self.assertEqual(([entry['message'] for entry in page], source), (['m4', 'm3', 'm2'], 'memory'))
+        page, source = server.read_history(('channel', 'news'), limit=5)
+        self.assertEqual([entry['message'] for entry in page], ['m4', 'm3', 'm2', 'm1', 'm0'])
+        self.assertEqual(source, 'memory+database')
+
+    def test_history_ring_stays_in_id_order(self):
+        server = self.make_server(history_size=3)
+        for message_id in (1, 3, 2):
+            server.remember_message(('target', 'bob'), message_id, {'type': 'direct', 'message': str(message_id)})
+        self.assertEqual([entry['id'] for entry in server.history[('target', 'bob')]], [1, 2, 3])
+
+    def test_session_quota(self):
+        self.assertEqual(parse_quota('worker=2'), ('worker', 2))
+        with self.assertRaises(ValueError):
+            parse_quota('robot=2')
+        server = self.make_server(session_quotas=dict([parse_quota('worker=2')]))
+        self.assertEqual([server.admit_session('worker') for _ in range(3)], [True, True, False])
+        self.assertTrue(server.admit_session('regular'))
+        self.assertEqual(server.session_counts['worker'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from task_cache import TaskCache
+
+
+def record(task_id, requester='alice', worker='w1'):
+    return {'task_id': task_id, 'requester': requester, 'worker': worker, 'status': 'pending'}
+
+
+class TaskCacheTest(unittest.TestCase):
+    """Per-requester and per-worker indexes only answer what they fully cover"""
+
+    def setUp(self):
+        self.cache = TaskCache(capacity=8)
+
+    def test_filled_list_is_served_and_kept_current_by_add(self):
+        self.cache.fill('requester', 'alice', [record('t2'), record('t1')], limit=10)
+        self.cache.add(record('t3'))
+        self.assertEqual([task['task_id'] for task in self.cache.get_many('requester', 'alice', 10)],
+                         ['t3', 't2', 't1'])
+        # No list of w1 was ever filled
+        self.assertIsNone(self.cache.get_many('worker', 'w1', 10))
+
+    def test_partial_list_covers_only_its_depth(self):
+        self.cache.fill('worker', 'w1', [record('t3'), record('t2')], limit=2)
+        self.assertEqual(len(self.cache.get_many('worker', 'w1', 2)), 2)
+        self.assertIsNone(self.cache.get_many('worker', 'w1', 3))
+
+    def test_eviction_cuts_the_index_at_the_evicted_task(self):
+        self.cache.fill('requester', 'alice', [record('t3'), record('t2'), record('t1')], limit=10)
+        # Leave t1 least recently used, then push it out
+        self.cache.get('t3')
+        self.cache.get('t2')
+        for i in range(6):
+            self.cache.add(record(f"b{i}", requester='bob'))
+        # t3 and t2 are still cached, but t1 went, so only the two newest are known
+        self.assertIsNone(self.cache.get('t1'))
+        self.assertEqual([task['task_id'] for task in self.cache.get_many('requester', 'alice', 2)], ['t3', 't2'])
+        self.assertIsNone(self.cache.get_many('requester', 'alice', 3))
+
+    def test_update_changes_the_cached_record_and_callers_get_copies(self):
+        self.cache.add(record('t1'))
+        self.cache.update('t1', {'status': 'completed'})
+        task = self.cache.get('t1')
+        self.assertEqual(task['status'], 'completed')
+        task['status'] = 'changed'
+        self.assertEqual(self.cache.get('t1')['status'], 'completed')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from workflow import parse_workflow, resolve_refs
+
+
+def node(node_id, params=None, after=None):
+    definition = {'id': node_id, 'task_type': 'calculate', 'params': params or {}}
+    if after is not None:
+        definition['after'] = after
+    return definition
+
+
+class ParseWorkflowTest(unittest.TestCase):
+    """Workflows are checked for bad references and cycles before anything runs"""
+
+    def test_dependencies_come_from_refs_and_after(self):
+        nodes, dependencies, output = parse_workflow([
+            node('a'),
+            node('b', {'numbers': [{'$ref': 'a'}, 1]}),
+            node('c', {'value': {'$ref': 'b'}}, after=['a'])
+        ])
+        self.assertEqual(set(nodes), {'a', 'b', 'c'})
+        self.assertEqual(dependencies, {'a': set(), 'b': {'a'}, 'c': {'a', 'b'}})
+        self.assertEqual(output, 'c')
+
+    def test_cycle_is_rejected(self):
+        with self.assertRaisesRegex(ValueError, 'cycle'):
+            parse_workflow([node('a', {'x': {'$ref': 'c'}}), node('b', {'x': {'$ref': 'a'}}),
+                            node('c', after=['b'])])
+
+    def test_self_reference_is_a_cycle(self):
+        with self.assertRaisesRegex(ValueError, 'cycle'):
+            parse_workflow([node('a', {'x': {'$ref': 'a'}})])
+
+    def test_unknown_reference_is_rejected(self):
+        with self.assertRaisesRegex(ValueError, 'unknown nodes: missing'):
+            parse_workflow([node('a', {'x': {'$ref': 'missing'}})])
+
+    def test_duplicate_ids_are_rejected(self):
+        with self.assertRaisesRegex(ValueError, 'Duplicate'):
+            parse_workflow([node('a'), node('a')])
+
+    def test_several_final_nodes_need_an_output(self):
+        with self.assertRaisesRegex(ValueError, 'output'):
+            parse_workflow([node('a'), node('b')])
+        self.assertEqual(parse_workflow([node('a'), node('b')], output='b')[2], 'b')
+        with self.assertRaisesRegex(ValueError, 'Unknown output'):
+            parse_workflow([node('a'), node('b')], output='c')
+
+    def test_resolve_refs_substitutes_results(self):
+        params = {'numbers': [{'$ref': 'a'}, 2], 'nested': {'value': {'$ref': 'b'}}}
+        self.assertEqual(resolve_refs(params, {'a': 1, 'b': {'sum': 3}}),
+                         {'numbers': [1, 2], 'nested': {'value': {'sum': 3}}})
+
+
+if __name__ == '__main__':
+    unittest.main()
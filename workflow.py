@@ -0,0 +1,248 @@
+import sqlite3
+import threading
+import time
+import uuid
+from scheduler import DEFAULT_PRIORITY
+
+REF_KEY = '$ref'  # {"$ref": "node"} in a node's params stands for that node's result
+MAX_NODES = 1000  # Most nodes in one workflow
+
+
+def find_refs(value, refs=None):
+    """Ids of the nodes referenced anywhere in a params value"""
+    refs = set() if refs is None else refs
+    if isinstance(value, dict):
+        if len(value) == 1 and REF_KEY in value:
+            if not isinstance(value[REF_KEY], str):
+                raise ValueError(f"A {REF_KEY} must name a node")
+            refs.add(value[REF_KEY])
+        else:
+            for item in value.values():
+                find_refs(item, refs)
+    elif isinstance(value, list):
+        for item in value:
+            find_refs(item, refs)
+    return refs
+
+
+def resolve_refs(value, results):
+    """Copy of a params value with each reference replaced by the result of its node"""
+    if isinstance(value, dict):
+        if len(value) == 1 and REF_KEY in value:
+            return results[value[REF_KEY]]
+        return {key: resolve_refs(item, results) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve_refs(item, results) for item in value]
+    return value
+
+
+def parse_workflow(nodes, output=None):
+    """Check a workflow definition; returns ({node id: node}, {node id: ids it waits for}, output node id).
+
+    Each node is {'id', 'task_type', 'params'} with optional 'worker' and
+    'after' (ids of nodes to wait for without using their results). A node
+    waits for the nodes its params reference. The output node defaults to
+    the only node nothing depends on. Raises ValueError for a malformed
+    workflow, an unknown reference or a cycle.
+    """
+    if not isinstance(nodes, list) or not nodes:
+        raise ValueError("A workflow needs a list of nodes")
+    if len(nodes) > MAX_NODES:
+        raise ValueError(f"A workflow has at most {MAX_NODES} nodes")
+
+    by_id = {}
+    for node in nodes:
+        if not isinstance(node, dict) or not isinstance(node.get('id'), str) or not node.get('task_type'):
+            raise ValueError("Each node needs an 'id' and a 'task_type'")
+        if node['id'] in by_id:
+            raise ValueError(f"Duplicate node id: {node['id']}")
+        by_id[node['id']] = node
+
+    dependencies = {}
+    dependents = {node_id: [] for node_id in by_id}
+    for node_id, node in by_id.items():
+        after = node.get('after', [])
+        if not isinstance(after, list) or not all(isinstance(item, str) for item in after):
+            raise ValueError(f"'after' of node {node_id} must be a list of node ids")
+        dependencies[node_id] = find_refs(node.get('params', {})) | set(after)
+        unknown = dependencies[node_id] - set(by_id)
+        if unknown:
+            raise ValueError(f"Node {node_id} refers to unknown nodes: {', '.join(sorted(unknown))}")
+        for dependency in dependencies[node_id]:
+            dependents[dependency].append(node_id)
+
+    # Kahn's algorithm; nodes left over are on a cycle
+    waiting = {node_id: len(ids) for node_id, ids in dependencies.items()}
+    ready = [node_id for node_id, count in waiting.items() if count == 0]
+    visited = 0
+    while ready:
+        node_id = ready.pop()
+        visited += 1
+        for dependent in dependents[node_id]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                ready.append(dependent)
+    if visited < len(by_id):
+        raise ValueError("The workflow has a cycle")
+
+    if output is None:
+        sinks = [node_id for node_id, ids in dependents.items() if not ids]
+        if len(sinks) != 1:
+            raise ValueError("The workflow has several final nodes; name the output node")
+        output = sinks[0]
+    elif output not in by_id:
+        raise ValueError(f"Unknown output node: {output}")
+    return by_id, dependencies, output
+
+
+class Workflow:
+    """A running workflow: the nodes still waiting, the tasks running and the results so far"""
+
+    def __init__(self, workflow_id, requester, nodes, dependencies, output, priority):
+        self.workflow_id = workflow_id
+        self.requester = requester
+        self.nodes = nodes
+        self.output = output
+        self.priority = priority
+        self.waiting = {node_id: set(ids) for node_id, ids in dependencies.items()}  # Not started yet
+        self.dependents = {node_id: [] for node_id in nodes}
+        for node_id, ids in dependencies.items():
+            for dependency in ids:
+                self.dependents[dependency].append(node_id)
+        self.running = {}  # task_id -> node id
+        self.results = {}  # Node id -> result
+        self.status = 'running'
+        self.started_at = time.time()
+
+
+class WorkflowEngine:
+    """Runs workflows (DAGs of tasks) on the local workers without client round-trips.
+
+    Each node becomes an ordinary task, sent through the scheduler as soon
+    as the nodes it depends on have finished, so independent nodes run in
+    parallel. Node results stay on the server and are substituted into the
+    params of later nodes; the requester only gets a 'workflow_result' with
+    the output node's result, or the first error. Workflow and node states
+    are kept in the database.
+    """
+
+    def __init__(self, db, scheduler, workers, deliver):
+        self.db = db
+        self.scheduler = scheduler
+        self.workers = workers  # workers() -> names of the local workers
+        self.deliver = deliver  # deliver(message, requester) sends the outcome of a workflow
+        self.lock = threading.Lock()
+        self.tasks = {}  # task_id of a running node -> its Workflow
+
+    def submit(self, workflow_id, requester, nodes, output=None, priority=DEFAULT_PRIORITY):
+        """Check and start a workflow; raises ValueError if it cannot run"""
+        nodes_by_id, dependencies, output = parse_workflow(nodes, output)
+        workers = self.workers()
+        if not workers:
+            raise ValueError("No workers are connected")
+        for node in nodes_by_id.values():
+            if node.get('worker') is not None and node['worker'] not in workers:
+                raise ValueError(f"Worker {node['worker']} is not connected to this server")
+
+        try:
+            self.db.store_workflow(workflow_id, requester, nodes, output)
+        except sqlite3.IntegrityError:
+            raise ValueError(f"Workflow {workflow_id} already exists")
+
+        workflow = Workflow(workflow_id, requester, nodes_by_id, dependencies, output, priority)
+        self._start(workflow, [node_id for node_id, ids in workflow.waiting.items() if not ids])
+
+    def owns(self, task_id):
+        """Whether a task is a node of a workflow that is still running"""
+        with self.lock:
+            return task_id in self.tasks
+
+    def task_finished(self, task_id, task_result):
+        """Take a node's result and start the nodes it unblocks; False if the task is no workflow's"""
+        failed = task_result.get('error') is not None
+        ready = []
+        finished = False
+        with self.lock:
+            workflow = self.tasks.pop(task_id, None)
+            if workflow is None:
+                return False
+            node_id = workflow.running.pop(task_id)
+            if workflow.status != 'running':
+                # Already failed; the node's own state is still recorded below
+                pass
+            elif failed:
+                workflow.status = 'failed'
+                finished = True
+            else:
+                workflow.results[node_id] = task_result.get('result')
+                for dependent in workflow.dependents[node_id]:
+                    waiting = workflow.waiting[dependent]
+                    waiting.discard(node_id)
+                    if not waiting:
+                        ready.append(dependent)
+                if not workflow.waiting and not workflow.running:
+                    workflow.status = 'completed'
+                    finished = True
+
+        self.db.update_workflow_node(workflow.workflow_id, node_id, 'failed' if failed else 'completed')
+        if finished and failed:
+            self._finish(workflow, error=f"Node {node_id} failed: {task_result.get('error')}")
+        elif finished:
+            self._finish(workflow, result=workflow.results[workflow.output])
+        else:
+            self._start(workflow, ready)
+        return True
+
+    def _start(self, workflow, node_ids):
+        """Send nodes whose dependencies have all finished to workers"""
+        for node_id in node_ids:
+            node = workflow.nodes[node_id]
+            # Spread nodes that can run at the same time over the workers
+            worker = node.get('worker') or self.scheduler.least_loaded(self.workers())
+            with self.lock:
+                if workflow.status != 'running':
+                    return
+                if worker is None:
+                    workflow.status = 'failed'
+                else:
+                    task_id = str(uuid.uuid4())
+                    params = resolve_refs(node.get('params', {}), workflow.results)
+                    del workflow.waiting[node_id]
+                    workflow.running[task_id] = node_id
+                    self.tasks[task_id] = workflow
+            if worker is None:
+                self._finish(workflow, error="No workers are connected")
+                return
+
+            self.db.store_task(task_id, node['task_type'], worker, workflow.requester, params,
+                               priority=workflow.priority)
+            self.db.update_workflow_node(workflow.workflow_id, node_id, 'running', task_id=task_id, worker=worker)
+            # The worker answers the requester, but the server hands the result to task_finished instead
+            self.scheduler.submit(task_id, worker, workflow.priority, {
+                'type': 'direct',
+                'sender': workflow.requester,
+                'target': worker,
+                'message': f"Workflow {workflow.workflow_id}: {node_id}",
+                'task_data': {
+                    'task_type': node['task_type'],
+                    'params': params
+                },
+                'task_id': task_id,
+                'workflow_id': workflow.workflow_id,
+                'priority': workflow.priority,
+                'timestamp': time.time()
+            })
+
+    def _finish(self, workflow, result=None, error=None):
+        """Store a workflow's outcome and send it to the requester"""
+        status = 'failed' if error is not None else 'completed'
+        self.db.finish_workflow(workflow.workflow_id, status, {'error': error} if error is not None else {'result': result})
+        self.deliver({
+            'type': 'workflow_result',
+            'workflow_id': workflow.workflow_id,
+            'status': status,
+            'result': result,
+            'error': error,
+            'elapsed': time.time() - workflow.started_at,
+            'timestamp': time.time()
+        }, workflow.requester)